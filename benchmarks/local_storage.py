@@ -0,0 +1,78 @@
+"""
+Filesystem-backed stand-in for google.cloud.storage.Client
+
+Implements the subset GCSTransfer uses, so train_lora() can be benchmarked
+end to end without network access. gs://bucket/name maps to
+<root>/bucket/name.
+"""
+
+import base64
+import hashlib
+import os
+import shutil
+
+try:
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
+
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.size = None
+        self.md5_hash = None
+        self.crc32c = None
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.root, self.name)
+
+    def _load_metadata(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.size = len(data)
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+        if google_crc32c is not None:
+            self.crc32c = base64.b64encode(google_crc32c.Checksum(data).digest()).decode("ascii")
+        return self
+
+    def download_to_filename(self, filename):
+        shutil.copyfile(self.path, filename)
+
+    def upload_from_filename(self, filename):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
+
+    def delete(self):
+        os.remove(self.path)
+
+
+class LocalBucket:
+    def __init__(self, root, name):
+        self.name = name
+        self.root = os.path.join(root, name)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name):
+        blob = LocalBlob(self, name)
+        return blob._load_metadata() if os.path.isfile(blob.path) else None
+
+    def list_blobs(self, prefix=""):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                name = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, "/")
+                if name.startswith(prefix):
+                    yield LocalBlob(self, name)._load_metadata()
+
+
+class LocalStorageClient:
+    def __init__(self, root):
+        self.root = root
+
+    def bucket(self, name):
+        return LocalBucket(self.root, name)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+CPU benchmarks for the SDXL generation and LoRA training hot paths
+
+Runs the real generate_sdxl.py and lora-trainer code against a tiny,
+randomly initialised SDXL pipeline (see tiny_sdxl.py), so it needs no GPU,
+no network and no model download. Each suite runs in its own process so
+peak RSS is measured per suite.
+
+Usage:
+    python benchmarks/run_benchmarks.py                    # run and compare with baseline.json
+    python benchmarks/run_benchmarks.py --save-baseline    # record a baseline on this machine
+    python benchmarks/run_benchmarks.py --suite training --output results.json
+
+Exits with status 1 if any metric regressed by more than --threshold
+relative to the baseline.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARK_DIR)
+SDXL_LORA_DIR = os.path.join(REPO_ROOT, "functions", "sdxl-lora")
+TRAINING_DIR = os.path.join(REPO_ROOT, "training")
+LORA_TRAINER_DIR = os.path.join(TRAINING_DIR, "lora-trainer")
+
+SUITES = ("generation", "training")
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, "baseline.json")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CPU benchmarks for MediaForge generation and training")
+    parser.add_argument("--suite", choices=SUITES + ("all",), default="all")
+    parser.add_argument("--output", type=str, default=None, help="Write results JSON here (default: stdout)")
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Allowed relative slowdown before a metric counts as a regression")
+    parser.add_argument("--work-dir", type=str, default=None,
+                        help="Scratch directory for the tiny model and data (default: a temp dir)")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--repeats", type=int, default=1,
+                        help="Run each suite this many times and report the median of each metric")
+    parser.add_argument("--width", type=int, default=64)
+    parser.add_argument("--height", type=int, default=64)
+    parser.add_argument("--images", type=int, default=5, help="Images for the steady-state measurement")
+    parser.add_argument("--train-images", type=int, default=12)
+    parser.add_argument("--train-steps", type=int, default=20)
+    parser.add_argument("--resolution", type=int, default=128, help="Training bucket resolution")
+    parser.add_argument("--num-workers", type=int, default=2, help="DataLoader workers")
+    parser.add_argument("--memory-mode", type=str, default="default",
+                        help="train_lora.py --memory_mode to benchmark (default, low, min)")
+    parser.add_argument("--child", choices=SUITES, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--child-output", type=str, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def bench_generation(args, work_dir):
+    """Pipeline load, first image, time to first image, steady-state throughput, UNet step and VAE decode times"""
+    import torch
+    from tiny_sdxl import build_tiny_sdxl
+
+    # Shared modules (gcs_transfer, instrumentation, lora_export) live in training/
+    sys.path[:0] = [SDXL_LORA_DIR, TRAINING_DIR]
+    import generate_sdxl
+
+    model_dir = build_tiny_sdxl(os.path.join(work_dir, "tiny-sdxl"))
+    output_dir = os.path.join(work_dir, "images")
+    os.makedirs(output_dir, exist_ok=True)
+
+    generator = generate_sdxl.SDXLGenerator(model_id=model_dir, device="cpu")
+    start_time = time.perf_counter()
+    generator.load()
+    load_seconds = time.perf_counter() - start_time
+
+    # Every UNet call is one denoising step (both CFG branches batched together)
+    step_times = []
+    unet = generator.pipe.unet
+    unet.register_forward_pre_hook(lambda module, inputs: step_times.append(-time.perf_counter()))
+    unet.register_forward_hook(lambda module, inputs, output: step_times.__setitem__(
+        -1, step_times[-1] + time.perf_counter()))
+
+    def generate(index):
+        generator.generate(
+            f"benchmark prompt {index}",
+            output_path=os.path.join(output_dir, f"{index}.png"),
+            width=args.width,
+            height=args.height,
+        )
+
+    start_time = time.perf_counter()
+    generate(0)
+    first_image_seconds = time.perf_counter() - start_time
+
+    step_times.clear()
+    start_time = time.perf_counter()
+    for index in range(1, args.images + 1):
+        generate(index)
+    steady_seconds = time.perf_counter() - start_time
+
+    vae = generator.pipe.vae
+    scale = generator.pipe.vae_scale_factor
+    latents = torch.randn(1, vae.config.latent_channels, args.height // scale, args.width // scale)
+    with torch.no_grad():
+        vae.decode(latents)
+        start_time = time.perf_counter()
+        for _ in range(args.images):
+            vae.decode(latents)
+    vae_decode_seconds = (time.perf_counter() - start_time) / args.images
+
+    return {
+        "pipeline_load_seconds": load_seconds,
+        "first_image_seconds": first_image_seconds,
+        # Cold start as a fresh server sees it: load plus the first request
+        "time_to_first_image_seconds": load_seconds + first_image_seconds,
+        "images_per_second": args.images / steady_seconds,
+        "denoising_step_seconds": sum(step_times) / len(step_times),
+        "vae_decode_seconds": vae_decode_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def make_training_images(image_dir, count):
+    """Random images in a mix of portrait, square and landscape shapes"""
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    shapes = [(160, 96), (128, 128), (96, 160)]
+    os.makedirs(image_dir, exist_ok=True)
+    paths = []
+    for index in range(count):
+        width, height = shapes[index % len(shapes)]
+        pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        path = os.path.join(image_dir, f"image_{index:03d}.png")
+        Image.fromarray(pixels).save(path)
+        paths.append(path)
+    return paths
+
+
+def bench_training(args, work_dir):
+    """Data-loader throughput and end-to-end train_lora() steps/sec"""
+    from local_storage import LocalStorageClient
+    from tiny_sdxl import build_tiny_sdxl
+
+    sys.path[:0] = [LORA_TRAINER_DIR, TRAINING_DIR]
+    import train_lora
+    from gcs_transfer import GCSTransfer
+    from training_data import (
+        BrandImageDataset, BucketBatchSampler, assign_bucket, image_size, make_buckets, make_loader
+    )
+
+    model_dir = build_tiny_sdxl(os.path.join(work_dir, "tiny-sdxl"))
+    storage_root = os.path.join(work_dir, "storage")
+    image_paths = make_training_images(os.path.join(storage_root, "bench-input", "brand"), args.train_images)
+
+    # Decode + resize throughput of the image loader, two full epochs
+    bucket_choices = make_buckets(args.resolution)
+    buckets = [assign_bucket(image_size(path), bucket_choices) for path in image_paths]
+    sampler = BucketBatchSampler(buckets, batch_size=4, shuffle=True)
+    loader = make_loader(BrandImageDataset(image_paths, buckets), sampler, num_workers=args.num_workers)
+    start_time = time.perf_counter()
+    loaded = 0
+    for epoch in range(2):
+        sampler.set_epoch(epoch)
+        for batch in loader:
+            loaded += len(batch["index"])
+    dataloader_seconds = time.perf_counter() - start_time
+
+    train_args = train_lora.parse_args([
+        "--brand_id", "bench",
+        "--brand_name", "Bench",
+        "--input_bucket", "bench-input",
+        "--input_path", "brand/",
+        "--output_bucket", "bench-output",
+        "--output_path", "models/bench/",
+        "--max_train_steps", str(args.train_steps),
+        "--resolution", str(args.resolution),
+        "--mixed_precision", "no",
+        "--pretrained_model_name_or_path", model_dir,
+        "--dataloader_num_workers", str(args.num_workers),
+        # Fresh caches each run, so latent precomputation is always included
+        "--latent_cache_dir", tempfile.mkdtemp(prefix="latent_cache-", dir=work_dir),
+        "--checkpoint_dir", tempfile.mkdtemp(prefix="checkpoints-", dir=work_dir),
+        "--checkpointing_steps", "0",
+        # Fixed step count, so throughput is comparable between runs
+        "--validation_steps", "0",
+        "--memory_mode", args.memory_mode,
+    ])
+    start_time = time.perf_counter()
+    metadata = train_lora.train_lora(train_args, transfer=GCSTransfer(client=LocalStorageClient(storage_root)))
+    total_seconds = time.perf_counter() - start_time
+
+    return {
+        "dataloader_images_per_second": loaded / dataloader_seconds,
+        "training_steps_per_second": args.train_steps / metadata["training_seconds"],
+        "train_total_seconds": total_seconds,
+        "train_peak_memory_mb": metadata["peak_memory_mb"],
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+BENCHMARKS = {"generation": bench_generation, "training": bench_training}
+
+
+def run_child(args):
+    """Run one suite in this process and write its metrics to --child-output"""
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+    metrics = BENCHMARKS[args.child](args, args.work_dir)
+    with open(args.child_output, "w") as f:
+        json.dump(metrics, f)
+
+
+def run_suite(suite, args, work_dir):
+    """Run a suite in a fresh interpreter so its peak RSS is its own"""
+    output_path = os.path.join(work_dir, f"{suite}.json")
+    command = [sys.executable, os.path.abspath(__file__), "--child", suite, "--child-output", output_path,
+               "--work-dir", work_dir]
+    for flag in ("threads", "width", "height", "images", "train_images", "train_steps", "resolution",
+                 "num_workers", "memory_mode"):
+        value = getattr(args, flag)
+        if value is not None:
+            command += [f"--{flag.replace('_', '-')}", str(value)]
+
+    print(f"Running {suite} benchmarks...", file=sys.stderr)
+    # Benchmark chatter goes to stderr; stdout is reserved for the results
+    subprocess.run(command, check=True, stdout=sys.stderr, cwd=BENCHMARK_DIR)
+    with open(output_path) as f:
+        return json.load(f)
+
+
+def environment(args):
+    import torch
+    return {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": args.threads or torch.get_num_threads(),
+    }
+
+
+def higher_is_better(metric):
+    return metric.endswith("_per_second")
+
+
+def compare(metrics, baseline, threshold):
+    """Per-metric relative change against the baseline; returns (rows, regressions)"""
+    rows = []
+    regressions = []
+    for name, value in sorted(metrics.items()):
+        reference = baseline.get(name)
+        if not reference:
+            rows.append((name, value, None, None))
+            continue
+        change = (value - reference) / reference
+        # Positive slowdown means worse, whichever direction the metric runs
+        slowdown = -change if higher_is_better(name) else change
+        rows.append((name, value, reference, change))
+        if slowdown > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, BENCHMARK_DIR)
+
+    if args.child:
+        run_child(args)
+        return 0
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="mediaforge-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+
+    suites = SUITES if args.suite == "all" else (args.suite,)
+    runs = {}
+    for suite in suites:
+        for _ in range(args.repeats):
+            for name, value in run_suite(suite, args, work_dir).items():
+                runs.setdefault(f"{suite}.{name}", []).append(value)
+    metrics = {name: statistics.median(values) for name, values in runs.items()}
+
+    results = {"environment": environment(args), "repeats": args.repeats, "metrics": metrics}
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            f.write(output + "\n")
+        print(f"Baseline saved to {args.baseline}", file=sys.stderr)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to record one", file=sys.stderr)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows, regressions = compare(metrics, baseline["metrics"], args.threshold)
+
+    print(f"\n{'metric':<45} {'value':>12} {'baseline':>12} {'change':>8}", file=sys.stderr)
+    for name, value, reference, change in rows:
+        reference_text = f"{reference:12.4f}" if reference is not None else f"{'-':>12}"
+        change_text = f"{change:+8.1%}" if change is not None else f"{'-':>8}"
+        flag = "  REGRESSION" if name in regressions else ""
+        print(f"{name:<45} {value:12.4f} {reference_text} {change_text}{flag}", file=sys.stderr)
+
+    if regressions:
+        print(f"\n{len(regressions)} metric(s) regressed by more than {args.threshold:.0%}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""
+Tiny, randomly initialised SDXL pipeline for CPU benchmarks
+
+Same component classes and wiring as stabilityai/stable-diffusion-xl-base-1.0
+(two CLIP text encoders, text_time UNet conditioning, 4-channel VAE) at a
+few hundred thousand parameters, built entirely offline. Outputs are noise;
+only the code paths and their relative cost matter.
+"""
+
+import json
+import os
+
+import torch
+from diffusers import AutoencoderKL, EulerDiscreteScheduler, StableDiffusionXLPipeline, UNet2DConditionModel
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
+
+
+def _byte_alphabet():
+    """The 256 printable stand-ins CLIP's byte-level BPE uses for raw bytes"""
+    printable = (list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1))
+                 + list(range(ord("®"), ord("ÿ") + 1)))
+    codes = printable[:]
+    extra = 0
+    for byte in range(256):
+        if byte not in printable:
+            printable.append(byte)
+            codes.append(256 + extra)
+            extra += 1
+    return [chr(code) for code in codes]
+
+
+def build_tokenizer(work_dir):
+    """Byte-level CLIP tokenizer with no merges (every byte is a token)"""
+    os.makedirs(work_dir, exist_ok=True)
+    vocab = {}
+    alphabet = _byte_alphabet()
+    for symbol in alphabet + [symbol + "</w>" for symbol in alphabet]:
+        vocab[symbol] = len(vocab)
+    vocab["<|startoftext|>"] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+
+    vocab_file = os.path.join(work_dir, "vocab.json")
+    merges_file = os.path.join(work_dir, "merges.txt")
+    with open(vocab_file, "w") as f:
+        json.dump(vocab, f)
+    with open(merges_file, "w") as f:
+        f.write("#version: 0.2\n")
+    return CLIPTokenizer(vocab_file, merges_file, model_max_length=77)
+
+
+def build_tiny_sdxl(output_dir, seed=0):
+    """Save a tiny SDXL pipeline to output_dir (reused if already there) and return the path"""
+    if os.path.exists(os.path.join(output_dir, "model_index.json")):
+        return output_dir
+
+    torch.manual_seed(seed)
+    tokenizer = build_tokenizer(os.path.join(output_dir, "_tokenizer_src"))
+
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=2,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4),
+        use_linear_projection=True,
+        addition_embed_type="text_time",
+        addition_time_embed_dim=8,
+        transformer_layers_per_block=(1, 2),
+        # pooled text embeds (32) + 6 time ids * addition_time_embed_dim (8)
+        projection_class_embeddings_input_dim=80,
+        # hidden states of both text encoders concatenated (32 + 32)
+        cross_attention_dim=64,
+        norm_num_groups=1,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+        up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"],
+        latent_channels=4,
+        sample_size=128,
+        norm_num_groups=1,
+    )
+    text_config = CLIPTextConfig(
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=37,
+        layer_norm_eps=1e-05,
+        num_attention_heads=4,
+        num_hidden_layers=5,
+        hidden_act="gelu",
+        projection_dim=32,
+    )
+    scheduler = EulerDiscreteScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        steps_offset=1,
+        beta_schedule="scaled_linear",
+        timestep_spacing="leading",
+    )
+
+    pipe = StableDiffusionXLPipeline(
+        vae=vae,
+        text_encoder=CLIPTextModel(text_config),
+        tokenizer=tokenizer,
+        text_encoder_2=CLIPTextModelWithProjection(text_config),
+        tokenizer_2=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+    )
+    pipe.save_pretrained(output_dir)
+    return output_dir
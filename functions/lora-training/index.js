@@ -187,7 +187,6 @@ functions.http('runLoraTraining', async (req, res) => {
                 '--output_bucket', MODELS_BUCKET,
                 '--output_path', `models/${brandId}/`,
                 '--num_images', imageCount.toString(),
-                '--max_train_steps', '500',
                 '--learning_rate', '1e-4'
               ]
             }
@@ -0,0 +1,99 @@
+"""
+Device selection and per-device tuning for SDXL generation
+
+The generator runs on CUDA when a GPU is present and otherwise on CPU, a
+slower but much cheaper capacity tier for low-priority jobs (and what CI
+runs on). On CUDA the weights are fp16 and attention uses xformers when it
+is installed; everywhere else it uses PyTorch's scaled-dot-product
+attention. The CPU path keeps fp32 weights, optionally running the UNet
+under bf16 autocast, converts the UNet and VAE to channels-last and sizes
+the intra-op thread pool to the CPUs this process may use. torch.compile
+is opt-in; its compiled graphs are cached on disk so later processes skip
+most of the compile time.
+"""
+
+import contextlib
+import os
+
+import torch
+from diffusers.models.attention_processor import AttnProcessor2_0
+from diffusers.utils import is_xformers_available
+
+# Weight dtype / autocast dtype on CPU
+CPU_PRECISIONS = ("fp32", "bf16")
+
+
+def resolve_device(device="auto"):
+    """CUDA for "auto" when a GPU is available, otherwise CPU; explicit devices pass through"""
+    if device in (None, "", "auto"):
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    return device
+
+
+def is_cuda(device):
+    return torch.device(device).type == "cuda"
+
+
+def weight_dtype(device):
+    return torch.float16 if is_cuda(device) else torch.float32
+
+
+def available_cpus():
+    """CPUs this process may run on (the container's share, not the host's)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def configure_runtime(device, num_threads=None):
+    """Process-wide backend settings; call once before loading models"""
+    if is_cuda(device):
+        torch.backends.cudnn.benchmark = True
+    else:
+        torch.set_num_threads(num_threads or available_cpus())
+
+
+def use_efficient_attention(module, device):
+    """xformers on CUDA when installed, PyTorch SDPA otherwise"""
+    if is_cuda(device) and is_xformers_available():
+        module.enable_xformers_memory_efficient_attention()
+    else:
+        module.set_attn_processor(AttnProcessor2_0())
+
+
+def tune_module(module, device):
+    """Memory format for the conv-heavy UNet and VAE"""
+    if not is_cuda(device):
+        # oneDNN convolutions are fastest on NHWC
+        module.to(memory_format=torch.channels_last)
+
+
+def compile_module(module, cache_dir):
+    """torch.compile a module in place, reusing compiled graphs from cache_dir across processes"""
+    # Importing torch already points this at a per-user /tmp directory
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    import torch._inductor.config as inductor_config
+
+    inductor_config.fx_graph_cache = True
+    # In place keeps the module itself on the pipeline, so adapters still attach to it
+    module.compile()
+
+
+def autocast(device, cpu_precision="fp32"):
+    """bf16 autocast for the denoising loop on CPU when requested"""
+    if not is_cuda(device) and cpu_precision == "bf16":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def synchronize(device):
+    """Wait for queued kernels, so step timings are real"""
+    if is_cuda(device):
+        torch.cuda.synchronize()
+
+
+def empty_cache():
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
@@ -0,0 +1,180 @@
+"""
+Prompt embedding cache for the SDXL text encoders
+
+Keeps prompt_embeds/pooled_prompt_embeds for recently used prompts so
+repeated prompts skip both text encoders, and computes the unconditional
+(negative) embeddings once per encoder state. Entries can optionally be
+written through to disk so they survive restarts. A size of 0 disables
+the cache; every prompt is then encoded on every call.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+from safetensors.torch import load_file, save_file
+
+TEXT_ENCODERS = ("text_encoder", "text_encoder_2")
+
+
+class PromptEmbeddingCache:
+    """Bounded LRU of SDXL prompt embeddings keyed by encoder identity and prompt"""
+
+    def __init__(self, max_entries=256, spill_dir=None, offload_encoders=False, load_encoders=None):
+        self.max_entries = max_entries
+        self.spill_dir = spill_dir
+        self.offload_encoders = offload_encoders
+        # Called before encoding so lazily loaded text encoders are only loaded on a miss
+        self.load_encoders = load_encoders
+        # key -> (prompt_embeds, pooled_prompt_embeds), oldest first
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    @staticmethod
+    def _key(encoder_id, prompt):
+        # prompt=None is the unconditional (negative) embedding
+        text = "\0uncond" if prompt is None else prompt
+        return hashlib.sha256(f"{encoder_id}\0{text}".encode("utf-8")).hexdigest()
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, f"{key}.safetensors")
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def _get(self, key, device):
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        if self.spill_dir and os.path.exists(self._spill_path(key)):
+            try:
+                tensors = load_file(self._spill_path(key), device=str(device))
+            except Exception as e:
+                print(f"Warning: ignoring unreadable embedding cache file: {e}")
+            else:
+                entry = (tensors["prompt_embeds"], tensors["pooled_prompt_embeds"])
+                self._put(key, entry, spill=False)
+                self.disk_hits += 1
+                return entry
+
+        return None
+
+    def _put(self, key, entry, spill=True):
+        if not self.enabled:
+            return
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+        if spill and self.spill_dir:
+            path = self._spill_path(key)
+            tmp_path = f"{path}.tmp"
+            save_file(
+                {
+                    "prompt_embeds": entry[0].detach().to("cpu").contiguous(),
+                    "pooled_prompt_embeds": entry[1].detach().to("cpu").contiguous(),
+                },
+                tmp_path,
+            )
+            os.replace(tmp_path, path)
+
+    def _encoders_to(self, pipe, device):
+        for name in TEXT_ENCODERS:
+            encoder = getattr(pipe, name, None)
+            if encoder is not None:
+                encoder.to(device)
+
+    def _encode(self, pipe, prompts, device, negative=False):
+        """Run both text encoders once for all prompts that missed"""
+        if self.load_encoders is not None:
+            self.load_encoders()
+        if self.offload_encoders:
+            self._encoders_to(pipe, device)
+        try:
+            with torch.no_grad():
+                if negative:
+                    _, embeds, _, pooled = pipe.encode_prompt(
+                        prompt="",
+                        device=device,
+                        num_images_per_prompt=1,
+                        do_classifier_free_guidance=True,
+                    )
+                else:
+                    embeds, _, pooled, _ = pipe.encode_prompt(
+                        prompt=list(prompts),
+                        device=device,
+                        num_images_per_prompt=1,
+                        do_classifier_free_guidance=False,
+                    )
+        finally:
+            if self.offload_encoders:
+                self._encoders_to(pipe, "cpu")
+        return embeds, pooled
+
+    def offload(self, pipe):
+        """Move the text encoders off the accelerator until the next miss"""
+        self._encoders_to(pipe, "cpu")
+
+    def encode(self, pipe, prompts, encoder_id, device):
+        """Batched (prompt_embeds, pooled_prompt_embeds), encoding only cache misses"""
+        with self._lock:
+            keys = [self._key(encoder_id, prompt) for prompt in prompts]
+            entries = [self._get(key, device) for key in keys]
+
+            missing = [i for i, entry in enumerate(entries) if entry is None]
+            if missing:
+                self.misses += len(missing)
+                # Duplicate prompts in one batch are encoded once
+                unique_prompts = list(dict.fromkeys(prompts[i] for i in missing))
+                embeds, pooled = self._encode(pipe, unique_prompts, device)
+                # From the fresh encodings, not the LRU: a batch can evict its own earlier entries
+                encoded = {}
+                for j, prompt in enumerate(unique_prompts):
+                    encoded[prompt] = (embeds[j:j + 1], pooled[j:j + 1])
+                    self._put(self._key(encoder_id, prompt), encoded[prompt])
+                for i in missing:
+                    entries[i] = encoded[prompts[i]]
+
+            prompt_embeds = torch.cat([entry[0] for entry in entries])
+            pooled_prompt_embeds = torch.cat([entry[1] for entry in entries])
+            return prompt_embeds, pooled_prompt_embeds
+
+    def unconditional(self, pipe, encoder_id, device, batch_size=1):
+        """Negative embeddings for classifier-free guidance, computed once per encoder state"""
+        with self._lock:
+            key = self._key(encoder_id, None)
+            entry = self._get(key, device)
+            if entry is None:
+                self.misses += 1
+                entry = self._encode(pipe, None, device, negative=True)
+                self._put(key, entry)
+            embeds, pooled = entry
+            return embeds.expand(batch_size, -1, -1), pooled.expand(batch_size, -1)
+
+    def stats(self):
+        """Hit/miss counters and current size"""
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "spill_dir": self.spill_dir,
+        }
@@ -2,161 +2,864 @@
 """
 SDXL + LoRA generation script for MediaForge
 Optimized for Cloud Run with scale-to-zero
+
+Runs one-shot (one prompt per process), as a warm inference server
+(--serve) that keeps the pipeline resident between requests, or as an
+offline batch job over a JSONL manifest (--manifest).
 """
 
+import time
+
+# Cold-start clock for time-to-first-image, taken before the heavy imports
+PROCESS_START_TIME = time.time()
+
 import argparse
+import base64
+import json
+import math
+import sys
+import threading
 import torch
-from diffusers import DiffusionPipeline, StableDiffusionXLPipeline
-from diffusers import DPMSolverMultistepScheduler
 import os
 import gc
+from concurrent.futures import Future
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
-from google.cloud import storage
-import time
 
-# Configure for optimal memory usage
-torch.cuda.empty_cache()
-torch.backends.cudnn.benchmark = True
+from diffusers import StableDiffusionXLImg2ImgPipeline
+
+from devices import (
+    CPU_PRECISIONS, autocast, compile_module, configure_runtime, empty_cache, is_cuda, resolve_device, synchronize,
+    tune_module, use_efficient_attention, weight_dtype
+)
+from embedding_cache import PromptEmbeddingCache
+from image_output import OutputEncoder, output_options
+from instrumentation import Instrumentation, StepProfiler, stage_seconds
+from lora_cache import LoraAdapterCache, lora_targets_text_encoders
+from lora_disk_cache import LoraDiskCache
+from model_loader import LazyComponents, build_pipeline, decode_latents, resolve_snapshot
+from previews import GenerationCancelled, LatentPreviewer
+from quality_tiers import DEFAULT_QUALITY_TIER, QUALITY_TIERS, render_plan, upscale_latents
+from result_cache import LocalResultStore, ResultCache, result_key
 
 # Cache directory for models
 CACHE_DIR = "/tmp/model_cache"
 os.makedirs(CACHE_DIR, exist_ok=True)
 
-def download_lora_weights(lora_path):
-    """Download LoRA weights from Cloud Storage if not cached"""
-    if not lora_path:
-        return None
-
-    # Parse GCS path: gs://bucket/path/to/model.safetensors
-    if lora_path.startswith("gs://"):
-        parts = lora_path.replace("gs://", "").split("/", 1)
-        bucket_name = parts[0]
-        blob_path = parts[1] if len(parts) > 1 else ""
-
-        local_path = os.path.join(CACHE_DIR, "lora", blob_path)
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-
-        # Check if already downloaded
-        if not os.path.exists(local_path):
-            print(f"Downloading LoRA weights from {lora_path}")
-            client = storage.Client()
-            bucket = client.bucket(bucket_name)
-            blob = bucket.blob(blob_path)
-            blob.download_to_filename(local_path)
-            print(f"LoRA weights downloaded to {local_path}")
-        else:
-            print(f"Using cached LoRA weights from {local_path}")
+MODEL_ID = "stabilityai/stable-diffusion-xl-base-1.0"
 
-        return local_path
+# "auto" runs on CUDA when a GPU is present, otherwise on CPU
+DEVICE = os.environ.get("SDXL_DEVICE", "auto")
+# CPU only: fp32, or bf16 autocast for the denoising loop
+CPU_PRECISION = os.environ.get("CPU_PRECISION", "fp32")
+# torch.compile the UNet; compiled graphs are cached under CACHE_DIR
+TORCH_COMPILE = os.environ.get("TORCH_COMPILE", "") == "1"
 
-    return lora_path
+# Memory budget for LoRA adapters kept resident on the pipeline
+LORA_CACHE_MB = int(os.environ.get("LORA_CACHE_MB", "1024"))
 
-def generate_image(prompt, lora_path=None, output_path="output.png", width=1024, height=1024):
-    """Generate image using SDXL with optional LoRA"""
+# Disk budget for downloaded LoRA weight files; on Cloud Run /tmp is memory
+LORA_DISK_CACHE_MB = int(os.environ.get("LORA_DISK_CACHE_MB", "1024"))
 
-    print(f"Starting generation: {width}x{height}")
-    print(f"Prompt: {prompt}")
+# Encoded images of explicitly seeded requests, replayed for identical repeats (0 disables)
+RESULT_CACHE_MB = int(os.environ.get("RESULT_CACHE_MB", "256"))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", os.path.join(CACHE_DIR, "results"))
 
-    start_time = time.time()
+# Prompt embeddings kept in memory, optionally written through to disk
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "512"))
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "")
+
+# Progress previews: "linear" latent-to-RGB projection, or a tiny autoencoder
+# (hub id or directory, e.g. madebyollin/taesdxl)
+PREVIEW_DECODER = os.environ.get("PREVIEW_DECODER", "linear")
+
+# Background threads encoding finished images while the next job denoises
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", "2"))
+
+# torch.profiler traces of the first request's denoising steps (opt-in)
+PROFILE_DIR = "/tmp/sdxl_profile"
 
-    # Load base SDXL model
+def load_pipeline(model_id=MODEL_ID, device=DEVICE, metrics=None, compile=False):
+    """Load the SDXL UNet and scheduler onto device; other components load lazily
+
+    Returns the pipeline and the LazyComponents that loads its VAE and
+    text encoders on first use.
+    """
+    metrics = metrics or Instrumentation("sdxl-lora")
     print("Loading SDXL base model...")
-    model_id = "stabilityai/stable-diffusion-xl-base-1.0"
-
-    # Use cached model if available
-    local_model_path = os.path.join(CACHE_DIR, "sdxl-base")
-
-    if os.path.exists(local_model_path):
-        print("Loading SDXL from cache...")
-        pipe = StableDiffusionXLPipeline.from_pretrained(
-            local_model_path,
-            torch_dtype=torch.float16,
-            use_safetensors=True,
-            variant="fp16",
-            local_files_only=True
+    device = resolve_device(device)
+    torch_dtype = weight_dtype(device)
+
+    with metrics.span("weights_load", model_id=model_id):
+        # One copy on disk: the hub cache (fp16 files only) or the local directory
+        model_dir = resolve_snapshot(model_id, CACHE_DIR)
+        print(f"Loading SDXL from {model_dir}...")
+        pipe = build_pipeline(model_dir, device, torch_dtype, metrics)
+
+        # Memory-efficient attention: xformers on GPU when installed, SDPA otherwise
+        use_efficient_attention(pipe.unet, device)
+        tune_module(pipe.unet, device)
+
+    if compile:
+        # Compiles on the first request; later processes reuse the cached graphs
+        compile_module(pipe.unet, os.path.join(CACHE_DIR, "inductor"))
+
+    def on_load(name, module):
+        if name == "vae":
+            use_efficient_attention(module, device)
+            tune_module(module, device)
+            module.enable_slicing()
+            module.enable_tiling()
+
+    return pipe, LazyComponents(pipe, model_dir, device, torch_dtype, metrics, on_load=on_load)
+
+class SDXLGenerator:
+    """Resident SDXL pipeline that serves generate requests back-to-back"""
+
+    def __init__(self, model_id=MODEL_ID, device=DEVICE, lora_cache_mb=LORA_CACHE_MB,
+                 lora_disk_cache_mb=LORA_DISK_CACHE_MB, embedding_cache_size=EMBEDDING_CACHE_SIZE, embedding_cache_dir=EMBEDDING_CACHE_DIR,
+                 offload_text_encoders=False, metrics=None, profile_steps=0, profile_dir=PROFILE_DIR,
+                 encode_workers=ENCODE_WORKERS, result_cache_mb=RESULT_CACHE_MB, result_cache_dir=RESULT_CACHE_DIR,
+                 result_store=None, cpu_precision=CPU_PRECISION, num_threads=None, compile=TORCH_COMPILE,
+                 preview_decoder=PREVIEW_DECODER):
+        if cpu_precision not in CPU_PRECISIONS:
+            raise ValueError(f"Unknown CPU precision {cpu_precision!r}; expected one of {CPU_PRECISIONS}")
+        self.model_id = model_id
+        self.device = resolve_device(device)
+        self.cpu_precision = cpu_precision
+        self.num_threads = num_threads
+        self.compile = compile
+        self.lora_cache_mb = lora_cache_mb
+        self.pipe = None
+        # img2img view of the same components, for latent-upscale refinement
+        self._refiner = None
+        self.components = None
+        self.lora_cache = None
+        self.lora_files = LoraDiskCache(os.path.join(CACHE_DIR, "lora"), max_bytes=lora_disk_cache_mb * 1024 * 1024)
+        # Any object with get(key)/put(key, meta, files) can stand in for the local store
+        if result_store is None and result_cache_mb > 0:
+            result_store = LocalResultStore(result_cache_dir, max_bytes=result_cache_mb * 1024 * 1024)
+        self.results = ResultCache(result_store) if result_store is not None else None
+        self.embedding_cache = PromptEmbeddingCache(
+            max_entries=embedding_cache_size,
+            spill_dir=embedding_cache_dir or None,
+            offload_encoders=offload_text_encoders,
+            load_encoders=self._load_text_encoders,
         )
-    else:
-        print("Downloading SDXL model (first run only)...")
-        pipe = StableDiffusionXLPipeline.from_pretrained(
-            model_id,
-            torch_dtype=torch.float16,
-            use_safetensors=True,
-            variant="fp16",
-            cache_dir=CACHE_DIR
+        self.metrics = metrics or Instrumentation.from_env("sdxl-lora")
+        self.encoder = OutputEncoder(max_workers=encode_workers)
+        self.previewer = LatentPreviewer(preview_decoder, device=self.device)
+        # Only the first request's denoising loop is profiled
+        self.profiler = StepProfiler(profile_dir, steps=profile_steps)
+        self.load_seconds = None
+        self.time_to_first_image = None
+        self.requests_served = 0
+        self.error = None
+        # The pipeline is not re-entrant; requests are served one at a time
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.pipe is not None
+
+    def load(self):
+        """Load the pipeline once; subsequent calls are no-ops"""
+        with self._lock:
+            if self.pipe is not None:
+                return self
+            start_time = time.time()
+            try:
+                with self.metrics.span("model_load", model_id=self.model_id, device=self.device):
+                    configure_runtime(self.device, self.num_threads)
+                    self.pipe, self.components = load_pipeline(self.model_id, self.device, metrics=self.metrics,
+                                                               compile=self.compile)
+                    self.lora_cache = LoraAdapterCache(
+                        self.pipe, max_bytes=self.lora_cache_mb * 1024 * 1024,
+                        before_load=self._prepare_lora,
+                    )
+            except Exception as e:
+                self.error = str(e)
+                raise
+            self.load_seconds = time.time() - start_time
+            print(f"Model loaded in {self.load_seconds:.2f} seconds")
+        return self
+
+    def status(self):
+        """Health/readiness snapshot for the server and callers"""
+        return {
+            "status": "ready" if self.ready else ("failed" if self.error else "loading"),
+            "ready": self.ready,
+            "model_id": self.model_id,
+            "device": self.device,
+            "cpu_precision": None if is_cuda(self.device) else self.cpu_precision,
+            "compiled": self.compile,
+            "load_seconds": self.load_seconds,
+            "time_to_first_image_seconds": self.time_to_first_image,
+            "components": {
+                name: self.components.loaded(name) for name in ("vae", "text_encoder", "text_encoder_2")
+            } if self.components else None,
+            "requests_served": self.requests_served,
+            "error": self.error,
+            "lora_cache": self.lora_cache.stats() if self.lora_cache else None,
+            "lora_disk_cache": self.lora_files.stats(),
+            "embedding_cache": self.embedding_cache.stats(),
+            "result_cache": self.results.stats() if self.results else None,
+            "stages": self.metrics.summary(),
+        }
+
+    def _load_text_encoders(self):
+        """Load both text encoders on the first embedding-cache miss"""
+        # Offloaded encoders are loaded on CPU and only moved to the device to encode
+        self.components.ensure_text_encoders("cpu" if self.embedding_cache.offload_encoders else None)
+
+    def _prepare_lora(self, lora_path):
+        """Text-encoder LoRA layers need the encoders loaded before the adapter is"""
+        if lora_targets_text_encoders(lora_path):
+            self._load_text_encoders()
+
+    @contextmanager
+    def _lora_weights(self, lora_path):
+        """Local LoRA weights for one request, kept on disk until the with block exits
+
+        Yields None without an adapter; missing weights fail the request
+        instead of rendering without the brand.
+        """
+        if not lora_path:
+            yield None
+            return
+        with ExitStack() as stack:
+            with self.metrics.span("lora_download", lora_path=lora_path):
+                if lora_path.startswith("gs://"):
+                    local_lora = stack.enter_context(self.lora_files.pinned(lora_path))
+                else:
+                    local_lora = lora_path
+            if not os.path.exists(local_lora):
+                raise FileNotFoundError(f"LoRA weights not found at {lora_path}")
+            yield local_lora
+
+    def _activate_lora(self, lora_path, local_lora, lora_scale):
+        """Activate the brand adapter (loaded once, then served from the cache)"""
+        self.lora_cache.deactivate()
+        if local_lora:
+            lora_start = time.time()
+            with self.metrics.span("lora_load", lora_path=lora_path) as span:
+                span["adapter"] = self.lora_cache.activate(local_lora, lora_scale=lora_scale)
+            print(f"LoRA adapter active (scale {lora_scale}) in {time.time() - lora_start:.3f} seconds")
+
+    def _refine(self, latents, plan, embeds, generators, on_step_end):
+        """Upscale latents to the requested size and re-denoise them briefly (img2img on the same UNet)"""
+        width, height = plan["upscale"]
+        # img2img reads the VAE config even when given latents
+        self.components.ensure("vae")
+        if self._refiner is None:
+            self._refiner = StableDiffusionXLImg2ImgPipeline(**self.pipe.components)
+        latents = upscale_latents(latents, width, height, self.pipe.vae_scale_factor)
+        return self._refiner(
+            image=latents,
+            strength=plan["refine_strength"],
+            # img2img runs num_inference_steps * strength of them
+            num_inference_steps=math.ceil(plan["refine_steps"] / plan["refine_strength"]),
+            guidance_scale=plan["guidance_scale"],
+            generator=generators,
+            output_type="latent",
+            callback_on_step_end=on_step_end,
+            **embeds
+        ).images
+
+    def _result_keys(self, prompts, seeds, local_lora, lora_scale, plan, output):
+        """Result-cache key per image, None where the seed wasn't given
+
+        local_lora is the file the images will be rendered with, so the key
+        names the adapter actually used.
+        """
+        if self.results is None or all(seed is None for seed in seeds):
+            return [None] * len(prompts)
+        adapter = self.lora_cache.content_hash(local_lora) if local_lora else None
+        common = dict(
+            model=self.components.model_dir,
+            device=self.device,
+            dtype=str(self.components.torch_dtype),
+            cpu_precision=None if is_cuda(self.device) else self.cpu_precision,
+            compiled=self.compile,
+            # Private config entries (e.g. _use_default_values, a set) aren't stable across processes
+            scheduler={name: value for name, value in self.pipe.scheduler.config.items() if not name.startswith("_")},
+            scheduler_class=type(self.pipe.scheduler).__name__,
+            adapter=adapter,
+            lora_scale=lora_scale if adapter else None,
+            plan=plan,
+            # The cache holds encoded bytes; only their destination doesn't matter
+            output={name: value for name, value in output.items() if name != "inline"},
         )
-        # Save for next time
-        pipe.save_pretrained(local_model_path)
+        return [
+            result_key(prompt=prompt, seed=seed, **common) if seed is not None else None
+            for prompt, seed in zip(prompts, seeds)
+        ]
 
-    # Move to GPU
-    pipe = pipe.to("cuda")
+    def submit_batch(self, prompts, output_paths=None, lora_path=None, width=1024, height=1024,
+                     lora_scale=0.8, seeds=None, output=None, quality_tier=None, on_preview=None,
+                     preview_steps=0, cancel=None):
+        """Denoise and decode a batch in one pipe() call, then queue the images for encoding
 
-    # Optimize with scheduler
-    pipe.scheduler = DPMSolverMultistepScheduler.from_config(
-        pipe.scheduler.config,
-        use_karras_sigmas=True
-    )
+        Returns as soon as the images are queued, so the next batch can start
+        denoising; pass the result to finish_batch() for the encoded outputs.
+        Images with an explicit seed are served from the result cache when
+        the same request was rendered before; the rest default to seed 42
+        and are never cached.
 
-    # Enable memory efficient attention
-    pipe.enable_xformers_memory_efficient_attention()
-    pipe.enable_vae_slicing()
-    pipe.enable_vae_tiling()
-
-    # Load LoRA weights if provided
-    if lora_path:
-        local_lora = download_lora_weights(lora_path)
-        if local_lora and os.path.exists(local_lora):
-            print(f"Loading LoRA weights from {local_lora}")
-            pipe.load_lora_weights(local_lora)
-            pipe.fuse_lora(lora_scale=0.8)  # Adjust strength as needed
-        else:
-            print(f"Warning: LoRA weights not found at {local_lora}")
+        With preview_steps, on_preview(preview) is called every that many
+        denoising steps with a small JPEG of each in-progress image. Setting
+        the cancel event (a threading.Event) stops the job at the next step
+        with GenerationCancelled.
+        """
+        if not self.ready:
+            self.load()
+
+        seeds = list(seeds or [None] * len(prompts))
+        output_paths = output_paths or [None] * len(prompts)
+        # Thumbnails are checked against the requested size, as the server does
+        output = output_options(output, max_size=max(width, height))
+        if not output["inline"] and not all(output_paths):
+            raise ValueError("output paths are required unless output is returned inline")
+        plan = render_plan(quality_tier, width, height)
+        # Drafts come back at their render size
+        width, height = plan["upscale"] or (plan["width"], plan["height"])
+
+        with self.metrics.capture() as records:
+            start_time = time.time()
+            # The adapter file stays on disk (never evicted) from the cache key to the render
+            with self._lora_weights(lora_path) as local_lora:
+                keys = self._result_keys(prompts, seeds, local_lora, lora_scale, plan, output)
+                futures = [None] * len(prompts)
+                if any(keys):
+                    with self.metrics.span("result_cache", images=sum(map(bool, keys))) as span:
+                        for i, (key, output_path) in enumerate(zip(keys, output_paths)):
+                            cached = self.results.lookup(key, output_path, output) if key else None
+                            if cached is not None:
+                                futures[i] = Future()
+                                futures[i].set_result(cached)
+                                keys[i] = None
+                        span["hits"] = sum(future is not None for future in futures)
+                    if span["hits"]:
+                        print(f"Result cache: {span['hits']} of {len(prompts)} images served")
+
+                todo = [i for i, future in enumerate(futures) if future is None]
+                generation_seconds = 0.0
+                if todo:
+                    preview_callback = None
+                    if on_preview is not None:
+                        def preview_callback(preview):
+                            # Numbered by position in this batch, not in the rendered subset
+                            on_preview(dict(preview, index=todo[preview["index"]]))
+                    with self._lock:
+                        rendered, generation_seconds = self._render(
+                            [prompts[i] for i in todo],
+                            [output_paths[i] for i in todo],
+                            [42 if seeds[i] is None else seeds[i] for i in todo],
+                            lora_path, local_lora, lora_scale, plan,
+                            # Cacheable images are encoded to memory too, for the store
+                            [dict(output, inline=True) if keys[i] else output for i in todo],
+                            preview_callback, preview_steps, cancel,
+                        )
+                    for i, future in zip(todo, rendered):
+                        futures[i] = future
+
+        return {
+            "futures": futures,
+            "cache_keys": keys,
+            "inline": output["inline"],
+            "records": records,
+            "start_time": start_time,
+            "width": width,
+            "height": height,
+            "quality_tier": plan["quality_tier"],
+            "generation_seconds": generation_seconds,
+        }
+
+    def _render(self, prompts, output_paths, seeds, lora_path, local_lora, lora_scale, plan, outputs,
+                on_preview=None, preview_steps=0, cancel=None):
+        """Run the pipeline for a batch and queue its images for encoding (caller holds the lock)
+
+        Returns the encode futures and the generation time.
+        """
+        # Cancelled while waiting for the pipeline
+        self._check_cancelled(cancel, 0)
+
+        width, height = plan["upscale"] or (plan["width"], plan["height"])
+        print(f"Starting generation: {len(prompts)} x {width}x{height} ({plan['quality_tier']})")
+        for prompt in prompts:
+            print(f"Prompt: {prompt}")
+
+        with self.metrics.span("request", batch_size=len(prompts), width=width, height=height,
+                               quality_tier=plan["quality_tier"]):
+            self._activate_lora(lora_path, local_lora, lora_scale)
+
+            # Text embeddings come from the cache; encoders only run on a miss
+            encode_start = time.time()
+            with self.metrics.span("text_encode", prompts=len(prompts)):
+                encoder_id = f"{self.model_id}:{self.lora_cache.text_encoder_state()}"
+                prompt_embeds, pooled_prompt_embeds = self.embedding_cache.encode(
+                    self.pipe, list(prompts), encoder_id, self.device
+                )
+                negative_prompt_embeds, negative_pooled_prompt_embeds = self.embedding_cache.unconditional(
+                    self.pipe, encoder_id, self.device, batch_size=len(prompts)
+                )
+            print(f"Prompts encoded in {time.time() - encode_start:.3f} seconds")
+
+            # Generate images
+            print("Generating image...")
+            gen_start = time.time()
+
+            # One generator per image keeps every image reproducible from its own seed
+            generators = [torch.Generator(device=self.device).manual_seed(seed) for seed in seeds]
 
-    print(f"Model loaded in {time.time() - start_time:.2f} seconds")
+            # The VAE loads in the background while the first request denoises
+            self.components.preload("vae")
 
-    # Generate image
-    print("Generating image...")
-    gen_start = time.time()
+            step_ends = []
+            profiler = self.profiler if self.requests_served == 0 else StepProfiler(None)
 
-    generator = torch.Generator(device="cuda").manual_seed(42)
+            total_steps = plan["steps"] + (plan["refine_steps"] if plan["upscale"] else 0)
 
-    image = pipe(
-        prompt=prompt,
-        height=height,
-        width=width,
-        num_inference_steps=25,  # Reduced for speed
-        guidance_scale=7.5,
-        generator=generator
-    ).images[0]
+            def on_step_end(pipe, step, timestep, callback_kwargs):
+                synchronize(self.device)
+                step_ends.append(time.perf_counter())
+                profiler.step()
+                if cancel is not None and cancel.is_set():
+                    # The pipeline skips its remaining steps
+                    pipe._interrupt = True
+                elif on_preview and preview_steps and len(step_ends) % preview_steps == 0 \
+                        and len(step_ends) < total_steps:
+                    self._emit_previews(callback_kwargs["latents"], len(step_ends), total_steps, on_preview)
+                return callback_kwargs
 
-    print(f"Image generated in {time.time() - gen_start:.2f} seconds")
+            embeds = dict(
+                prompt_embeds=prompt_embeds,
+                pooled_prompt_embeds=pooled_prompt_embeds,
+                negative_prompt_embeds=negative_prompt_embeds,
+                negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+            )
+            with profiler, autocast(self.device, self.cpu_precision):
+                pipe_start = time.perf_counter()
+                latents = self.pipe(
+                    height=plan["height"],
+                    width=plan["width"],
+                    num_inference_steps=plan["steps"],
+                    guidance_scale=plan["guidance_scale"],
+                    generator=generators,
+                    output_type="latent",
+                    callback_on_step_end=on_step_end,
+                    **embeds
+                ).images
+                loop_end = time.perf_counter()
 
-    # Save image
-    image.save(output_path, "PNG")
-    print(f"Image saved to {output_path}")
+            self.metrics.record("denoise", loop_end - pipe_start, steps=len(step_ends),
+                                step_seconds=(loop_end - pipe_start) / max(len(step_ends), 1))
+            self._check_cancelled(cancel, len(step_ends))
 
-    # Clean up memory
-    del pipe
-    torch.cuda.empty_cache()
-    gc.collect()
+            if plan["upscale"]:
+                base_steps = len(step_ends)
+                with self.metrics.span("refine", width=width, height=height) as span, \
+                        autocast(self.device, self.cpu_precision):
+                    latents = self._refine(latents, plan, embeds, generators, on_step_end)
+                    span["steps"] = len(step_ends) - base_steps
+                self._check_cancelled(cancel, len(step_ends))
+
+            self.components.ensure("vae")
+            with self.metrics.span("vae_decode", batch_size=len(prompts)):
+                images = decode_latents(self.pipe, latents)
+
+            generation_seconds = time.time() - gen_start
+            print(f"Image generated in {generation_seconds:.2f} seconds")
+
+            # Encoding runs on the encoder's threads, outside the pipeline lock
+            futures = [
+                self.encoder.submit(image, output_path, options)
+                for image, output_path, options in zip(images, output_paths, outputs)
+            ]
+
+        self.requests_served += len(prompts)
+        return futures, generation_seconds
+
+    def _check_cancelled(self, cancel, steps):
+        if cancel is not None and cancel.is_set():
+            self.metrics.emit("cancelled", steps=steps)
+            print(f"Generation cancelled after {steps} steps")
+            raise GenerationCancelled(f"Generation cancelled after {steps} steps")
+
+    def _emit_previews(self, latents, step, total_steps, on_preview):
+        """Decode in-progress latents to small JPEGs and hand them to on_preview"""
+        with self.metrics.span("preview", step=step):
+            previews = self.previewer.previews(latents)
+        for index, data in enumerate(previews):
+            on_preview({"step": step, "steps": total_steps, "index": index,
+                        "content_type": "image/jpeg", "data": data})
+
+    def finish_batch(self, submitted):
+        """Wait for a submitted batch's encoded outputs"""
+        with self.metrics.capture() as records:
+            wait_start = time.perf_counter()
+            outputs = [future.result() for future in submitted["futures"]]
+            self.metrics.record("encode_wait", time.perf_counter() - wait_start)
+            for key, output in zip(submitted["cache_keys"], outputs):
+                if key:
+                    self._store_result(key, output, submitted["inline"])
+            # Encoder thread time, which overlapped with whatever ran next
+            self.metrics.record("encode", sum(output["seconds"] for output in outputs),
+                                images=len(outputs), format=outputs[0]["format"] if outputs else None)
+            for output in outputs:
+                if "output_path" in output:
+                    print(f"Image saved to {output['output_path']}")
+
+        if self.time_to_first_image is None:
+            self.time_to_first_image = time.time() - PROCESS_START_TIME
+            self.metrics.emit("time_to_first_image", seconds=self.time_to_first_image)
+            print(f"Time to first image: {self.time_to_first_image:.2f} seconds")
+
+        # Until the last image was encoded, even if it is collected later
+        done_at = max([output["encoded_at"] for output in outputs], default=time.time())
+        total_seconds = done_at - submitted["start_time"]
+        print(f"Request time: {total_seconds:.2f} seconds")
+
+        return {
+            "outputs": outputs,
+            "cached": sum(bool(output.get("cached")) for output in outputs),
+            "output_paths": [output.get("output_path") for output in outputs],
+            "width": submitted["width"],
+            "height": submitted["height"],
+            "quality_tier": submitted["quality_tier"],
+            "generation_seconds": submitted["generation_seconds"],
+            "total_seconds": total_seconds,
+            "stages": stage_seconds(submitted["records"] + records),
+        }
+
+    def _store_result(self, key, output, inline):
+        """Save an encoded output to the result cache, dropping bytes the caller didn't ask for"""
+        try:
+            self.results.save(key, output)
+        except OSError as e:
+            print(f"Warning: could not cache result: {e}")
+        if not inline:
+            output.pop("data", None)
+            for thumbnail in output["thumbnails"]:
+                thumbnail.pop("data", None)
+
+    def generate_batch(self, prompts, output_paths=None, lora_path=None, width=1024, height=1024,
+                       lora_scale=0.8, seeds=None, output=None, quality_tier=None, on_preview=None,
+                       preview_steps=0, cancel=None):
+        """Generate a batch of images sharing one adapter, resolution and quality in a single pipe() call"""
+        return self.finish_batch(self.submit_batch(
+            prompts, output_paths, lora_path, width, height, lora_scale=lora_scale, seeds=seeds, output=output,
+            quality_tier=quality_tier, on_preview=on_preview, preview_steps=preview_steps, cancel=cancel
+        ))
+
+    def generate(self, prompt, lora_path=None, output_path="output.png", width=1024, height=1024,
+                 lora_scale=0.8, seed=None, output=None, quality_tier=None, on_preview=None, preview_steps=0,
+                 cancel=None):
+        """Generate one image on the resident pipeline and encode it (PNG by default)
+
+        An explicit seed makes the result cacheable; without one seed 42 is used.
+        """
+        result = self.generate_batch(
+            [prompt], [output_path], lora_path, width, height, lora_scale=lora_scale, seeds=[seed],
+            output=output, quality_tier=quality_tier, on_preview=on_preview, preview_steps=preview_steps,
+            cancel=cancel
+        )
+        return {
+            "output_path": result["output_paths"][0],
+            "output": result["outputs"][0],
+            "cached": bool(result["cached"]),
+            "width": result["width"],
+            "height": result["height"],
+            "quality_tier": result["quality_tier"],
+            "generation_seconds": result["generation_seconds"],
+            "total_seconds": result["total_seconds"],
+            "stages": result["stages"],
+        }
+
+    def close(self):
+        """Release the pipeline and accelerator memory"""
+        self.encoder.close()
+        with self._lock:
+            self.pipe = None
+            self._refiner = None
+            self.components = None
+            self.lora_cache = None
+        gc.collect()
+        empty_cache()
+
+def generate_image(prompt, lora_path=None, output_path="output.png", width=1024, height=1024,
+                   lora_scale=0.8, output=None, quality_tier=None, seed=None, preview_steps=0,
+                   **generator_options):
+    """Generate image using SDXL with optional LoRA
+
+    With preview_steps, progress previews are printed to stdout as JSON
+    lines ({"event": "preview", ..., "data": base64 JPEG}).
+    """
+    start_time = time.time()
+
+    def print_preview(preview):
+        preview = dict(preview, event="preview", data=base64.b64encode(preview["data"]).decode("ascii"))
+        print(json.dumps(preview), flush=True)
+
+    generator = SDXLGenerator(**generator_options).load()
+    try:
+        generator.generate(prompt, lora_path, output_path, width, height, lora_scale=lora_scale, seed=seed,
+                           output=output, quality_tier=quality_tier, on_preview=print_preview,
+                           preview_steps=preview_steps)
+    finally:
+        # Clean up memory
+        generator.close()
 
     print(f"Total time: {time.time() - start_time:.2f} seconds")
 
     return output_path
 
+def load_manifest(manifest_path):
+    """Read a JSONL manifest of generation jobs"""
+    jobs = []
+    with open(manifest_path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            if not job.get("prompt") or not job.get("output_path"):
+                raise ValueError(f"Manifest line {line_number}: prompt and output_path are required")
+            job.setdefault("id", str(line_number))
+            jobs.append(job)
+    return jobs
+
+def group_jobs(jobs, max_batch_size=4):
+    """Split jobs into batches that share an adapter, LoRA scale, resolution and quality tier"""
+    groups = {}
+    for job in jobs:
+        key = (
+            job.get("lora_path") or "",
+            float(job.get("lora_scale", 0.8)),
+            int(job.get("width", 1024)),
+            int(job.get("height", 1024)),
+            job.get("quality_tier") or DEFAULT_QUALITY_TIER,
+        )
+        groups.setdefault(key, []).append(job)
+
+    # Adapter-major order so each brand's adapter is activated once per run
+    batches = []
+    for key in sorted(groups):
+        group = groups[key]
+        for i in range(0, len(group), max_batch_size):
+            batches.append((key, group[i:i + max_batch_size]))
+    return batches
+
+def generate_batch(generator, jobs, max_batch_size=4, results=sys.stdout, output=None):
+    """Run manifest jobs as batched pipe() calls, streaming one JSON line per batch
+
+    Each batch's images are encoded while the next batch denoises; its line
+    is written once its outputs are on disk.
+    """
+    batches = group_jobs(jobs, max_batch_size)
+    run_start = time.time()
+    counts = {"completed": 0, "failed": 0}
+
+    def write(event, batch, error=None, result=None):
+        jobs_field = [{"id": job["id"], "output_path": job["output_path"]} for job in batch]
+        if error is None:
+            counts["completed"] += len(batch)
+            event.update({
+                "status": "completed",
+                "seconds": result["total_seconds"],
+                "images_per_second": len(batch) / result["total_seconds"],
+                "stages": result["stages"],
+                "jobs": jobs_field,
+            })
+        else:
+            counts["failed"] += len(batch)
+            event.update({"status": "failed", "error": str(error), "jobs": jobs_field})
+        results.write(json.dumps(event) + "\n")
+        results.flush()
+
+    def finish(event, batch, submitted):
+        try:
+            result = generator.finish_batch(submitted)
+        except Exception as e:
+            write(event, batch, error=e)
+        else:
+            write(event, batch, result=result)
+
+    # The previous batch, still encoding while this one denoises
+    pending = None
+
+    for batch_index, ((lora_path, lora_scale, width, height, quality_tier), batch) in enumerate(batches):
+        event = {
+            "event": "batch",
+            "batch_index": batch_index,
+            "num_batches": len(batches),
+            "batch_size": len(batch),
+            "lora_path": lora_path,
+            "width": width,
+            "height": height,
+            "quality_tier": quality_tier,
+        }
+        try:
+            submitted = generator.submit_batch(
+                prompts=[job["prompt"] for job in batch],
+                output_paths=[job["output_path"] for job in batch],
+                lora_path=lora_path or None,
+                width=width,
+                height=height,
+                lora_scale=lora_scale,
+                seeds=[int(job["seed"]) if job.get("seed") is not None else None for job in batch],
+                output=output,
+                quality_tier=quality_tier,
+            )
+        except Exception as e:
+            submitted = None
+            error = e
+
+        if pending is not None:
+            finish(*pending)
+            pending = None
+        if submitted is None:
+            write(event, batch, error=error)
+        else:
+            pending = (event, batch, submitted)
+
+    if pending is not None:
+        finish(*pending)
+
+    total_seconds = time.time() - run_start
+    completed = counts["completed"]
+    summary = {
+        "event": "summary",
+        "jobs": len(jobs),
+        "completed": completed,
+        "failed": counts["failed"],
+        "batches": len(batches),
+        "seconds": total_seconds,
+        "images_per_second": completed / total_seconds if total_seconds else 0.0,
+        "seconds_per_image": total_seconds / completed if completed else None,
+    }
+    results.write(json.dumps(summary) + "\n")
+    results.flush()
+    return summary
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate image with SDXL + LoRA")
-    parser.add_argument("--prompt", required=True, help="Text prompt for generation")
+    parser.add_argument("--prompt", help="Text prompt for generation")
     parser.add_argument("--lora_path", default="", help="Path to LoRA weights (GCS or local)")
+    parser.add_argument("--lora_scale", type=float, default=0.8, help="LoRA strength")
     parser.add_argument("--output", default="output.png", help="Output path for generated image")
     parser.add_argument("--width", type=int, default=1024, help="Image width")
     parser.add_argument("--height", type=int, default=1024, help="Image height")
+    parser.add_argument("--quality_tier", default=DEFAULT_QUALITY_TIER, choices=sorted(QUALITY_TIERS),
+                        help="draft: fewer steps at half size; final: more steps, large sizes via latent upscale")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Random seed; an explicit seed also enables the result cache (default 42, uncached)")
+    parser.add_argument("--preview_steps", type=int, default=0,
+                        help="Print a JSON-line JPEG preview every this many denoising steps")
+    parser.add_argument("--preview_decoder", default=PREVIEW_DECODER,
+                        help="Preview decoder: linear, or a tiny autoencoder (hub id or directory)")
+    parser.add_argument("--model_id", default=MODEL_ID, help="Base model (hub id or local directory)")
+    parser.add_argument("--device", default=DEVICE, help="Torch device to run on (auto: CUDA if available, else CPU)")
+    parser.add_argument("--cpu_precision", default=CPU_PRECISION, choices=CPU_PRECISIONS,
+                        help="On CPU, run denoising in fp32 or under bf16 autocast")
+    parser.add_argument("--num_threads", type=int, default=None,
+                        help="CPU intra-op threads (default: the CPUs available to this process)")
+    parser.add_argument("--compile", action="store_true", default=TORCH_COMPILE,
+                        help="torch.compile the UNet, caching compiled graphs on disk")
+    parser.add_argument("--serve", action="store_true", help="Run as a warm inference server")
+    parser.add_argument("--host", default="127.0.0.1", help="Server bind address")
+    parser.add_argument("--port", type=int, default=8081, help="Server port")
+    parser.add_argument("--socket", default="", help="Serve on a Unix socket instead of TCP")
+    parser.add_argument("--manifest", default="", help="JSONL manifest of jobs for offline batch mode")
+    parser.add_argument("--max_batch_size", type=int, default=4, help="Images per pipe() call in batch mode")
+    parser.add_argument("--results", default="", help="Write batch results as JSON lines here (default stdout)")
+    parser.add_argument("--embedding_cache_size", type=int, default=EMBEDDING_CACHE_SIZE,
+                        help="Prompt embeddings kept in memory (0 disables the cache)")
+    parser.add_argument("--embedding_cache_dir", default=EMBEDDING_CACHE_DIR,
+                        help="Also persist prompt embeddings to this directory")
+    parser.add_argument("--offload_text_encoders", action="store_true",
+                        help="Keep text encoders on CPU, moving them to the device only on a cache miss")
+    parser.add_argument("--output_format", default="png", choices=["png", "webp", "jpeg"],
+                        help="Encoding for generated images")
+    parser.add_argument("--compress_level", type=int, default=6, help="PNG compression level (0-9)")
+    parser.add_argument("--quality", type=int, default=90, help="WebP/JPEG quality (1-100)")
+    parser.add_argument("--thumbnails", default="",
+                        help="Comma-separated square thumbnail sizes written next to each image, e.g. 256")
+    parser.add_argument("--encode_workers", type=int, default=ENCODE_WORKERS,
+                        help="Background threads encoding images while the next job denoises")
+    parser.add_argument("--lora_cache_mb", type=int, default=LORA_CACHE_MB,
+                        help="Memory budget for resident LoRA adapters")
+    parser.add_argument("--lora_disk_cache_mb", type=int, default=LORA_DISK_CACHE_MB,
+                        help="Disk budget for downloaded LoRA weight files")
+    parser.add_argument("--result_cache_mb", type=int, default=RESULT_CACHE_MB,
+                        help="Disk budget for cached results of seeded requests (0 disables)")
+    parser.add_argument("--result_cache_dir", default=RESULT_CACHE_DIR, help="Where cached results are stored")
+    parser.add_argument("--metrics_file", default="",
+                        help="Write stage timings as JSON lines here ('-' for stdout; "
+                             "default $MEDIAFORGE_METRICS_FILE)")
+    parser.add_argument("--profile_steps", type=int, default=0,
+                        help="Record a torch.profiler trace of this many denoising steps of the first request")
+    parser.add_argument("--profile_dir", default=PROFILE_DIR, help="Where profiler traces are written")
 
     args = parser.parse_args()
 
-    generate_image(
-        prompt=args.prompt,
-        lora_path=args.lora_path,
-        output_path=args.output,
-        width=args.width,
-        height=args.height
-    )
\ No newline at end of file
+    generator_options = dict(
+        model_id=args.model_id,
+        device=args.device,
+        cpu_precision=args.cpu_precision,
+        num_threads=args.num_threads,
+        compile=args.compile,
+        preview_decoder=args.preview_decoder,
+        lora_cache_mb=args.lora_cache_mb,
+        lora_disk_cache_mb=args.lora_disk_cache_mb,
+        embedding_cache_size=args.embedding_cache_size,
+        embedding_cache_dir=args.embedding_cache_dir,
+        offload_text_encoders=args.offload_text_encoders,
+        metrics=Instrumentation.from_env("sdxl-lora", sink=args.metrics_file),
+        profile_steps=args.profile_steps,
+        profile_dir=args.profile_dir,
+        encode_workers=args.encode_workers,
+        result_cache_mb=args.result_cache_mb,
+        result_cache_dir=args.result_cache_dir,
+    )
+    output = output_options({
+        "format": args.output_format,
+        "compress_level": args.compress_level,
+        "quality": args.quality,
+        "thumbnails": args.thumbnails,
+    })
+
+    if args.serve:
+        from sdxl_server import serve
+
+        serve(
+            SDXLGenerator(**generator_options),
+            host=args.host,
+            port=args.port,
+            socket_path=args.socket or None
+        )
+    elif args.manifest:
+        generator = SDXLGenerator(**generator_options).load()
+        results = open(args.results, "w") if args.results else sys.stdout
+        try:
+            generate_batch(generator, load_manifest(args.manifest), args.max_batch_size, results, output)
+        finally:
+            if results is not sys.stdout:
+                results.close()
+            generator.close()
+    else:
+        if not args.prompt:
+            parser.error("--prompt is required unless --serve or --manifest is given")
+
+        generate_image(
+            prompt=args.prompt,
+            lora_path=args.lora_path,
+            output_path=args.output,
+            width=args.width,
+            height=args.height,
+            lora_scale=args.lora_scale,
+            output=output,
+            quality_tier=args.quality_tier,
+            seed=args.seed,
+            preview_steps=args.preview_steps,
+            **generator_options
+        )
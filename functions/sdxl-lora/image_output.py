@@ -0,0 +1,144 @@
+"""
+Output encoding for generated images
+
+Generated PIL images are encoded (PNG, WebP or JPEG, plus optional square
+thumbnails) on a small background thread pool, so the pipeline can start
+denoising the next job while the previous one is compressed. Pillow
+releases the GIL inside its encoders, so this overlaps with the GPU work.
+Encoded bytes are written to output_path and/or returned in memory for
+the caller to upload directly.
+"""
+
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+# format -> (Pillow format name, content type)
+FORMATS = {
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+
+DEFAULT_OUTPUT = {
+    "format": "png",
+    # PNG zlib level 0-9; Pillow's default, higher is smaller and slower
+    "compress_level": 6,
+    # WebP / JPEG quality 1-100
+    "quality": 90,
+    # Square cover-cropped thumbnail edge lengths, e.g. [256]
+    "thumbnails": [],
+    # Return the encoded bytes to the caller
+    "inline": False,
+}
+
+
+def output_options(options=None, max_size=None):
+    """DEFAULT_OUTPUT updated with options, validated
+
+    Thumbnails must be at least 1 pixel and, when max_size is given (the
+    image's longer side), no larger than the image.
+    """
+    merged = dict(DEFAULT_OUTPUT)
+    merged.update({key: value for key, value in (options or {}).items() if value is not None})
+    merged["format"] = str(merged["format"]).lower().replace("jpg", "jpeg")
+    if merged["format"] not in FORMATS:
+        raise ValueError(f"Unsupported output format {merged['format']!r}; expected one of {sorted(FORMATS)}")
+    merged["compress_level"] = int(merged["compress_level"])
+    if not 0 <= merged["compress_level"] <= 9:
+        raise ValueError("compress_level must be between 0 and 9")
+    merged["quality"] = int(merged["quality"])
+    if not 1 <= merged["quality"] <= 100:
+        raise ValueError("quality must be between 1 and 100")
+    thumbnails = merged["thumbnails"]
+    if isinstance(thumbnails, str):
+        thumbnails = [size for size in thumbnails.split(",") if size.strip()]
+    merged["thumbnails"] = [int(size) for size in thumbnails]
+    for size in merged["thumbnails"]:
+        if size < 1 or (max_size is not None and size > max_size):
+            raise ValueError(f"thumbnail sizes must be between 1 and {max_size or 'the image size'}, got {size}")
+    merged["inline"] = bool(merged["inline"])
+    return merged
+
+
+def encode_image(image, options):
+    """Encode one PIL image to bytes in options["format"]"""
+    pil_format = FORMATS[options["format"]][0]
+    buffer = io.BytesIO()
+    if pil_format == "PNG":
+        image.save(buffer, pil_format, compress_level=options["compress_level"])
+    elif pil_format == "JPEG":
+        image.convert("RGB").save(buffer, pil_format, quality=options["quality"], optimize=True)
+    else:
+        image.save(buffer, pil_format, quality=options["quality"])
+    return buffer.getvalue()
+
+
+def thumbnail_path(output_path, size):
+    root, ext = os.path.splitext(output_path)
+    return f"{root}_thumb{size}{ext}"
+
+
+def write_output(path, data):
+    """Write encoded bytes to path atomically (temp file, then rename)"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def encode_output(image, output_path=None, options=None):
+    """Encode an image and its thumbnails; write them to output_path and/or return the bytes"""
+    options = output_options(options)
+    start_time = time.perf_counter()
+    content_type = FORMATS[options["format"]][1]
+
+    variants = [(None, image)]
+    for size in options["thumbnails"]:
+        variants.append((size, ImageOps.fit(image, (size, size), Image.LANCZOS)))
+
+    result = {"format": options["format"], "content_type": content_type, "thumbnails": []}
+    for size, variant in variants:
+        data = encode_image(variant, options)
+        entry = {"bytes": len(data)}
+        if output_path:
+            entry["output_path"] = output_path if size is None else thumbnail_path(output_path, size)
+            write_output(entry["output_path"], data)
+        if options["inline"]:
+            entry["data"] = data
+        if size is None:
+            result.update(entry)
+        else:
+            result["thumbnails"].append({"size": size, **entry})
+
+    result["seconds"] = time.perf_counter() - start_time
+    # Wall-clock completion, for callers that collect the result later
+    result["encoded_at"] = time.time()
+    return result
+
+
+class OutputEncoder:
+    """Background thread pool for encode_output()"""
+
+    def __init__(self, max_workers=2):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, image, output_path=None, options=None):
+        """Queue an image for encoding; returns a future of encode_output()'s result"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="encode")
+            return self._executor.submit(encode_output, image, output_path, options)
+
+    def close(self):
+        """Finish queued encodes and stop the workers (they restart on the next submit)"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
@@ -1,10 +1,8 @@
 const express = require('express');
 const admin = require('firebase-admin');
 const { Storage } = require('@google-cloud/storage');
-const sharp = require('sharp');
 const { spawn } = require('child_process');
 const path = require('path');
-const fs = require('fs').promises;
 
 // Initialize Firebase Admin
 if (!admin.apps.length) {
@@ -37,9 +35,86 @@ const PROJECT_ID = 'mediaforge-957e4';
 const BUCKET_NAME = 'mediaforge-957e4.firebasestorage.app';
 const LORA_MODELS_BUCKET = 'mediaforge-lora-models';
 
+// Warm inference server (generate_sdxl.py --serve) keeps SDXL resident
+const INFERENCE_PORT = parseInt(process.env.SDXL_INFERENCE_PORT || '8081', 10);
+const INFERENCE_URL = `http://127.0.0.1:${INFERENCE_PORT}`;
+
+let inferenceProcess = null;
+
+function startInferenceServer() {
+  inferenceProcess = spawn('python3', [
+    path.join(__dirname, 'generate_sdxl.py'),
+    '--serve',
+    '--port', INFERENCE_PORT.toString()
+  ], { stdio: ['ignore', 'inherit', 'inherit'] });
+
+  inferenceProcess.on('exit', (code, signal) => {
+    console.error(`Inference server exited (code ${code}, signal ${signal}), restarting`);
+    setTimeout(startInferenceServer, 1000);
+  });
+}
+
+async function inferenceStatus() {
+  try {
+    const response = await fetch(`${INFERENCE_URL}/ready`);
+    return await response.json();
+  } catch (error) {
+    return { status: 'starting', ready: false };
+  }
+}
+
+// With onPreview, the inference server streams JSON lines: previews while
+// the job denoises, then its result. Aborting signal disconnects, which
+// cancels the job on the inference server.
+async function runGeneration(job, { onPreview, signal } = {}) {
+  const response = await fetch(`${INFERENCE_URL}/generate`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify(onPreview ? { ...job, stream: true } : job),
+    signal
+  });
+  if (!onPreview || !response.ok) {
+    const result = await response.json();
+    if (!response.ok) {
+      throw new Error(`Inference server returned ${response.status}: ${result.details || result.error}`);
+    }
+    return result;
+  }
+
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let result = null;
+  for await (const chunk of response.body) {
+    buffer += decoder.decode(chunk, { stream: true });
+    let newline;
+    while ((newline = buffer.indexOf('\n')) >= 0) {
+      const line = buffer.slice(0, newline);
+      buffer = buffer.slice(newline + 1);
+      if (!line.trim()) continue;
+      const event = JSON.parse(line);
+      if (event.event === 'preview') {
+        onPreview(event);
+      } else if (event.event !== 'started') {
+        result = event;
+      }
+    }
+  }
+  if (!result || result.event !== 'result') {
+    throw new Error(`Inference server stream ended: ${result ? result.details || result.error : 'no result'}`);
+  }
+  return result;
+}
+
 // Health check endpoint
-app.get('/health', (req, res) => {
-  res.status(200).json({ status: 'healthy', service: 'sdxl-lora' });
+app.get('/health', async (req, res) => {
+  const inference = await inferenceStatus();
+  res.status(200).json({ status: 'healthy', service: 'sdxl-lora', inference });
+});
+
+// Readiness: only route traffic once the pipeline is warm
+app.get('/ready', async (req, res) => {
+  const inference = await inferenceStatus();
+  res.status(inference.ready ? 200 : 503).json(inference);
 });
 
 /**
@@ -51,14 +126,38 @@ app.get('/health', (req, res) => {
  *   prompt: string,
  *   brandId: string,
  *   width: number (1024, 1536, 2048),
- *   height: number (1024, 1536, 2048)
+ *   height: number (1024, 1536, 2048),
+ *   qualityTier: 'draft' | 'standard' | 'final' (default 'standard'; draft
+ *     renders quickly at half size, final upscales large sizes in latent space),
+ *   seed: number (optional; repeating a request with the same seed returns
+ *     the cached image instead of regenerating it),
+ *   previewSteps: number (optional; the response becomes JSON lines, with a
+ *     { event: 'preview', step, steps, data } JPEG every previewSteps steps
+ *     and then { event: 'result', ... }; closing the connection cancels)
  * }
  */
 app.post('/generate', async (req, res) => {
   console.log('SDXL + LoRA generation request:', req.body);
 
+  // Streaming responses have already sent their headers; the outcome is the last line
+  const respond = (status, payload) => {
+    if (res.headersSent) {
+      res.end(JSON.stringify({ event: status < 400 ? 'result' : 'error', ...payload }) + '\n');
+    } else {
+      res.status(status).json(payload);
+    }
+  };
+  // The caller hanging up cancels the job on the inference server
+  const abort = new AbortController();
+  res.on('close', () => {
+    if (!res.writableFinished) abort.abort();
+  });
+
   try {
-    const { userId, illustrationId, prompt, brandId, width = 1024, height = 1024 } = req.body;
+    const {
+      userId, illustrationId, prompt, brandId, width = 1024, height = 1024, qualityTier = 'standard',
+      seed, previewSteps
+    } = req.body;
 
     // Validate request
     if (!userId || !illustrationId || !prompt || !brandId) {
@@ -100,59 +199,49 @@ app.post('/generate', async (req, res) => {
     console.log('Enhanced prompt:', enhancedPrompt);
     console.log('LoRA model path:', brand.loraModelPath);
 
-    // Generate image using Python script
+    // Generate image on the warm inference server; it encodes the PNG and
+    // thumbnail in the background and returns them in memory (no temp file)
     const startTime = Date.now();
-    const outputPath = `/tmp/${illustrationId}.png`;
-
-    const pythonProcess = spawn('python3', [
-      path.join(__dirname, 'generate_sdxl.py'),
-      '--prompt', enhancedPrompt,
-      '--lora_path', brand.loraModelPath || '',
-      '--output', outputPath,
-      '--width', width.toString(),
-      '--height', height.toString()
-    ]);
-
-    let pythonOutput = '';
-    let pythonError = '';
-
-    pythonProcess.stdout.on('data', (data) => {
-      pythonOutput += data.toString();
-      console.log('Python output:', data.toString());
-    });
 
-    pythonProcess.stderr.on('data', (data) => {
-      pythonError += data.toString();
-      console.error('Python error:', data.toString());
-    });
-
-    await new Promise((resolve, reject) => {
-      pythonProcess.on('close', (code) => {
-        if (code !== 0) {
-          reject(new Error(`Python process exited with code ${code}: ${pythonError}`));
-        } else {
-          resolve();
-        }
-      });
-    });
+    let onPreview;
+    if (previewSteps) {
+      res.status(200).set({ 'Content-Type': 'application/x-ndjson', 'Cache-Control': 'no-cache' });
+      res.flushHeaders();
+      onPreview = ({ step, steps, content_type: contentType, data }) => {
+        res.write(JSON.stringify({ event: 'preview', step, steps, contentType, data }) + '\n');
+      };
+    }
 
-    // Check if image was generated
-    try {
-      await fs.access(outputPath);
-    } catch (error) {
-      throw new Error('Image generation failed - output file not created');
+    const inference = await runGeneration({
+      prompt: enhancedPrompt,
+      lora_path: brand.loraModelPath || '',
+      width,
+      height,
+      quality_tier: qualityTier,
+      seed,
+      preview_steps: previewSteps,
+      output_format: 'png',
+      compress_level: 9,
+      thumbnails: [256],
+      inline: true
+    }, { onPreview, signal: abort.signal });
+
+    const output = inference.output || {};
+    if (!output.data || !output.thumbnails || !output.thumbnails.length) {
+      throw new Error('Image generation failed - no encoded output returned');
     }
 
-    // Optimize image with Sharp
-    const optimizedBuffer = await sharp(outputPath)
-      .png({ quality: 95, compressionLevel: 9 })
-      .toBuffer();
+    // Stage timings (seconds) from the inference server, plus this service's own
+    const stages = { ...(inference.stages || {}) };
+    let stageStart = Date.now();
+    const endStage = (name) => {
+      stages[name] = (Date.now() - stageStart) / 1000;
+      stageStart = Date.now();
+    };
 
-    // Create thumbnail
-    const thumbnailBuffer = await sharp(optimizedBuffer)
-      .resize(256, 256, { fit: 'cover' })
-      .png({ quality: 90 })
-      .toBuffer();
+    const optimizedBuffer = Buffer.from(output.data, 'base64');
+    const thumbnailBuffer = Buffer.from(output.thumbnails[0].data, 'base64');
+    endStage('postprocess');
 
     // Upload to Cloud Storage
     const timestamp = Date.now();
@@ -183,6 +272,7 @@ app.post('/generate', async (req, res) => {
       contentType: 'image/png'
     });
     await thumbnailFile.makePublic();
+    endStage('upload');
 
     const imageUrl = `https://storage.googleapis.com/${BUCKET_NAME}/${fileName}`;
     const thumbnailUrl = `https://storage.googleapis.com/${BUCKET_NAME}/${thumbnailFileName}`;
@@ -197,8 +287,11 @@ app.post('/generate', async (req, res) => {
       completedAt: admin.firestore.FieldValue.serverTimestamp(),
       generationTime,
       modelUsed: 'sdxl-lora',
-      width,
-      height,
+      // Drafts come back smaller than requested
+      width: inference.width || width,
+      height: inference.height || height,
+      qualityTier: inference.quality_tier || qualityTier,
+      ...(seed !== undefined && { seed }),
       finalPrompt: enhancedPrompt,
       brandId
     };
@@ -207,44 +300,60 @@ app.post('/generate', async (req, res) => {
       .collection('illustrations')
       .doc(illustrationId)
       .update(generationData);
-
-    // Clean up temp file
-    await fs.unlink(outputPath).catch(() => {});
+    endStage('firestore_update');
 
     console.log(`SDXL + LoRA generation completed in ${generationTime}s`);
+    // One structured line per request; Cloud Logging parses it as jsonPayload
+    console.log(JSON.stringify({
+      event: 'generation_stages',
+      service: 'sdxl-lora',
+      illustrationId,
+      brandId,
+      width,
+      height,
+      qualityTier,
+      cached: Boolean(inference.cached),
+      stages
+    }));
 
-    res.json({
+    respond(200, {
       success: true,
       imageURL: imageUrl,
       thumbnailURL: thumbnailUrl,
       generationTime,
+      stages,
       illustrationId
     });
 
   } catch (error) {
     console.error('SDXL generation error:', error);
 
-    // Update Firestore with error
+    // Update Firestore with error (or the cancellation, if the caller hung up)
+    const cancelled = abort.signal.aborted;
     if (req.body.userId && req.body.illustrationId) {
       await firestore
         .collection('illustrations')
         .doc(req.body.illustrationId)
         .update({
-          status: 'failed',
+          status: cancelled ? 'cancelled' : 'failed',
           error: error.message,
           failedAt: admin.firestore.FieldValue.serverTimestamp()
         })
         .catch(console.error);
     }
 
-    res.status(500).json({
-      error: 'Generation failed',
-      details: error.message
-    });
+    if (!cancelled) {
+      respond(500, {
+        error: 'Generation failed',
+        details: error.message
+      });
+    }
   }
 });
 
 const PORT = process.env.PORT || 8080;
+startInferenceServer();
+
 app.listen(PORT, () => {
   console.log(`SDXL + LoRA service listening on port ${PORT}`);
   console.log('Scale-to-zero enabled - container will shut down after inactivity');
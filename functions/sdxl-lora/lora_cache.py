@@ -0,0 +1,227 @@
+"""
+In-memory LoRA adapter cache for the resident SDXL pipeline
+
+Brand adapters are loaded once as named PEFT adapters and switched with
+set_adapters()/disable_lora(), so changing brands never touches the base
+weights. Least recently used adapters are deleted when the memory budget
+is exceeded. int8 adapter exports are dequantized before loading.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from safetensors import safe_open
+
+from lora_export import is_quantized, load_lora_state_dict
+
+# Pipeline components that can carry LoRA layers
+LORA_COMPONENTS = ("unet", "text_encoder", "text_encoder_2")
+
+
+def file_content_hash(path, chunk_size=8 * 1024 * 1024):
+    """SHA-256 of a weights file, or of every file under a weights directory"""
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                digest.update(os.path.relpath(file_path, path).encode("utf-8"))
+                with open(file_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(chunk_size), b""):
+                        digest.update(chunk)
+    else:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def lora_targets_text_encoders(path):
+    """Whether LoRA weights at path (a .safetensors file or directory) patch a text encoder"""
+    if os.path.isdir(path):
+        files = [os.path.join(path, name) for name in os.listdir(path) if name.endswith(".safetensors")]
+    else:
+        files = [path]
+    for file_path in files:
+        # Only the header is read, not the tensors
+        with safe_open(file_path, framework="pt") as f:
+            # diffusers ("text_encoder.", "text_encoder_2.") and kohya ("lora_te1_", "lora_te2_") naming
+            if any(key.startswith(("text_encoder", "lora_te")) for key in f.keys()):
+                return True
+    return False
+
+
+class LoraAdapterCache:
+    """Bounded LRU of LoRA adapters loaded on a resident pipeline"""
+
+    def __init__(self, pipe, max_bytes=1024 * 1024 * 1024, max_adapters=None, before_load=None):
+        self.pipe = pipe
+        self.max_bytes = max_bytes
+        self.max_adapters = max_adapters
+        # Called with the weights path before a new adapter is loaded, e.g. to load text encoders
+        self.before_load = before_load
+        # content hash -> {"name", "bytes", "text_encoder"}, oldest first; identical
+        # weights under several paths (e.g. a re-upload) share one adapter
+        self._adapters = OrderedDict()
+        # path -> content hash of the weights last loaded from it
+        self._paths = {}
+        # path -> ((size, mtime_ns), content hash); avoids rehashing unchanged files
+        self._hash_memo = {}
+        self._active = None
+        self._active_scale = None
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+    @property
+    def total_bytes(self):
+        return sum(entry["bytes"] for entry in self._adapters.values())
+
+    def content_hash(self, path):
+        """Content hash of path, recomputed only when its size or mtime changes"""
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if os.path.isdir(path):
+            # Directory mtimes don't track file rewrites; fold in the files
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    file_stat = os.stat(os.path.join(root, name))
+                    signature += (name, file_stat.st_size, file_stat.st_mtime_ns)
+        memo = self._hash_memo.get(path)
+        if memo and memo[0] == signature:
+            return memo[1]
+        digest = file_content_hash(path)
+        self._hash_memo[path] = (signature, digest)
+        return digest
+
+    def _adapter_footprint(self, adapter_name):
+        """Bytes held by one adapter's LoRA parameters, and the components it patches"""
+        marker = f".{adapter_name}."
+        total = 0
+        components = set()
+        for component_name in LORA_COMPONENTS:
+            component = getattr(self.pipe, component_name, None)
+            if component is None:
+                continue
+            for name, param in component.named_parameters():
+                if marker in f".{name}.":
+                    total += param.numel() * param.element_size()
+                    components.add(component_name)
+        return total, components
+
+    def _evict(self, key):
+        entry = self._adapters.pop(key)
+        for path in [path for path, digest in self._paths.items() if digest == key]:
+            del self._paths[path]
+        if self._active == entry["name"]:
+            self.pipe.disable_lora()
+            self._active = None
+        self.pipe.delete_adapters(entry["name"])
+        self.evictions += 1
+        print(f"Evicted LoRA adapter {entry['name']} ({entry['bytes'] / 1e6:.1f} MB)")
+
+    def _enforce_budget(self, keep):
+        while len(self._adapters) > 1:
+            over_bytes = self.max_bytes is not None and self.total_bytes > self.max_bytes
+            over_count = self.max_adapters is not None and len(self._adapters) > self.max_adapters
+            if not (over_bytes or over_count):
+                break
+            oldest = next(iter(self._adapters))
+            if oldest == keep:
+                # Only the adapter being activated is left to drop; keep it
+                break
+            self._evict(oldest)
+
+    def load(self, path):
+        """Ensure the adapter at path is loaded and return its adapter name"""
+        with self._lock:
+            path = os.path.realpath(path)
+            key = self.content_hash(path)
+
+            # Weights at this path were replaced (e.g. a brand was retrained)
+            stale = self._paths.get(path)
+            if stale is not None and stale != key:
+                del self._paths[path]
+                if stale in self._adapters and stale not in self._paths.values():
+                    self._evict(stale)
+
+            if key in self._adapters:
+                self.hits += 1
+                self._adapters.move_to_end(key)
+                self._paths[path] = key
+                return self._adapters[key]["name"]
+
+            self.misses += 1
+
+            adapter_name = f"lora_{key[:16]}"
+            if self.before_load is not None:
+                self.before_load(path)
+            start_time = time.time()
+            weights = load_lora_state_dict(path) if is_quantized(path) else path
+            self.pipe.load_lora_weights(weights, adapter_name=adapter_name)
+            elapsed = time.time() - start_time
+            self.load_seconds += elapsed
+
+            adapter_bytes, components = self._adapter_footprint(adapter_name)
+            entry = {
+                "name": adapter_name,
+                "bytes": adapter_bytes,
+                "text_encoder": bool(components & {"text_encoder", "text_encoder_2"}),
+            }
+            self._adapters[key] = entry
+            self._paths[path] = key
+            print(f"Loaded LoRA adapter {adapter_name} from {path} "
+                  f"({entry['bytes'] / 1e6:.1f} MB) in {elapsed:.2f} seconds")
+
+            self._enforce_budget(keep=key)
+            return adapter_name
+
+    def activate(self, path, lora_scale=0.8):
+        """Make the adapter at path the only active one, at lora_scale"""
+        with self._lock:
+            adapter_name = self.load(path)
+            self.pipe.enable_lora()
+            self.pipe.set_adapters([adapter_name], adapter_weights=[lora_scale])
+            self._active = adapter_name
+            self._active_scale = lora_scale
+            return adapter_name
+
+    def deactivate(self):
+        """Run the base model without any adapter (adapters stay cached)"""
+        with self._lock:
+            if self._active is not None:
+                self.pipe.disable_lora()
+                self._active = None
+
+    def text_encoder_state(self):
+        """Identifies what the text encoders compute; changes only with text-encoder LoRA"""
+        with self._lock:
+            for entry in self._adapters.values():
+                if entry["name"] == self._active and entry["text_encoder"]:
+                    return f"{self._active}@{self._active_scale}"
+            return "base"
+
+    def clear(self):
+        """Delete every cached adapter from the pipeline"""
+        with self._lock:
+            for key in list(self._adapters):
+                self._evict(key)
+
+    def stats(self):
+        """Hit/miss/eviction counters and current memory use"""
+        return {
+            "adapters": len(self._adapters),
+            "active": self._active,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "load_seconds": self.load_seconds,
+        }
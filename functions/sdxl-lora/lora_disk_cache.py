@@ -0,0 +1,197 @@
+"""
+On-disk cache of LoRA weight files downloaded from Cloud Storage
+
+Entries are keyed by object path and generation, so a brand retrained to
+the same path is fetched again instead of served stale. Each entry lives in
+its own directory and is complete only once its meta.json is written (the
+weights are downloaded to a temporary name and renamed first), so a failed
+download is never served. Concurrent requests for the same object share
+one download. Least recently used entries are deleted when the byte budget
+is exceeded; on Cloud Run /tmp is memory, so the budget bounds RAM use.
+Entries in use through pinned() are never deleted until released.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from gcs_transfer import default_transfer, parse_gcs_uri
+
+META_FILE = "meta.json"
+
+
+class LoraDiskCache:
+    """Byte-bounded LRU of LoRA weight files keyed by gs:// path and generation"""
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024, transfer=None, metadata_ttl=30.0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.transfer = transfer
+        # Seconds a generation lookup is trusted before asking Cloud Storage again
+        self.metadata_ttl = metadata_ttl
+        # key -> {"uri", "generation", "path", "bytes"}, oldest first
+        self._entries = OrderedDict()
+        # uri -> (checked_at, generation)
+        self._generations = {}
+        self._key_locks = {}
+        # key -> number of pinned() users; pinned entries are never evicted
+        self._pins = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.download_seconds = 0.0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    @property
+    def total_bytes(self):
+        return sum(entry["bytes"] for entry in self._entries.values())
+
+    def _scan(self):
+        """Adopt complete entries left by an earlier process, least recently used first"""
+        found = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            meta_path = os.path.join(entry_dir, META_FILE)
+            try:
+                with open(meta_path) as f:
+                    entry = json.load(f)
+                found.append((os.path.getmtime(meta_path), name, entry))
+            except (OSError, ValueError):
+                # Interrupted download
+                shutil.rmtree(entry_dir, ignore_errors=True)
+        for _, name, entry in sorted(found, key=lambda item: item[0]):
+            self._entries[name] = entry
+        self._enforce_budget(keep=None)
+
+    def _entry_key(self, uri, generation):
+        return hashlib.sha256(f"{uri}#{generation}".encode("utf-8")).hexdigest()[:32]
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _generation(self, bucket_name, blob_path, uri):
+        """Current object generation, and its metadata when it had to be fetched"""
+        checked = self._generations.get(uri)
+        if checked and time.time() - checked[0] < self.metadata_ttl:
+            return checked[1], None
+        blob = self._transfer().get_blob(bucket_name, blob_path)
+        generation = str(blob.generation or blob.etag or blob.md5_hash)
+        self._generations[uri] = (time.time(), generation)
+        return generation, blob
+
+    def _transfer(self):
+        return self.transfer or default_transfer()
+
+    def _evict(self, key):
+        entry = self._entries.pop(key)
+        shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+        self.evictions += 1
+        print(f"Evicted cached LoRA weights {entry['uri']} ({entry['bytes'] / 1e6:.1f} MB)")
+
+    def _enforce_budget(self, keep):
+        with self._lock:
+            while self._entries and self.max_bytes is not None and self.total_bytes > self.max_bytes:
+                # Oldest first, never the entry being returned or one in use
+                oldest = next((key for key in self._entries if key != keep and key not in self._pins), None)
+                if oldest is None:
+                    break
+                self._evict(oldest)
+
+    def _touch(self, key):
+        with self._lock:
+            self._entries.move_to_end(key)
+        # Recency survives a restart through the marker's mtime
+        try:
+            os.utime(os.path.join(self.cache_dir, key, META_FILE))
+        except OSError:
+            pass
+
+    def get(self, uri):
+        """Local path of the LoRA weights at gs:// uri, downloading them on a miss
+
+        The file may be evicted by a later call; hold it with pinned() while
+        it is in use.
+        """
+        return self._get(uri)[1]
+
+    @contextmanager
+    def pinned(self, uri):
+        """Like get(), but the file is kept on disk until the with block exits"""
+        key, path = self._get(uri, pin=True)
+        try:
+            yield path
+        finally:
+            with self._lock:
+                self._pins[key] -= 1
+                if not self._pins[key]:
+                    del self._pins[key]
+            # Pinned entries may have held the cache over budget
+            self._enforce_budget(keep=None)
+
+    def _get(self, uri, pin=False):
+        """(entry key, local path) of the weights at uri, pinned against eviction if pin"""
+        bucket_name, blob_path = parse_gcs_uri(uri)
+        generation, blob = self._generation(bucket_name, blob_path, uri)
+        key = self._entry_key(uri, generation)
+
+        with self._key_lock(key):
+            with self._lock:
+                # Checked and pinned in one step, so no other request evicts it in between
+                entry = self._entries.get(key)
+                hit = entry is not None and os.path.exists(entry["path"])
+                if hit and pin:
+                    self._pins[key] = self._pins.get(key, 0) + 1
+            if hit:
+                self.hits += 1
+                self._touch(key)
+                return key, entry["path"]
+
+            self.misses += 1
+            if blob is None:
+                blob = self._transfer().get_blob(bucket_name, blob_path)
+            entry_dir = os.path.join(self.cache_dir, key)
+            local_path = os.path.join(entry_dir, os.path.basename(blob_path))
+            print(f"Downloading LoRA weights from {uri}")
+            record = self._transfer().download_blob(blob, local_path)
+            self.download_seconds += record["seconds"]
+
+            entry = {"uri": uri, "generation": generation, "path": local_path,
+                     "bytes": os.path.getsize(local_path)}
+            # Written last: its presence marks a complete entry
+            tmp_meta = os.path.join(entry_dir, f"{META_FILE}.tmp")
+            with open(tmp_meta, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp_meta, os.path.join(entry_dir, META_FILE))
+            print(f"LoRA weights downloaded to {local_path} "
+                  f"({record['bytes'] / 1e6:.1f} MB in {record['seconds']:.2f} seconds)")
+
+            with self._lock:
+                # Older generations of the same object won't be asked for again; ones
+                # still in use go once the budget needs their space
+                for stale in [k for k, e in self._entries.items() if e["uri"] == uri and k not in self._pins]:
+                    self._evict(stale)
+                self._entries[key] = entry
+                if pin:
+                    self._pins[key] = self._pins.get(key, 0) + 1
+            self._enforce_budget(keep=key)
+            return key, local_path
+
+    def stats(self):
+        """Hit/miss/eviction counters and current disk use"""
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "download_seconds": self.download_seconds,
+        }
@@ -0,0 +1,196 @@
+"""
+Cold-start model loading for the SDXL generation service
+
+The base model lives in exactly one place on disk: the Hugging Face cache
+under CACHE_DIR, holding only the fp16 safetensors and configs (or a local
+model directory). Components are memory-mapped straight onto the target
+device. Only the UNet, scheduler and tokenizers are loaded up front: the
+text encoders are loaded on the first embedding-cache miss, and the VAE is
+preloaded on a background thread and waited for at the first decode.
+"""
+
+import json
+import os
+import threading
+
+import torch
+from diffusers import AutoencoderKL, DPMSolverMultistepScheduler, StableDiffusionXLPipeline, UNet2DConditionModel
+from diffusers.image_processor import VaeImageProcessor
+from huggingface_hub import snapshot_download
+from transformers import CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
+
+COMPONENT_CLASSES = {
+    "unet": UNet2DConditionModel,
+    "vae": AutoencoderKL,
+    "text_encoder": CLIPTextModel,
+    "text_encoder_2": CLIPTextModelWithProjection,
+}
+TEXT_ENCODERS = ("text_encoder", "text_encoder_2")
+
+# Everything the pipeline needs from the hub repo, fp16 weights only
+SNAPSHOT_PATTERNS = [
+    "model_index.json",
+    "scheduler/*",
+    "tokenizer/*",
+    "tokenizer_2/*",
+    "*/config.json",
+    "*/*.fp16.safetensors",
+]
+
+
+def resolve_snapshot(model_id, cache_dir):
+    """Local directory with model_id's files; downloads the fp16 snapshot on first use only"""
+    if os.path.isdir(model_id):
+        return model_id
+    try:
+        return snapshot_download(model_id, cache_dir=cache_dir, allow_patterns=SNAPSHOT_PATTERNS,
+                                 local_files_only=True)
+    except Exception:
+        print("Downloading SDXL model (first run only)...")
+        return snapshot_download(model_id, cache_dir=cache_dir, allow_patterns=SNAPSHOT_PATTERNS)
+
+
+def weights_variant(model_dir, component):
+    """"fp16" if the component ships fp16 safetensors, else None (full-precision files)"""
+    folder = os.path.join(model_dir, component)
+    if any(name.endswith(".fp16.safetensors") for name in os.listdir(folder)):
+        return "fp16"
+    return None
+
+
+def load_component(model_dir, name, device, torch_dtype):
+    """Memory-map one component's safetensors directly onto device"""
+    return COMPONENT_CLASSES[name].from_pretrained(
+        model_dir,
+        subfolder=name,
+        torch_dtype=torch_dtype,
+        variant=weights_variant(model_dir, name),
+        use_safetensors=True,
+        low_cpu_mem_usage=True,
+        device_map=str(device),
+    )
+
+
+def decode_latents(pipe, latents):
+    """VAE decode + postprocess to PIL, as StableDiffusionXLPipeline does for output_type="pil" """
+    vae = pipe.vae
+    # The SDXL VAE overflows in fp16
+    needs_upcasting = vae.dtype == torch.float16 and vae.config.force_upcast
+    if needs_upcasting:
+        vae.to(dtype=torch.float32)
+        latents = latents.to(torch.float32)
+
+    latents_mean = getattr(vae.config, "latents_mean", None)
+    latents_std = getattr(vae.config, "latents_std", None)
+    if latents_mean is not None and latents_std is not None:
+        latents_mean = torch.tensor(latents_mean).view(1, 4, 1, 1).to(latents.device, latents.dtype)
+        latents_std = torch.tensor(latents_std).view(1, 4, 1, 1).to(latents.device, latents.dtype)
+        latents = latents * latents_std / vae.config.scaling_factor + latents_mean
+    else:
+        latents = latents / vae.config.scaling_factor
+
+    latents = latents.to(vae.device)
+    with torch.no_grad():
+        image = vae.decode(latents, return_dict=False)[0]
+
+    if needs_upcasting:
+        vae.to(dtype=torch.float16)
+
+    if pipe.watermark is not None:
+        image = pipe.watermark.apply_watermark(image)
+    return pipe.image_processor.postprocess(image, output_type="pil")
+
+
+class LazyComponents:
+    """Loads pipeline components on first use and registers them on the pipeline"""
+
+    def __init__(self, pipe, model_dir, device, torch_dtype, metrics, on_load=None):
+        self.pipe = pipe
+        self.model_dir = model_dir
+        self.device = device
+        self.torch_dtype = torch_dtype
+        self.metrics = metrics
+        # Called with (name, module) after loading, e.g. to enable memory optimizations
+        self.on_load = on_load
+        # Loads are serialized: meta-device initialization patches torch.nn.Module globally
+        self._lock = threading.RLock()
+        self._preloads = {}
+        self._errors = {}
+
+    def loaded(self, name):
+        return getattr(self.pipe, name, None) is not None
+
+    def _load(self, name, device):
+        with self.metrics.span("component_load", component=name, device=str(device)):
+            module = load_component(self.model_dir, name, device, self.torch_dtype)
+        if self.on_load is not None:
+            self.on_load(name, module)
+        self.pipe.register_modules(**{name: module})
+        print(f"Loaded {name}")
+        return module
+
+    def preload(self, name):
+        """Start loading a component on a background thread"""
+        with self._lock:
+            if self.loaded(name) or name in self._preloads:
+                return
+
+            def _run():
+                try:
+                    with self._lock:
+                        if not self.loaded(name):
+                            self._load(name, self.device)
+                except Exception as e:
+                    self._errors[name] = e
+
+            thread = threading.Thread(target=_run, name=f"load-{name}", daemon=True)
+            self._preloads[name] = thread
+            thread.start()
+
+    def ensure(self, name, device=None):
+        """Return the component, waiting for its preload or loading it now"""
+        thread = self._preloads.get(name)
+        if thread is not None:
+            thread.join()
+            if name in self._errors:
+                raise self._errors.pop(name)
+        with self._lock:
+            self._preloads.pop(name, None)
+            if not self.loaded(name):
+                self._load(name, device or self.device)
+        return getattr(self.pipe, name)
+
+    def ensure_text_encoders(self, device=None):
+        for name in TEXT_ENCODERS:
+            self.ensure(name, device)
+
+
+def build_pipeline(model_dir, device, torch_dtype, metrics):
+    """SDXL pipeline with only the UNet, scheduler and tokenizers loaded"""
+    with open(os.path.join(model_dir, "model_index.json")) as f:
+        model_index = json.load(f)
+
+    with metrics.span("component_load", component="unet", device=str(device)):
+        unet = load_component(model_dir, "unet", device, torch_dtype)
+
+    with metrics.span("scheduler_setup"):
+        scheduler = DPMSolverMultistepScheduler.from_pretrained(
+            model_dir, subfolder="scheduler", use_karras_sigmas=True
+        )
+
+    pipe = StableDiffusionXLPipeline(
+        vae=None,
+        text_encoder=None,
+        text_encoder_2=None,
+        tokenizer=CLIPTokenizer.from_pretrained(model_dir, subfolder="tokenizer"),
+        tokenizer_2=CLIPTokenizer.from_pretrained(model_dir, subfolder="tokenizer_2"),
+        unet=unet,
+        scheduler=scheduler,
+        force_zeros_for_empty_prompt=model_index.get("force_zeros_for_empty_prompt", True),
+    )
+
+    # Latent geometry comes from the VAE config, which is cheap to read before the weights
+    vae_config = AutoencoderKL.load_config(model_dir, subfolder="vae")
+    pipe.vae_scale_factor = 2 ** (len(vae_config["block_out_channels"]) - 1)
+    pipe.image_processor = VaeImageProcessor(vae_scale_factor=pipe.vae_scale_factor)
+    return pipe
@@ -0,0 +1,152 @@
+"""
+Deterministic result cache for SDXL generation
+
+A request that pins its seed produces the same image every time, so its
+encoded output is stored under a hash of every input that affects it:
+prompt, adapter content, LoRA scale, render plan (size, steps, guidance,
+quality tier), scheduler config, base model snapshot, seed and output
+encoding. Repeats are served from the store without touching the GPU.
+Requests without an explicit seed are never cached.
+
+Stores implement get(key) -> (meta, files) or None and put(key, meta,
+files), with files a {name: bytes} mapping; LocalResultStore keeps them
+on local disk under a byte budget.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from image_output import thumbnail_path, write_output
+
+META_FILE = "meta.json"
+
+
+def result_key(**inputs):
+    """SHA-256 of the inputs as canonical JSON"""
+    text = json.dumps(inputs, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class LocalResultStore:
+    """Results on local disk, least recently used deleted beyond max_bytes"""
+
+    def __init__(self, root, max_bytes=512 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, META_FILE)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            files = {}
+            for name in meta["files"]:
+                with open(os.path.join(entry_dir, name), "rb") as f:
+                    files[name] = f.read()
+        except (OSError, ValueError, KeyError):
+            return None
+        # Recency for eviction
+        os.utime(meta_path)
+        return meta, files
+
+    def put(self, key, meta, files):
+        tmp_dir = f"{self._entry_dir(key)}.tmp{threading.get_ident()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, data in files.items():
+            with open(os.path.join(tmp_dir, name), "wb") as f:
+                f.write(data)
+        with open(os.path.join(tmp_dir, META_FILE), "w") as f:
+            json.dump(dict(meta, files=sorted(files)), f)
+        with self._lock:
+            # Another request may have stored the same result meanwhile
+            if os.path.exists(self._entry_dir(key)):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            else:
+                os.replace(tmp_dir, self._entry_dir(key))
+            self._enforce_budget(keep=key)
+
+    def _enforce_budget(self, keep):
+        if self.max_bytes is None:
+            return
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            entry_dir = os.path.join(self.root, name)
+            meta_path = os.path.join(entry_dir, META_FILE)
+            if not os.path.exists(meta_path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+            entries.append((os.path.getmtime(meta_path), name, size))
+            total += size
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            total -= size
+
+
+class ResultCache:
+    """Encoded generation outputs by result_key(), in a pluggable store"""
+
+    def __init__(self, store):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def lookup(self, key, output_path=None, options=None):
+        """A cached encode_output()-style result, written to output_path, or None"""
+        start_time = time.perf_counter()
+        entry = self.store.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        meta, files = entry
+
+        result = {"format": meta["format"], "content_type": meta["content_type"], "thumbnails": [],
+                  "cached": True}
+        variants = [(None, files["image"])]
+        variants += [(size, files[f"thumb{size}"]) for size in meta["thumbnails"]]
+        for size, data in variants:
+            variant = {"bytes": len(data)}
+            if output_path:
+                variant["output_path"] = output_path if size is None else thumbnail_path(output_path, size)
+                write_output(variant["output_path"], data)
+            if options and options.get("inline"):
+                variant["data"] = data
+            if size is None:
+                result.update(variant)
+            else:
+                result["thumbnails"].append({"size": size, **variant})
+        result["seconds"] = time.perf_counter() - start_time
+        result["encoded_at"] = time.time()
+        return result
+
+    def save(self, key, result):
+        """Store an encode_output() result produced with inline bytes"""
+        files = {"image": result["data"]}
+        for thumbnail in result["thumbnails"]:
+            files[f"thumb{thumbnail['size']}"] = thumbnail["data"]
+        meta = {
+            "format": result["format"],
+            "content_type": result["content_type"],
+            "thumbnails": [thumbnail["size"] for thumbnail in result["thumbnails"]],
+        }
+        self.store.put(key, meta, files)
+        self.stores += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "stores": self.stores}
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Warm inference server for MediaForge SDXL + LoRA generation
+
+Loads the pipeline once in the background and serves generate requests
+back-to-back over local HTTP (TCP or Unix socket).
+
+  GET  /health    liveness, answers immediately while the model loads
+  GET  /ready     200 once the pipeline is warm, 503 before
+  POST /generate  JSON body: prompt, lora_path, lora_scale, output_path,
+                  width, height, and optionally seed, quality_tier
+                  (draft, standard, final), output_format (png, webp, jpeg),
+                  compress_level, quality, thumbnails (sizes) and inline.
+                  With inline, the encoded image and thumbnails are
+                  returned base64-encoded in the response ("data") and
+                  output_path may be omitted. Requests with a seed are
+                  served from the result cache when repeated ("cached").
+                  With stream, the response is JSON lines: "started" (with
+                  the job_id), a "preview" JPEG every preview_steps steps,
+                  then "result", "cancelled" or "error". Disconnecting
+                  cancels the job. Invalid fields are answered with 400
+                  and a job_id that is already running with 409.
+  POST /cancel    JSON body: job_id. Stops that job at its next step.
+"""
+
+import base64
+import json
+import math
+import os
+import socketserver
+import threading
+import traceback
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from image_output import output_options
+from previews import GenerationCancelled
+from quality_tiers import tier_settings
+
+# Requested image sides, in pixels; SDXL's VAE needs multiples of 8
+MIN_SIZE = 64
+MAX_SIZE = 4096
+# What torch.Generator.manual_seed() accepts
+SEED_RANGE = (-2 ** 63, 2 ** 64 - 1)
+
+
+def _json_output(output):
+    """encode_output() result with in-memory bytes base64-encoded for JSON"""
+    output = dict(output)
+    if "data" in output:
+        output["data"] = base64.b64encode(output["data"]).decode("ascii")
+    if "thumbnails" in output:
+        output["thumbnails"] = [_json_output(thumbnail) for thumbnail in output["thumbnails"]]
+    return output
+
+
+def _int_field(job, name, default, minimum=None, maximum=None, multiple=1):
+    """job[name] as an int within bounds (default when absent); ValueError otherwise"""
+    value = job.get(name)
+    if value is None:
+        return default
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError(f"{name} must be an integer")
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an integer") from None
+    if maximum is not None and not minimum <= number <= maximum:
+        raise ValueError(f"{name} must be between {minimum} and {maximum}")
+    if minimum is not None and number < minimum:
+        raise ValueError(f"{name} must be at least {minimum}")
+    if number % multiple:
+        raise ValueError(f"{name} must be a multiple of {multiple}")
+    return number
+
+
+def _float_field(job, name, default):
+    """job[name] as a finite float (default when absent); ValueError otherwise"""
+    value = job.get(name)
+    if value is None:
+        return default
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a number") from None
+    if isinstance(value, bool) or not math.isfinite(number):
+        raise ValueError(f"{name} must be a finite number")
+    return number
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server bound to a Unix domain socket"""
+
+    daemon_threads = True
+
+
+class SDXLRequestHandler(BaseHTTPRequestHandler):
+    """Routes HTTP requests to the server's SDXLGenerator"""
+
+    def address_string(self):
+        # Unix socket peers have no (host, port) tuple
+        if isinstance(self.client_address, str) or not self.client_address:
+            return "unix"
+        return super().address_string()
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        generator = self.server.generator
+        if self.path == "/health":
+            self._send_json(200, {"status": "healthy", "service": "sdxl-lora", **generator.status()})
+        elif self.path == "/ready":
+            self._send_json(200 if generator.ready else 503, generator.status())
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def _read_json(self):
+        """Request body as a dict, or None after answering 400"""
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": "Invalid JSON body"})
+            return None
+        if not isinstance(body, dict):
+            self._send_json(400, {"error": "Invalid JSON body", "details": "expected a JSON object"})
+            return None
+        return body
+
+    def _cancel(self):
+        job = self._read_json()
+        if job is None:
+            return
+        cancel = self.server.jobs.get(str(job.get("job_id")))
+        if cancel is None:
+            self._send_json(404, {"error": "No running job with that job_id"})
+            return
+        cancel.set()
+        self._send_json(200, {"success": True, "job_id": job["job_id"]})
+
+    def do_POST(self):
+        generator = self.server.generator
+        if self.path == "/cancel":
+            self._cancel()
+            return
+        if self.path != "/generate":
+            self._send_json(404, {"error": "Not found"})
+            return
+
+        if not generator.ready:
+            self._send_json(503, {"error": "Model not ready", **generator.status()})
+            return
+
+        job = self._read_json()
+        if job is None:
+            return
+
+        if not job.get("prompt") or not (job.get("output_path") or job.get("inline")):
+            self._send_json(400, {"error": "Missing required fields: prompt, output_path (or inline)"})
+            return
+        if not isinstance(job["prompt"], str) or not job["prompt"].strip():
+            self._send_json(400, {"error": "Invalid request", "details": "prompt must be a non-empty string"})
+            return
+
+        try:
+            width = _int_field(job, "width", 1024, MIN_SIZE, MAX_SIZE, multiple=8)
+            height = _int_field(job, "height", 1024, MIN_SIZE, MAX_SIZE, multiple=8)
+            lora_scale = _float_field(job, "lora_scale", 0.8)
+            seed = _int_field(job, "seed", None, *SEED_RANGE)
+            preview_steps = _int_field(job, "preview_steps", 0, minimum=0)
+        except ValueError as e:
+            self._send_json(400, {"error": "Invalid request", "details": str(e)})
+            return
+
+        try:
+            quality_tier, _ = tier_settings(job.get("quality_tier"))
+        except ValueError as e:
+            self._send_json(400, {"error": "Invalid quality tier", "details": str(e)})
+            return
+
+        try:
+            # Thumbnails are cut from the finished image, so they can't be larger
+            output = output_options({
+                "format": job.get("output_format"),
+                "compress_level": job.get("compress_level"),
+                "quality": job.get("quality"),
+                "thumbnails": job.get("thumbnails"),
+                "inline": job.get("inline"),
+            }, max_size=max(width, height))
+        except (TypeError, ValueError) as e:
+            self._send_json(400, {"error": "Invalid output options", "details": str(e)})
+            return
+
+        stream = bool(job.get("stream"))
+        job_id = str(job.get("job_id") or uuid.uuid4().hex)
+        cancel = threading.Event()
+        # setdefault is atomic: of two requests with one job_id, only the first registers
+        if self.server.jobs.setdefault(job_id, cancel) is not cancel:
+            self._send_json(409, {"error": "A job with this job_id is already running", "job_id": job_id})
+            return
+
+        on_preview = None
+        if stream:
+            self._start_stream()
+
+            def on_preview(preview):
+                self._send_event({"event": "preview", "job_id": job_id, **_json_output(preview)}, cancel)
+
+            self._send_event({"event": "started", "job_id": job_id}, cancel)
+
+        try:
+            result = generator.generate(
+                prompt=job["prompt"],
+                lora_path=job.get("lora_path") or None,
+                output_path=job.get("output_path") or None,
+                width=width,
+                height=height,
+                lora_scale=lora_scale,
+                seed=seed,
+                output=output,
+                quality_tier=quality_tier,
+                on_preview=on_preview,
+                preview_steps=preview_steps if stream else 0,
+                cancel=cancel,
+            )
+        except GenerationCancelled as e:
+            self._finish(stream, 409, {"event": "cancelled", "error": "Generation cancelled", "details": str(e),
+                                       "job_id": job_id}, cancel)
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self._finish(stream, 500, {"event": "error", "error": "Generation failed", "details": str(e),
+                                       "job_id": job_id}, cancel)
+            return
+        finally:
+            self.server.jobs.pop(job_id, None)
+
+        self._finish(stream, 200, {"event": "result", "success": True, "job_id": job_id, **result,
+                                   "output": _json_output(result["output"])}, cancel)
+
+    def _start_stream(self):
+        """Headers for a JSON-lines response; the body ends when the connection closes"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+    def _send_event(self, payload, cancel):
+        try:
+            self.wfile.write(json.dumps(payload).encode("utf-8") + b"\n")
+            self.wfile.flush()
+        except OSError:
+            # The client went away; nobody is waiting for the image
+            cancel.set()
+
+    def _finish(self, stream, status, payload, cancel):
+        if stream:
+            self._send_event(payload, cancel)
+        else:
+            payload.pop("event")
+            self._send_json(status, payload)
+
+    def log_message(self, format, *args):
+        print(f"[sdxl-server] {self.address_string()} - {format % args}", flush=True)
+
+
+def create_server(generator, host="127.0.0.1", port=8081, socket_path=None):
+    """Build (but do not start) an HTTP server bound to TCP or a Unix socket"""
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = UnixHTTPServer(socket_path, SDXLRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), SDXLRequestHandler)
+        server.daemon_threads = True
+    server.generator = generator
+    # job_id -> cancel event of each running /generate request
+    server.jobs = {}
+    return server
+
+
+def warm_up(generator):
+    """Load the pipeline on a background thread so /health answers immediately"""
+
+    def _load():
+        try:
+            generator.load()
+            print("SDXL server ready", flush=True)
+        except Exception:
+            traceback.print_exc()
+
+    thread = threading.Thread(target=_load, name="sdxl-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def serve(generator, host="127.0.0.1", port=8081, socket_path=None):
+    """Run the warm inference server until interrupted"""
+    server = create_server(generator, host, port, socket_path)
+    warm_up(generator)
+
+    where = socket_path or f"http://{host}:{port}"
+    print(f"SDXL server listening on {where}", flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.unlink(socket_path)
+        generator.close()
@@ -0,0 +1,35 @@
+"""
+Shared fixtures for the Python service tests
+
+The tests run the real generation service and trainer code on CPU against
+the tiny, randomly initialised SDXL pipeline from benchmarks/tiny_sdxl.py,
+with Cloud Storage replaced by benchmarks/local_storage.py. Like the
+benchmarks, they need the packages from training/lora-trainer/requirements.txt
+plus google-cloud-storage, and no GPU, network access or model download.
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(TESTS_DIR)
+BENCHMARK_DIR = os.path.join(REPO_ROOT, "benchmarks")
+SDXL_LORA_DIR = os.path.join(REPO_ROOT, "functions", "sdxl-lora")
+TRAINING_DIR = os.path.join(REPO_ROOT, "training")
+LORA_TRAINER_DIR = os.path.join(TRAINING_DIR, "lora-trainer")
+
+# Shared modules (gcs_transfer, instrumentation, lora_export, brand_status) live in
+# training/; lora-trainer/ comes first so train_lora is the LoRA trainer's
+sys.path[:0] = [BENCHMARK_DIR, SDXL_LORA_DIR, LORA_TRAINER_DIR, TRAINING_DIR]
+
+
+@pytest.fixture(scope="session")
+def tiny_model(tmp_path_factory):
+    """Directory of the tiny SDXL pipeline, built once per test session"""
+    from tiny_sdxl import build_tiny_sdxl
+
+    return build_tiny_sdxl(str(tmp_path_factory.mktemp("tiny-sdxl")))
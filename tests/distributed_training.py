@@ -0,0 +1,36 @@
+"""
+Worker for test_distributed_training.py, started once per rank by torchrun
+
+    ACCELERATE_USE_CPU=1 python -m torch.distributed.run --standalone --nproc_per_node 2 \
+        tests/distributed_training.py <storage root> <result dir> <train_lora.py arguments...>
+
+Trains one brand the way train_lora() does, with Cloud Storage under
+<storage root>, and saves each rank's training metadata and LoRA weights to
+<result dir>/rank<N>.pt.
+"""
+
+import os
+import sys
+
+import torch
+from accelerate import Accelerator
+
+import conftest  # noqa: F401  (import paths of the services and benchmarks)
+import train_lora
+from checkpointing import lora_state_dict
+from gcs_transfer import GCSTransfer
+from local_storage import LocalStorageClient
+
+
+def main(storage_root, result_dir, *argv):
+    args = train_lora.parse_args(argv)
+    train_lora.OUTPUT_DIR = os.path.join(result_dir, "output")
+    accelerator = Accelerator(mixed_precision=args.mixed_precision)
+    base = train_lora.SharedBaseModel(args, accelerator)
+    metadata = train_lora.run_brand(args, base, GCSTransfer(client=LocalStorageClient(storage_root)))
+    torch.save({"metadata": metadata, "weights": lora_state_dict(base.model)},
+               os.path.join(result_dir, f"rank{accelerator.process_index}.pt"))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,140 @@
+"""Brand status and throttled progress updates (training/brand_status.py) against InMemoryStatusStore"""
+
+import time
+
+import pytest
+from local_storage import LocalStorageClient
+from run_benchmarks import make_training_images
+
+import brand_status
+import train_lora
+from brand_status import InMemoryStatusStore, ProgressReporter
+from gcs_transfer import GCSTransfer
+
+
+class FailingStore:
+    def update(self, user_id, brand_id, data):
+        raise ConnectionError("firestore unavailable")
+
+
+def progress_writes(store):
+    return [data["trainingProgress"] for _, _, data in store.updates if "trainingProgress" in data]
+
+
+def statuses(store):
+    return [data["status"] for _, _, data in store.updates if "status" in data]
+
+
+def test_reports_between_writes_are_coalesced():
+    store = InMemoryStatusStore()
+    reporter = ProgressReporter("brand", "user", interval=3600, store=store)
+    for step in range(1, 101):
+        reporter.report(step, 100, loss=1.0 / step)
+    assert reporter.writes == 0
+    reporter.close()
+
+    # Only the newest values are written, once, when the reporter closes
+    assert reporter.writes == 1
+    [progress] = progress_writes(store)
+    assert (progress["step"], progress["totalSteps"], progress["loss"]) == (100, 100, 0.01)
+    assert progress["etaSeconds"] in (None, 0)
+    assert store.documents[("user", "brand")]["trainingProgress"]["step"] == 100
+
+
+def test_writes_are_throttled_to_the_interval():
+    store = InMemoryStatusStore()
+    interval = 0.1
+    start = time.monotonic()
+    with ProgressReporter("brand", "user", interval=interval, store=store) as reporter:
+        step = 0
+        while time.monotonic() - start < 0.5:
+            step += 1
+            reporter.report(step, 10_000, loss=1.0)
+            time.sleep(0.001)
+    elapsed = time.monotonic() - start
+
+    # One write per elapsed interval at most, plus the final one from close()
+    assert 2 <= reporter.writes <= elapsed / interval + 1
+    writes = progress_writes(store)
+    assert len(writes) == reporter.writes
+    assert [progress["step"] for progress in writes] == sorted(progress["step"] for progress in writes)
+    assert writes[-1]["step"] == step
+    assert all(progress["stepsPerSecond"] > 0 for progress in writes[1:])
+
+
+def test_close_without_new_progress_writes_nothing():
+    store = InMemoryStatusStore()
+    reporter = ProgressReporter("brand", "user", interval=3600, store=store)
+    reporter.close()
+    reporter.close()
+    assert reporter.writes == 0
+    assert store.updates == []
+
+
+def test_failed_writes_never_reach_training():
+    reporter = ProgressReporter("brand", "user", interval=3600, store=FailingStore())
+    reporter.report(1, 10, loss=0.5)
+    reporter.close()
+    assert (reporter.writes, reporter.failures) == (0, 1)
+
+
+@pytest.fixture
+def memory_store(monkeypatch):
+    store = InMemoryStatusStore()
+    monkeypatch.setattr(brand_status, "_store", store)
+    return store
+
+
+def trainer_args(tiny_model, tmp_path):
+    return train_lora.parse_args([
+        "--brand_id", "brand", "--brand_name", "Brand", "--user_id", "user",
+        "--input_bucket", "input", "--input_path", "brand/",
+        "--output_bucket", "output", "--output_path", "models/brand/",
+        "--pretrained_model_name_or_path", tiny_model,
+        "--mixed_precision", "no",
+        "--resolution", "128",
+        "--batch_size", "2",
+        "--max_train_steps", "6",
+        "--validation_steps", "0",
+        "--checkpointing_steps", "0",
+        "--dataloader_num_workers", "0",
+        "--progress_interval", "3600",
+        "--image_dir", str(tmp_path / "images"),
+        "--latent_cache_dir", str(tmp_path / "latent_cache"),
+        "--checkpoint_dir", str(tmp_path / "checkpoints"),
+    ])
+
+
+def test_training_reports_status_and_progress(tiny_model, tmp_path, memory_store, monkeypatch):
+    monkeypatch.setattr(train_lora, "OUTPUT_DIR", str(tmp_path / "output"))
+    storage = tmp_path / "storage"
+    make_training_images(str(storage / "input" / "brand"), 12)
+
+    metadata = train_lora.train_lora(trainer_args(tiny_model, tmp_path),
+                                     GCSTransfer(client=LocalStorageClient(str(storage))))
+
+    assert statuses(memory_store) == ["training", "ready"]
+    # Six steps inside one long interval: a single progress write, from close(), before "ready"
+    [progress] = progress_writes(memory_store)
+    assert (progress["step"], progress["totalSteps"]) == (6, 6)
+    assert progress["loss"] == pytest.approx(metadata["smoothed_loss"])
+    assert [list(data) for _, _, data in memory_store.updates].index(["trainingProgress"]) == 1
+
+    document = memory_store.documents[("user", "brand")]
+    assert document["status"] == "ready"
+    assert document["loraModelPath"] == metadata["model_path"]
+    assert (storage / "output" / "models" / "brand" / "lora_weights.safetensors").exists()
+
+
+def test_training_failure_marks_the_brand_failed(tiny_model, tmp_path, memory_store, monkeypatch):
+    monkeypatch.setattr(train_lora, "OUTPUT_DIR", str(tmp_path / "output"))
+    storage = tmp_path / "storage"
+    make_training_images(str(storage / "input" / "brand"), 2)
+
+    with pytest.raises(ValueError, match="Not enough training images"):
+        train_lora.train_lora(trainer_args(tiny_model, tmp_path),
+                              GCSTransfer(client=LocalStorageClient(str(storage))))
+
+    assert statuses(memory_store) == ["training", "failed"]
+    assert progress_writes(memory_store) == []
+    assert "loraModelPath" not in memory_store.documents[("user", "brand")]
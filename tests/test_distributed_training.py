@@ -0,0 +1,67 @@
+"""Data-parallel LoRA training: two CPU processes over gloo on the tiny pipeline"""
+
+import os
+import subprocess
+import sys
+
+import torch
+from run_benchmarks import make_training_images
+
+from conftest import TESTS_DIR
+
+WORKER = os.path.join(TESTS_DIR, "distributed_training.py")
+
+
+def test_two_processes_train_identical_adapters(tiny_model, tmp_path):
+    storage = tmp_path / "storage"
+    results = tmp_path / "results"
+    results.mkdir()
+    make_training_images(str(storage / "input" / "brand"), 12)
+
+    command = [
+        sys.executable, "-m", "torch.distributed.run", "--standalone", "--nproc_per_node", "2", WORKER,
+        str(storage), str(results),
+        "--brand_id", "brand", "--brand_name", "Brand",
+        "--input_bucket", "input", "--input_path", "brand/",
+        "--output_bucket", "output", "--output_path", "models/brand/",
+        "--pretrained_model_name_or_path", tiny_model,
+        "--mixed_precision", "no",
+        "--resolution", "128",
+        "--batch_size", "2",
+        "--gradient_accumulation_steps", "2",
+        "--max_train_steps", "8",
+        "--validation_steps", "4",
+        "--validation_images", "2",
+        "--checkpointing_steps", "4",
+        "--dataloader_num_workers", "0",
+        "--image_dir", str(tmp_path / "images"),
+        "--latent_cache_dir", str(tmp_path / "latent_cache"),
+        "--checkpoint_dir", str(tmp_path / "checkpoints"),
+    ]
+    env = dict(os.environ, ACCELERATE_USE_CPU="1", OMP_NUM_THREADS="1")
+    subprocess.run(command, env=env, check=True, timeout=900)
+
+    ranks = [torch.load(results / f"rank{index}.pt", weights_only=False) for index in range(2)]
+    metadata = [rank["metadata"] for rank in ranks]
+    for rank_metadata in metadata:
+        assert rank_metadata["num_processes"] == 2
+        assert rank_metadata["effective_batch_size"] == 2 * 2 * 2
+        assert rank_metadata["training_steps"] == 8
+
+    # Plateau checks average the validation loss over the ranks, so every rank sees the same number
+    assert metadata[0]["best_plateau_loss"] == metadata[1]["best_plateau_loss"]
+    assert metadata[0]["best_plateau_step"] == metadata[1]["best_plateau_step"]
+
+    # DDP keeps the adapters in lockstep, and they have moved away from their zero-initialized lora_B
+    weights = [rank["weights"] for rank in ranks]
+    assert weights[0].keys() == weights[1].keys()
+    for name, value in weights[0].items():
+        assert torch.equal(value, weights[1][name]), name
+    assert any(value.abs().sum() > 0 for name, value in weights[0].items() if "lora_B" in name)
+
+    # Only the main process exports and uploads; finished runs leave no checkpoints behind
+    assert "export" in metadata[0] and "export" not in metadata[1]
+    output = storage / "output" / "models" / "brand"
+    assert (output / "lora_weights.safetensors").exists()
+    assert not list((tmp_path / "checkpoints").glob("checkpoint-*"))
+    assert not any(path.is_file() for path in (output / "checkpoints").rglob("*"))
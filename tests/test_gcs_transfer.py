@@ -0,0 +1,107 @@
+"""Parallel transfers (training/gcs_transfer.py) against the filesystem-backed storage stand-in"""
+
+import os
+
+import pytest
+from local_storage import LocalBlob, LocalStorageClient
+
+from gcs_transfer import GCSTransfer
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def storage(tmp_path):
+    root = tmp_path / "storage"
+    for name in ("a.jpg", "b.png", "notes.txt", "sub/c.jpg"):
+        write(root / "input" / "brand" / name, name.encode("utf-8") * 100)
+    return root
+
+
+def transfer(storage, **kwargs):
+    return GCSTransfer(client=LocalStorageClient(str(storage)), backoff_seconds=0, **kwargs)
+
+
+def test_download_prefix_skips_unchanged_files(storage, tmp_path):
+    local_dir = tmp_path / "images"
+    first = transfer(storage)
+    paths = first.download_prefix("input", "brand/", str(local_dir), suffixes=(".jpg", ".png"))
+    names = sorted(os.path.relpath(path, local_dir) for path in paths)
+    assert names == ["a.jpg", "b.png", os.path.join("sub", "c.jpg")]
+    for path in paths:
+        assert read(path) == read(storage / "input" / "brand" / os.path.relpath(path, local_dir))
+    assert first.summary("download")["transferred"] == 3
+
+    # A new process finds the same files on disk and fetches only the changed one
+    write(storage / "input" / "brand" / "a.jpg", b"retouched")
+    second = transfer(storage)
+    second.download_prefix("input", "brand/", str(local_dir), suffixes=(".jpg", ".png"))
+    summary = second.summary("download")
+    assert (summary["files"], summary["transferred"], summary["skipped"]) == (3, 1, 2)
+    assert summary["bytes"] == len(b"retouched")
+    assert read(local_dir / "a.jpg") == b"retouched"
+
+
+def test_download_prefix_keeps_same_names_in_subfolders_apart(tmp_path):
+    root = tmp_path / "storage"
+    write(root / "input" / "brand" / "a" / "1.jpg", b"first")
+    write(root / "input" / "brand" / "b" / "1.jpg", b"second")
+    paths = transfer(root).download_prefix("input", "brand", str(tmp_path / "images"))
+    assert len(set(paths)) == 2
+    assert sorted(read(path) for path in paths) == [b"first", b"second"]
+
+
+def test_upload_dir_skips_unchanged_files(storage, tmp_path):
+    local_dir = tmp_path / "model"
+    write(local_dir / "adapter.safetensors", b"weights")
+    write(local_dir / "training_metadata.json", b"{}")
+    write(local_dir / "scratch.tmp", b"ignored")
+
+    first = transfer(storage)
+    records = first.upload_dir(str(local_dir), "output", "models/brand", suffixes=(".safetensors", ".json"))
+    assert sorted(record["uri"] for record in records) == [
+        "gs://output/models/brand/adapter.safetensors", "gs://output/models/brand/training_metadata.json"
+    ]
+    assert not any(record["skipped"] for record in records)
+    assert not (storage / "output" / "models" / "brand" / "scratch.tmp").exists()
+
+    write(local_dir / "training_metadata.json", b'{"steps": 1}')
+    second = transfer(storage)
+    second.upload_dir(str(local_dir), "output", "models/brand", suffixes=(".safetensors", ".json"))
+    summary = second.summary("upload")
+    assert (summary["transferred"], summary["skipped"]) == (1, 1)
+    assert read(storage / "output" / "models" / "brand" / "training_metadata.json") == b'{"steps": 1}'
+
+
+def test_transient_failures_are_retried(storage, tmp_path, monkeypatch):
+    download = LocalBlob.download_to_filename
+    failures = []
+
+    def flaky_download(blob, filename):
+        if not failures:
+            failures.append(blob.name)
+            raise ConnectionError("connection reset")
+        download(blob, filename)
+
+    monkeypatch.setattr(LocalBlob, "download_to_filename", flaky_download)
+    transfers = transfer(storage, retries=2)
+    record = transfers.download("input", "brand/a.jpg", str(tmp_path / "a.jpg"))
+    assert record["attempts"] == 2
+    assert transfers.summary()["retries"] == 1
+    assert not os.path.exists(tmp_path / "a.jpg.part")
+
+
+def test_records_are_bounded_but_totals_are_not(storage, tmp_path):
+    transfers = transfer(storage, max_records=2)
+    transfers.download_prefix("input", "brand/", str(tmp_path / "images"))
+    assert len(transfers.records) == 2
+    assert transfers.summary("download")["files"] == 4
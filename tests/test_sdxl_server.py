@@ -0,0 +1,97 @@
+"""Warm inference server (functions/sdxl-lora/sdxl_server.py) end to end on the tiny pipeline"""
+
+import base64
+import io
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+from PIL import Image
+
+
+@pytest.fixture(scope="module")
+def server_url(tiny_model):
+    from generate_sdxl import SDXLGenerator
+    from sdxl_server import create_server
+
+    generator = SDXLGenerator(model_id=tiny_model, device="cpu", result_cache_mb=0).load()
+    server = create_server(generator, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+    generator.close()
+
+
+def request(url, path, body=None):
+    """(status, JSON response) of a GET, or of a POST when body is given"""
+    data = None if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode("utf-8"))
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url + path, data=data), timeout=300) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def decode(encoded):
+    return Image.open(io.BytesIO(base64.b64decode(encoded["data"])))
+
+
+def test_ready(server_url):
+    status, body = request(server_url, "/ready")
+    assert status == 200
+    assert body["ready"]
+
+
+def test_generate_inline(server_url):
+    status, body = request(server_url, "/generate", {
+        "prompt": "a red bicycle", "inline": True, "width": 96, "height": 64, "seed": 1, "thumbnails": [32],
+    })
+    assert status == 200, body
+    assert body["success"]
+    image = decode(body["output"])
+    assert image.format == "PNG"
+    assert image.size == (96, 64)
+    [thumbnail] = body["output"]["thumbnails"]
+    assert decode(thumbnail).size == (32, 32)
+
+
+def test_generate_writes_output_path(server_url, tmp_path):
+    output_path = tmp_path / "out.webp"
+    status, body = request(server_url, "/generate", {
+        "prompt": "a red bicycle", "output_path": str(output_path), "width": 64, "height": 64,
+        "output_format": "webp",
+    })
+    assert status == 200, body
+    with Image.open(output_path) as image:
+        assert image.format == "WEBP"
+        assert image.size == (64, 64)
+
+
+@pytest.mark.parametrize("body", [
+    b"[]",
+    b'"x"',
+    b"not json",
+    {"inline": True},
+    {"prompt": 123, "inline": True},
+    {"prompt": "a cat"},
+    {"prompt": "a cat", "inline": True, "width": 100},
+    {"prompt": "a cat", "inline": True, "height": 99999},
+    {"prompt": "a cat", "inline": True, "seed": 1.5},
+    {"prompt": "a cat", "inline": True, "quality_tier": "best"},
+    {"prompt": "a cat", "inline": True, "output_format": "gif"},
+    {"prompt": "a cat", "inline": True, "width": 64, "height": 64, "thumbnails": [0]},
+    {"prompt": "a cat", "inline": True, "width": 64, "height": 64, "thumbnails": [128]},
+])
+def test_invalid_requests_are_rejected(server_url, body):
+    status, response = request(server_url, "/generate", body)
+    assert status == 400
+    assert "error" in response
+
+
+def test_cancel_unknown_job(server_url):
+    status, _ = request(server_url, "/cancel", {"job_id": "missing"})
+    assert status == 404
@@ -0,0 +1,174 @@
+"""
+Brand training status in Firestore for MediaForge
+
+Shared by the MVP trainer (train_lora.py) and the LoRA trainer
+(lora-trainer/train_lora.py); the lora-trainer image is built with
+training/ as its context, so both ship this one copy.
+
+Status changes (training, ready, failed) are written as they happen.
+Progress while a brand trains goes through a ProgressReporter: the
+training loop hands it the latest step and loss, which never waits on the
+network, and a background thread writes the newest values to the brand's
+trainingProgress field at most every few seconds. Writes go to a status
+store, Firestore by default; set_status_store(InMemoryStatusStore())
+records them in memory instead, for tests and local runs.
+"""
+
+import logging
+import threading
+import time
+
+from google.cloud import firestore
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_store = None
+
+
+def firestore_client():
+    """One Firestore client per process, reused across brands"""
+    global _client
+    if _client is None:
+        _client = firestore.Client()
+    return _client
+
+
+class FirestoreStatusStore:
+    """Brand documents under users/{user_id}/brands in Firestore"""
+
+    def update(self, user_id: str, brand_id: str, data: dict):
+        db = firestore_client()
+        db.collection('users').document(user_id).collection('brands').document(brand_id).update(data)
+
+
+class InMemoryStatusStore:
+    """Keeps every update in memory instead of writing to Firestore"""
+
+    def __init__(self):
+        # (user_id, brand_id, data) in the order they were written
+        self.updates = []
+        # (user_id, brand_id) -> merged fields
+        self.documents = {}
+        self._lock = threading.Lock()
+
+    def update(self, user_id: str, brand_id: str, data: dict):
+        with self._lock:
+            self.updates.append((user_id, brand_id, dict(data)))
+            self.documents.setdefault((user_id, brand_id), {}).update(data)
+
+
+def status_store():
+    """The process's status store (Firestore unless replaced with set_status_store())"""
+    global _store
+    if _store is None:
+        _store = FirestoreStatusStore()
+    return _store
+
+
+def set_status_store(store):
+    global _store
+    _store = store
+
+
+def update_brand_status(brand_id: str, user_id: str, status: str, model_path: str = None, store=None):
+    """Update brand training status in Firestore"""
+    logger.info(f"Updating brand {brand_id} status to {status}")
+
+    update_data = {
+        'status': status,
+    }
+
+    if status == 'ready' and model_path:
+        update_data['loraModelPath'] = model_path
+        update_data['trainingCompletedAt'] = firestore.SERVER_TIMESTAMP
+    elif status == 'failed':
+        update_data['failedAt'] = firestore.SERVER_TIMESTAMP
+
+    (store or status_store()).update(user_id, brand_id, update_data)
+    logger.info(f"Brand status updated to {status}")
+
+
+class ProgressReporter:
+    """Writes a brand's training progress from a background thread, at most every interval seconds
+
+    report() only records the newest values. Each write carries the step,
+    total steps, smoothed loss, steps per second over the steps since the
+    previous write and the ETA at that rate; close() writes whatever is
+    still unwritten before returning. Failed writes are logged and skipped,
+    never raised into training.
+    """
+
+    def __init__(self, brand_id: str, user_id: str, interval: float = 10.0, store=None):
+        self.brand_id = brand_id
+        self.user_id = user_id
+        self.interval = interval
+        self.store = store or status_store()
+        self.writes = 0
+        self.failures = 0
+        # (step, total_steps, loss, monotonic time) of the newest report
+        self._latest = None
+        # The first report and the last written one, for steps per second
+        self._first = None
+        self._written = None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"progress-{brand_id}", daemon=True)
+        self._thread.start()
+
+    def report(self, step: int, total_steps: int, loss: float = None):
+        """Record progress; returns immediately"""
+        with self._lock:
+            self._latest = (step, total_steps, loss, time.monotonic())
+            if self._first is None:
+                self._first = self._latest
+
+    def _progress(self, latest):
+        step, total_steps, loss, at = latest
+        previous = self._written or self._first
+        steps_per_second = None
+        if previous is not latest and at > previous[3]:
+            steps_per_second = (step - previous[0]) / (at - previous[3])
+        eta_seconds = None
+        if steps_per_second:
+            eta_seconds = max(total_steps - step, 0) / steps_per_second
+        return {
+            'step': step,
+            'totalSteps': total_steps,
+            'loss': loss,
+            'stepsPerSecond': steps_per_second,
+            'etaSeconds': eta_seconds,
+            'updatedAt': firestore.SERVER_TIMESTAMP,
+        }
+
+    def _write(self):
+        with self._lock:
+            latest = self._latest
+        if latest is None or latest is self._written:
+            return
+        try:
+            self.store.update(self.user_id, self.brand_id, {'trainingProgress': self._progress(latest)})
+            self.writes += 1
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"Progress update for brand {self.brand_id} failed: {e}")
+        self._written = latest
+
+    def _run(self):
+        # Wakes every interval until closed
+        while not self._closed.wait(self.interval):
+            self._write()
+
+    def close(self):
+        """Stop the thread and write the final progress"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._thread.join()
+        self._write()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,246 @@
+"""
+Parallel, resumable Cloud Storage transfers for MediaForge
+
+Shared by the training scripts and the SDXL generation service; the
+sdxl-lora image is built from the repository root to copy it from here.
+
+Transfers run on a bounded thread pool over one reused storage client,
+skip files whose local copy already matches the object's CRC32C/MD5,
+retry transient failures with exponential backoff and record per-transfer
+timing and byte counts.
+"""
+
+import base64
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions as gcs_exceptions
+from google.cloud import storage
+
+try:
+    import google_crc32c
+except ImportError:  # MD5 comparison still works without it
+    google_crc32c = None
+
+logger = logging.getLogger(__name__)
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png')
+
+
+def parse_gcs_uri(uri):
+    """Split gs://bucket/path into (bucket, path)"""
+    parts = uri.replace("gs://", "", 1).split("/", 1)
+    return parts[0], parts[1] if len(parts) > 1 else ""
+
+
+def local_checksums(path, chunk_size=4 * 1024 * 1024):
+    """Base64 CRC32C and MD5 of a local file, in the format GCS reports them"""
+    crc = google_crc32c.Checksum() if google_crc32c else None
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+            if crc is not None:
+                crc.update(chunk)
+    return {
+        "crc32c": base64.b64encode(crc.digest()).decode("ascii") if crc is not None else None,
+        "md5": base64.b64encode(md5.digest()).decode("ascii"),
+    }
+
+
+def matches_blob(local_path, blob):
+    """True if local_path exists with the same content as blob"""
+    if not os.path.exists(local_path):
+        return False
+    if blob.size is not None and os.path.getsize(local_path) != blob.size:
+        return False
+    checksums = local_checksums(local_path)
+    if blob.crc32c and checksums["crc32c"]:
+        return blob.crc32c == checksums["crc32c"]
+    if blob.md5_hash:
+        return blob.md5_hash == checksums["md5"]
+    return False
+
+
+class GCSTransfer:
+    """Thread-pooled uploads/downloads sharing one storage client"""
+
+    def __init__(self, client=None, max_workers=8, retries=3, backoff_seconds=1.0, max_records=1000):
+        self._client = client
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        # The most recent transfers; long-lived processes keep only running totals beyond these
+        self.records = deque(maxlen=max_records)
+        # op -> running totals for summary()
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = storage.Client()
+        return self._client
+
+    def _record(self, op, uri, local_path, nbytes, seconds, skipped, attempts):
+        record = {
+            "op": op,
+            "uri": uri,
+            "local_path": local_path,
+            "bytes": nbytes,
+            "seconds": seconds,
+            "skipped": skipped,
+            "attempts": attempts,
+        }
+        with self._lock:
+            self.records.append(record)
+            totals = self._totals.setdefault(
+                op, {"files": 0, "transferred": 0, "skipped": 0, "bytes": 0, "seconds": 0.0, "retries": 0}
+            )
+            totals["files"] += 1
+            totals["skipped" if skipped else "transferred"] += 1
+            if not skipped:
+                totals["bytes"] += nbytes
+            totals["seconds"] += seconds
+            totals["retries"] += max(attempts - 1, 0)
+        return record
+
+    def _with_retries(self, description, fn):
+        """Run fn(), retrying transient errors with exponential backoff; returns (result, attempts)"""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return fn(), attempt
+            except (gcs_exceptions.NotFound, gcs_exceptions.Forbidden, gcs_exceptions.Unauthorized):
+                raise
+            except Exception as e:
+                if attempt > self.retries:
+                    raise
+                delay = self.backoff_seconds * (2 ** (attempt - 1))
+                logger.warning(f"{description} failed (attempt {attempt}): {e}; retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def download_blob(self, blob, local_path):
+        """Download one blob unless local_path already holds the same content"""
+        uri = f"gs://{blob.bucket.name}/{blob.name}"
+        start_time = time.time()
+        if matches_blob(local_path, blob):
+            return self._record("download", uri, local_path, 0, time.time() - start_time, True, 0)
+
+        os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+        tmp_path = f"{local_path}.part"
+
+        def _download():
+            blob.download_to_filename(tmp_path)
+            os.replace(tmp_path, local_path)
+
+        try:
+            _, attempts = self._with_retries(f"Download of {uri}", _download)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return self._record(
+            "download", uri, local_path, os.path.getsize(local_path), time.time() - start_time, False, attempts
+        )
+
+    def get_blob(self, bucket_name, blob_name):
+        """Object metadata (generation, size, checksums) without its content"""
+        bucket = self.client.bucket(bucket_name)
+        blob, _ = self._with_retries(f"Metadata for gs://{bucket_name}/{blob_name}",
+                                     lambda: bucket.get_blob(blob_name))
+        if blob is None:
+            raise FileNotFoundError(f"gs://{bucket_name}/{blob_name} does not exist")
+        return blob
+
+    def download(self, bucket_name, blob_name, local_path):
+        """Download gs://bucket_name/blob_name to local_path, skipping if unchanged"""
+        return self.download_blob(self.get_blob(bucket_name, blob_name), local_path)
+
+    def download_prefix(self, bucket_name, prefix, local_dir, suffixes=None):
+        """Download every blob under prefix (optionally filtered by suffix) into local_dir
+
+        Files keep their path relative to prefix, so a/1.jpg and b/1.jpg
+        land in separate subdirectories; returns their local paths in
+        listing order.
+        """
+        os.makedirs(local_dir, exist_ok=True)
+        blobs, _ = self._with_retries(
+            f"Listing gs://{bucket_name}/{prefix}",
+            lambda: list(self.client.bucket(bucket_name).list_blobs(prefix=prefix))
+        )
+        # Folder placeholder objects ("path/") hold no file
+        blobs = [blob for blob in blobs if not blob.name.endswith("/")]
+        if suffixes:
+            blobs = [blob for blob in blobs if blob.name.lower().endswith(suffixes)]
+
+        local_paths = [self._prefix_path(blob.name, prefix, local_dir) for blob in blobs]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            list(pool.map(self.download_blob, blobs, local_paths))
+        return local_paths
+
+    @staticmethod
+    def _prefix_path(blob_name, prefix, local_dir):
+        """Local path for blob_name under local_dir, relative to prefix"""
+        relative = os.path.normpath(blob_name[len(prefix):].lstrip("/"))
+        if relative.startswith("..") or os.path.isabs(relative):
+            raise ValueError(f"Object name {blob_name!r} escapes the download directory")
+        return os.path.join(local_dir, relative)
+
+    def upload(self, local_path, bucket_name, blob_name):
+        """Upload local_path unless the object already has the same content"""
+        uri = f"gs://{bucket_name}/{blob_name}"
+        start_time = time.time()
+        bucket = self.client.bucket(bucket_name)
+
+        existing, _ = self._with_retries(f"Metadata for {uri}", lambda: bucket.get_blob(blob_name))
+        if existing is not None and matches_blob(local_path, existing):
+            return self._record("upload", uri, local_path, 0, time.time() - start_time, True, 0)
+
+        blob = bucket.blob(blob_name)
+        _, attempts = self._with_retries(f"Upload of {uri}", lambda: blob.upload_from_filename(local_path))
+        return self._record(
+            "upload", uri, local_path, os.path.getsize(local_path), time.time() - start_time, False, attempts
+        )
+
+    def upload_dir(self, local_dir, bucket_name, prefix, suffixes=None):
+        """Upload every file under local_dir to gs://bucket_name/prefix in parallel"""
+        jobs = []
+        for root, dirs, files in os.walk(local_dir):
+            for file in files:
+                if suffixes and not file.endswith(suffixes):
+                    continue
+                local_file = os.path.join(root, file)
+                relative_path = os.path.relpath(local_file, local_dir)
+                jobs.append((local_file, os.path.join(prefix, relative_path)))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(lambda job: self.upload(job[0], bucket_name, job[1]), jobs))
+
+    def summary(self, op=None):
+        """Aggregate counts, bytes and time over every transfer so far (of one op, if given)"""
+        summary = {"files": 0, "transferred": 0, "skipped": 0, "bytes": 0, "seconds": 0.0, "retries": 0}
+        with self._lock:
+            for name, totals in self._totals.items():
+                if op is None or name == op:
+                    for key, value in totals.items():
+                        summary[key] += value
+        return summary
+
+
+_default_transfer = None
+_default_lock = threading.Lock()
+
+
+def default_transfer():
+    """Process-wide GCSTransfer, so every caller shares one storage client"""
+    global _default_transfer
+    with _default_lock:
+        if _default_transfer is None:
+            _default_transfer = GCSTransfer()
+        return _default_transfer
@@ -0,0 +1,218 @@
+"""
+Structured stage timing and profiling hooks for MediaForge
+
+Shared by the training scripts and the SDXL generation service; the
+sdxl-lora image is built from the repository root to copy it from here.
+
+Named spans record wall time plus host and accelerator memory high-water
+marks, and are written as JSON lines ({"event": "span", ...}) to a file or
+stream when a sink is configured. StepProfiler wraps torch.profiler for an
+opt-in trace over a bounded number of steps.
+"""
+
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import torch
+
+# Where JSON lines go when a script isn't given an explicit sink
+METRICS_FILE_ENV = "MEDIAFORGE_METRICS_FILE"
+
+
+def _rss_mb():
+    """Current resident set size, from /proc where available"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def memory_snapshot():
+    """Host RSS (current and peak) and CUDA allocated (current and peak) in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    snapshot = {
+        "rss_mb": _rss_mb(),
+        # Linux reports kilobytes, macOS bytes
+        "rss_peak_mb": peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024,
+    }
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        snapshot["cuda_allocated_mb"] = torch.cuda.memory_allocated() / (1024 * 1024)
+        snapshot["cuda_peak_mb"] = torch.cuda.max_memory_allocated() / (1024 * 1024)
+    return snapshot
+
+
+def _open_sink(sink):
+    if sink is None or hasattr(sink, "write"):
+        return sink, False
+    if sink in ("", "none"):
+        return None, False
+    if sink == "-":
+        return sys.stdout, False
+    if sink == "stderr":
+        return sys.stderr, False
+    os.makedirs(os.path.dirname(os.path.abspath(sink)), exist_ok=True)
+    return open(sink, "a", buffering=1), True
+
+
+class Instrumentation:
+    """Records named spans and events, and writes them as JSON lines
+
+    sink is a path, "-" (stdout), "stderr", an open stream, or None to keep
+    records in memory only. context fields are added to every record.
+    """
+
+    def __init__(self, service, sink=None, context=None):
+        self.service = service
+        self.run_id = uuid.uuid4().hex[:12]
+        self.context = dict(context or {})
+        self.totals = {}
+        self._sink, self._owns_sink = _open_sink(sink)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @classmethod
+    def from_env(cls, service, sink=None, context=None):
+        """Use sink if given, else $MEDIAFORGE_METRICS_FILE, else in-memory only"""
+        return cls(service, sink=sink or os.environ.get(METRICS_FILE_ENV), context=context)
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+            self._local.captures = []
+        return self._local.stack
+
+    def emit(self, event, **fields):
+        """Write one record: {"event", "service", "run_id", "ts", **context, **fields}"""
+        record = {"event": event, "service": self.service, "run_id": self.run_id, "ts": time.time()}
+        record.update(self.context)
+        record.update(fields)
+        self._stack()
+        for captured in self._local.captures:
+            captured.append(record)
+        if self._sink is not None:
+            line = json.dumps(record, default=str)
+            with self._lock:
+                self._sink.write(line + "\n")
+                self._sink.flush()
+        return record
+
+    def record(self, name, seconds, **fields):
+        """Record a span timed by the caller, nested under the current span"""
+        stack = self._stack()
+        fields.setdefault("parent", stack[-1] if stack else None)
+        with self._lock:
+            total = self.totals.setdefault(name, {"count": 0, "seconds": 0.0})
+            total["count"] += 1
+            total["seconds"] += seconds
+        return self.emit("span", name=name, seconds=seconds, **memory_snapshot(), **fields)
+
+    @contextmanager
+    def span(self, name, reset_peak=False, **fields):
+        """Time the enclosed block; the yielded dict can take extra fields for the record
+
+        cuda_peak_mb is the process's high-water mark since its last reset.
+        With reset_peak the CUDA peak is reset when the span starts, making it
+        this span's own peak; that is process-wide state, so only use it where
+        nothing else is measuring.
+        """
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        if reset_peak and torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.reset_peak_memory_stats()
+        stack.append(name)
+        status = "ok"
+        start_time = time.perf_counter()
+        try:
+            yield fields
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            seconds = time.perf_counter() - start_time
+            stack.pop()
+            self.record(name, seconds, **{**fields, "parent": parent, "status": status})
+
+    @contextmanager
+    def capture(self):
+        """Collect the records this thread emits inside the block"""
+        self._stack()
+        records = []
+        self._local.captures.append(records)
+        try:
+            yield records
+        finally:
+            self._local.captures.remove(records)
+
+    def summary(self):
+        """Per-span-name count and total seconds since this instance was created"""
+        with self._lock:
+            return {name: dict(total) for name, total in self.totals.items()}
+
+    def close(self):
+        if self._owns_sink:
+            self._sink.close()
+        self._sink = None
+
+
+def stage_seconds(records):
+    """Total seconds per span name in captured records"""
+    stages = {}
+    for record in records:
+        if record["event"] == "span":
+            stages[record["name"]] = stages.get(record["name"], 0.0) + record["seconds"]
+    return stages
+
+
+class StepProfiler:
+    """torch.profiler trace over `steps` steps after `wait` + `warmup`; a no-op when steps is 0
+
+    Call step() once per training or denoising step. Traces are written
+    for TensorBoard / Perfetto under trace_dir.
+    """
+
+    def __init__(self, trace_dir, steps=0, wait=1, warmup=1):
+        self.trace_dir = trace_dir
+        self.steps = steps
+        self.wait = wait
+        self.warmup = warmup
+        self.profiler = None
+
+    @property
+    def enabled(self):
+        return self.steps > 0
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=self.wait, warmup=self.warmup, active=self.steps, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir),
+            record_shapes=True,
+            profile_memory=True,
+        )
+        self.profiler.__enter__()
+        print(f"Profiling {self.steps} steps to {self.trace_dir}")
+        return self
+
+    def step(self):
+        if self.profiler is not None:
+            self.profiler.step()
+
+    def __exit__(self, *exc_info):
+        if self.profiler is not None:
+            self.profiler.__exit__(*exc_info)
+            self.profiler = None
+        return False
@@ -0,0 +1,307 @@
+"""
+Checkpointing with resume for preemptible LoRA training runs
+
+A checkpoint holds the trainable LoRA weights, optimizer state, RNG
+states, the step counter, the data stream position and the early-stopping
+state. The training loop
+only pays for copying state to host memory; serialization, the local
+write and the upload to the output bucket happen on a background thread.
+A checkpoint counts as valid once its COMPLETE marker exists, which is
+always written last. A failed write or upload is logged and training
+carries on; the checkpoint just never becomes valid. The newest
+total_limit valid checkpoints are kept, locally and in the bucket.
+
+Each checkpoint records the fingerprint of the run that wrote it (see
+run_fingerprint()); restore() only resumes from checkpoints of the same
+run, and clear() deletes a run's checkpoints once its adapter is uploaded.
+"""
+
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from safetensors.torch import load_file, save_file
+
+COMPLETE_MARKER = "COMPLETE"
+CHECKPOINT_PATTERN = re.compile(r"^checkpoint-(\d+)$")
+
+
+def _to_cpu(obj):
+    """Deep copy of nested state with every tensor cloned to host memory"""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return obj
+
+
+def rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def run_fingerprint(**settings):
+    """Stable hash of everything that makes a checkpoint resumable: training data and settings"""
+    text = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def lora_state_dict(model):
+    """Trainable (LoRA) parameters only; the frozen base weights never change"""
+    return {name: param.detach().to("cpu", copy=True)
+            for name, param in model.named_parameters() if param.requires_grad}
+
+
+class CheckpointManager:
+    """Writes checkpoints in the background and finds the latest valid one to resume from"""
+
+    def __init__(self, checkpoint_dir, total_limit=2, transfer=None, bucket_name=None, remote_prefix=None,
+                 fingerprint=None):
+        self.checkpoint_dir = checkpoint_dir
+        # run_fingerprint() of this run; checkpoints from any other run are never resumed
+        self.fingerprint = fingerprint
+        self.total_limit = total_limit
+        self.transfer = transfer
+        self.bucket_name = bucket_name
+        self.remote_prefix = remote_prefix
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self._pending = None
+        # Checkpoints that failed to write or upload
+        self.failures = 0
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    @property
+    def uploads_enabled(self):
+        return self.transfer is not None and self.bucket_name is not None
+
+    def _local_path(self, step):
+        return os.path.join(self.checkpoint_dir, f"checkpoint-{step}")
+
+    def _remote_path(self, step):
+        return f"{self.remote_prefix.rstrip('/')}/checkpoints/checkpoint-{step}"
+
+    def save(self, step, model, optimizer, scaler=None, data_state=None, progress=None):
+        """Snapshot training state now and write it asynchronously"""
+        # Only one checkpoint in flight; bounds host memory held by snapshots
+        self.wait()
+
+        snapshot = {
+            "weights": lora_state_dict(model),
+            "state": {
+                "step": step,
+                "fingerprint": self.fingerprint,
+                "optimizer": _to_cpu(optimizer.state_dict()),
+                "scaler": scaler.state_dict() if scaler is not None else None,
+                "rng": rng_state(),
+                "data": data_state,
+                # Convergence tracking (smoothed loss, plateau detector)
+                "progress": progress,
+            },
+        }
+        self._pending = self._executor.submit(self._save, step, snapshot)
+        return self._pending
+
+    def _save(self, step, snapshot):
+        """Background job: write locally, then upload; failures never reach the training loop"""
+        try:
+            self._write(step, snapshot)
+        except Exception as e:
+            self.failures += 1
+            shutil.rmtree(f"{self._local_path(step)}.tmp", ignore_errors=True)
+            print(f"Warning: checkpoint at step {step} was not saved: {e}")
+            return
+        if self.uploads_enabled:
+            try:
+                self._upload(step)
+            except Exception as e:
+                # Without its COMPLETE marker the partial upload is never resumed from
+                self.failures += 1
+                print(f"Warning: checkpoint at step {step} was not uploaded: {e}")
+            else:
+                self._prune_remote()
+        self._prune()
+
+    def _write(self, step, snapshot):
+        final_path = self._local_path(step)
+        tmp_path = f"{final_path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        save_file(snapshot["weights"], os.path.join(tmp_path, "lora_weights.safetensors"))
+        torch.save(snapshot["state"], os.path.join(tmp_path, "training_state.pt"))
+        with open(os.path.join(tmp_path, COMPLETE_MARKER), "w") as f:
+            f.write(str(step))
+
+        shutil.rmtree(final_path, ignore_errors=True)
+        os.replace(tmp_path, final_path)
+        print(f"Checkpoint saved at step {step}: {final_path}")
+
+    def _upload(self, step):
+        local_path = self._local_path(step)
+        remote_path = self._remote_path(step)
+        for name in ("lora_weights.safetensors", "training_state.pt"):
+            self.transfer.upload(os.path.join(local_path, name), self.bucket_name, f"{remote_path}/{name}")
+        # Marker last, so a partially uploaded checkpoint is never picked up
+        self.transfer.upload(os.path.join(local_path, COMPLETE_MARKER), self.bucket_name,
+                             f"{remote_path}/{COMPLETE_MARKER}")
+        print(f"Checkpoint uploaded to gs://{self.bucket_name}/{remote_path}")
+
+    def _prune(self):
+        steps = sorted(self._local_steps())
+        for step in steps[:-self.total_limit] if self.total_limit else []:
+            shutil.rmtree(self._local_path(step), ignore_errors=True)
+
+    def _prune_remote(self):
+        """Delete bucket checkpoints older than the newest total_limit valid ones, including failed uploads"""
+        if not self.total_limit:
+            return
+        try:
+            blobs = self._remote_blobs()
+            complete = sorted(step for step, names in blobs.items() if COMPLETE_MARKER in names)
+            if not complete:
+                return
+            keep = set(complete[-self.total_limit:])
+            for step in sorted(blobs):
+                if step < max(keep) and step not in keep:
+                    # Marker first: a half-deleted checkpoint is never mistaken for a valid one
+                    names = sorted(blobs[step], key=lambda name: name != COMPLETE_MARKER)
+                    for name in names:
+                        blobs[step][name].delete()
+        except Exception as e:
+            print(f"Warning: could not prune checkpoints in gs://{self.bucket_name}: {e}")
+
+    def wait(self):
+        """Block until the in-flight checkpoint (if any) is fully written"""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown(wait=True)
+
+    def clear(self):
+        """Delete this run's checkpoints, locally and in the bucket, once they are no longer needed"""
+        self.wait()
+        for step in self._local_steps():
+            shutil.rmtree(self._local_path(step), ignore_errors=True)
+        if not self.uploads_enabled:
+            return
+        try:
+            for step, blobs in self._remote_blobs().items():
+                # Marker first: a half-deleted checkpoint is never mistaken for a valid one
+                for name in sorted(blobs, key=lambda name: name != COMPLETE_MARKER):
+                    blobs[name].delete()
+        except Exception as e:
+            print(f"Warning: could not delete checkpoints in gs://{self.bucket_name}: {e}")
+
+    def _local_steps(self):
+        steps = []
+        for name in os.listdir(self.checkpoint_dir):
+            match = CHECKPOINT_PATTERN.match(name)
+            if match and os.path.exists(os.path.join(self.checkpoint_dir, name, COMPLETE_MARKER)):
+                steps.append(int(match.group(1)))
+        return steps
+
+    def _remote_blobs(self):
+        """{step: {file name: blob}} of every checkpoint in the bucket, complete or not"""
+        prefix = f"{self.remote_prefix.rstrip('/')}/checkpoints/"
+        bucket = self.transfer.client.bucket(self.bucket_name)
+        checkpoints = {}
+        for blob in bucket.list_blobs(prefix=prefix):
+            parts = blob.name[len(prefix):].split("/")
+            match = CHECKPOINT_PATTERN.match(parts[0])
+            if match:
+                checkpoints.setdefault(int(match.group(1)), {})[parts[-1]] = blob
+        return checkpoints
+
+    def _remote_steps(self):
+        if not self.uploads_enabled:
+            return []
+        return [step for step, names in self._remote_blobs().items() if COMPLETE_MARKER in names]
+
+    def _fetch(self, step):
+        """Make checkpoint `step` available locally, downloading it if needed"""
+        local_path = self._local_path(step)
+        if os.path.exists(os.path.join(local_path, COMPLETE_MARKER)):
+            return local_path
+        print(f"Downloading checkpoint {step} from gs://{self.bucket_name}/{self._remote_path(step)}")
+        tmp_path = f"{local_path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        self.transfer.download_prefix(self.bucket_name, f"{self._remote_path(step)}/", tmp_path)
+        shutil.rmtree(local_path, ignore_errors=True)
+        os.replace(tmp_path, local_path)
+        return local_path
+
+    def restore(self, model, optimizer, scaler=None):
+        """Load the newest valid checkpoint (local or remote) into model/optimizer
+
+        Returns the saved state ({"step", "data", ...}) or None if there is
+        nothing to resume from. Checkpoints of another run (a different
+        fingerprint) or that fail to load are skipped.
+        """
+        for step in sorted(set(self._local_steps()) | set(self._remote_steps()), reverse=True):
+            try:
+                path = self._fetch(step)
+                weights = load_file(os.path.join(path, "lora_weights.safetensors"))
+                state = torch.load(os.path.join(path, "training_state.pt"), map_location="cpu",
+                                   weights_only=False)
+            except Exception as e:
+                print(f"Warning: skipping unreadable checkpoint {step}: {e}")
+                continue
+
+            if state.get("fingerprint") != self.fingerprint:
+                print(f"Warning: skipping checkpoint {step}: it was written by a different training run")
+                continue
+
+            params = dict(model.named_parameters())
+            mismatched = [name for name, value in weights.items()
+                          if name not in params or params[name].shape != value.shape]
+            if mismatched:
+                print(f"Warning: checkpoint {step} does not match this model ({len(mismatched)} unknown "
+                      f"or differently shaped weights)")
+                continue
+
+            # Put the current weights back if the checkpoint only partly loads
+            original = {name: params[name].detach().clone() for name in weights}
+            try:
+                with torch.no_grad():
+                    for name, value in weights.items():
+                        params[name].copy_(value.to(params[name].device, params[name].dtype))
+                optimizer.load_state_dict(state["optimizer"])
+                if scaler is not None and state.get("scaler"):
+                    scaler.load_state_dict(state["scaler"])
+                set_rng_state(state["rng"])
+            except Exception as e:
+                with torch.no_grad():
+                    for name, value in original.items():
+                        params[name].copy_(value)
+                print(f"Warning: skipping checkpoint {step}: {e}")
+                continue
+
+            print(f"Resumed from checkpoint at step {state['step']}")
+            return state
+
+        return None
@@ -0,0 +1,165 @@
+"""
+Training budget and convergence checks for MediaForge LoRA training
+
+The default step budget is a number of passes over the brand's images
+(more for higher LoRA ranks), so small brands don't pay for 500 steps and
+large ones aren't cut short. Latents are noised with the base model's
+DDPM schedule, optionally with min-SNR loss weighting, which keeps the
+many easy low-noise timesteps from dominating the gradient.
+
+Training stops early once a plateau is reached: every few steps the loss
+on a fixed set of cached latents, timesteps and noise (or, without them,
+the smoothed training loss) is compared with the best so far, and after
+a number of checks without meaningful improvement the run ends.
+"""
+
+import math
+
+import torch
+from diffusers import DDPMScheduler
+from diffusers.training_utils import compute_snr
+
+# Passes over the images at rank 16; higher ranks have more weights to fit
+BASE_EPOCHS = 25
+MIN_TRAIN_STEPS = 100
+MAX_TRAIN_STEPS = 3000
+
+
+def default_train_steps(batches_per_epoch, rank, base_epochs=BASE_EPOCHS):
+    """Step budget for a dataset of batches_per_epoch batches (per process) at a LoRA rank"""
+    epochs = base_epochs * math.sqrt(rank / 16)
+    return int(min(MAX_TRAIN_STEPS, max(MIN_TRAIN_STEPS, round(epochs * batches_per_epoch))))
+
+
+def make_noise_scheduler(scheduler_config):
+    """DDPM training schedule with the base model's betas and prediction type"""
+    return DDPMScheduler.from_config(scheduler_config)
+
+
+def sample_timesteps(noise_scheduler, batch_size, device, generator=None):
+    return torch.randint(0, noise_scheduler.config.num_train_timesteps, (batch_size,),
+                         device=device, generator=generator)
+
+
+def training_target(noise_scheduler, latents, noise, timesteps):
+    """What the UNet should predict for these noisy latents"""
+    if noise_scheduler.config.prediction_type == "v_prediction":
+        return noise_scheduler.get_velocity(latents, noise, timesteps)
+    return noise
+
+
+def diffusion_loss(model_pred, target, timesteps, noise_scheduler, snr_gamma=None):
+    """MSE, weighted per sample by min(SNR, snr_gamma) / SNR when snr_gamma is set"""
+    if snr_gamma is None:
+        return torch.nn.functional.mse_loss(model_pred.float(), target.float())
+
+    snr = compute_snr(noise_scheduler, timesteps)
+    weights = torch.clamp(snr, max=snr_gamma)
+    if noise_scheduler.config.prediction_type == "v_prediction":
+        weights = weights / (snr + 1)
+    else:
+        weights = weights / snr
+    loss = torch.nn.functional.mse_loss(model_pred.float(), target.float(), reduction="none")
+    return (loss.mean(dim=list(range(1, loss.ndim))) * weights).mean()
+
+
+class ValidationLatents:
+    """Fixed latents, timesteps and noise, so losses are comparable across checks
+
+    Each image is evaluated at evenly spaced timesteps in one batch; the
+    latents are the cached distributions' means, not samples.
+    """
+
+    def __init__(self, dataset, noise_scheduler, num_images=4, timesteps_per_image=4, seed=0):
+        self.noise_scheduler = noise_scheduler
+        self.items = []
+        generator = torch.Generator().manual_seed(seed)
+        num_train_timesteps = noise_scheduler.config.num_train_timesteps
+        timesteps = torch.tensor([
+            int((i + 0.5) * num_train_timesteps / timesteps_per_image) for i in range(timesteps_per_image)
+        ])
+        # Spread over the dataset rather than its first few images
+        count = min(num_images, len(dataset))
+        for index in sorted({i * len(dataset) // count for i in range(count)}):
+            item = dataset[index]
+            mean, _ = torch.chunk(item["latent_params"].to(torch.float32), 2, dim=0)
+            latents = mean.unsqueeze(0).expand(len(timesteps), -1, -1, -1)
+            noise = torch.randn(latents.shape, generator=generator)
+            self.items.append((latents, noise, timesteps, item["time_ids"].unsqueeze(0)))
+
+    def __len__(self):
+        return len(self.items)
+
+    @torch.no_grad()
+    def loss(self, predict, scaling_factor, device, dtype, snr_gamma=None):
+        """Mean loss of predict(noisy_latents, timesteps, time_ids) over the fixed set"""
+        losses = []
+        for latents, noise, timesteps, time_ids in self.items:
+            latents = (latents.to(device) * scaling_factor).to(dtype)
+            noise = noise.to(device, dtype)
+            timesteps = timesteps.to(device)
+            noisy_latents = self.noise_scheduler.add_noise(latents, noise, timesteps)
+            model_pred = predict(noisy_latents, timesteps, time_ids.to(device, dtype).expand(len(timesteps), -1))
+            target = training_target(self.noise_scheduler, latents, noise, timesteps)
+            losses.append(diffusion_loss(model_pred, target, timesteps, self.noise_scheduler, snr_gamma))
+        return torch.stack(losses).mean()
+
+
+class SmoothedLoss:
+    """Bias-corrected exponential moving average of the training loss"""
+
+    def __init__(self, beta=0.98):
+        self.beta = beta
+        self.average = 0.0
+        self.count = 0
+
+    def update(self, loss):
+        self.count += 1
+        self.average = self.beta * self.average + (1 - self.beta) * loss
+        return self.value
+
+    @property
+    def value(self):
+        if not self.count:
+            return None
+        return self.average / (1 - self.beta ** self.count)
+
+    def state_dict(self):
+        return {"average": self.average, "count": self.count}
+
+    def load_state_dict(self, state):
+        self.average = state["average"]
+        self.count = state["count"]
+
+
+class PlateauDetector:
+    """Signals a stop after patience checks without a min_delta relative improvement"""
+
+    def __init__(self, patience=3, min_delta=0.01, min_steps=0):
+        self.patience = patience
+        self.min_delta = min_delta
+        # Never stop before this step, however flat the start looks
+        self.min_steps = min_steps
+        self.best = None
+        self.best_step = None
+        self.checks_without_improvement = 0
+
+    def update(self, step, value):
+        """Record a check at step; True when training should stop"""
+        if self.best is None or value < self.best * (1 - self.min_delta):
+            self.best = value
+            self.best_step = step
+            self.checks_without_improvement = 0
+        else:
+            self.checks_without_improvement += 1
+        return (self.patience > 0 and step >= self.min_steps
+                and self.checks_without_improvement >= self.patience)
+
+    def state_dict(self):
+        return {"best": self.best, "best_step": self.best_step,
+                "checks_without_improvement": self.checks_without_improvement}
+
+    def load_state_dict(self, state):
+        self.best = state["best"]
+        self.best_step = state["best_step"]
+        self.checks_without_improvement = state["checks_without_improvement"]
@@ -0,0 +1,146 @@
+"""
+Content fingerprints of training images for MediaForge LoRA training
+
+Each source image is identified by the SHA-256 of its bytes and described
+by its size and a 64-bit difference hash (dHash) of its pixels. Images are
+decoded for hashing in a process pool, and fingerprints are kept in a JSON
+index keyed by content hash, so a retrained brand only decodes its new
+images. Files that fail to decode, exact duplicates and near-duplicates
+(dHashes within a small Hamming distance) are left out of training.
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from latent_cache import file_sha256
+
+
+def difference_hash(img, hash_size=8):
+    """64-bit dHash: whether each pixel is brighter than its right neighbour on a 9x8 thumbnail"""
+    pixels = list(img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS).getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def fingerprint_image(img_path):
+    """{"size": [width, height], "dhash": int}; raises if the image doesn't decode"""
+    with Image.open(img_path) as img:
+        size = list(img.size)
+        # JPEGs decode at a fraction of full size; the hash only needs a thumbnail
+        img.draft("RGB", (64, 64))
+        return {"size": size, "dhash": difference_hash(img)}
+
+
+def _fingerprint_or_error(img_path):
+    try:
+        return fingerprint_image(img_path), None
+    except Exception as e:
+        return None, str(e)
+
+
+class FingerprintIndex:
+    """JSON file of image fingerprints keyed by content hash"""
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.entries = {}
+        try:
+            with open(index_path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def get(self, content_hash):
+        return self.entries.get(content_hash)
+
+    def put(self, content_hash, fingerprint):
+        self.entries[content_hash] = fingerprint
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+        # Write-then-rename so an interrupted run never leaves a truncated index
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.index_path)
+
+
+def fingerprint_images(image_paths, index, num_workers=2):
+    """Fingerprint every image, decoding only content the index hasn't seen
+
+    Returns (images, stats): images is a list of {"path", "content_hash",
+    "size", "dhash"} for the files that decoded, in input order.
+    """
+    hashes = [file_sha256(path) for path in image_paths]
+    fingerprints = {content_hash: index.get(content_hash) for content_hash in hashes}
+    # One decode per distinct new content
+    todo = {}
+    for path, content_hash in zip(image_paths, hashes):
+        if fingerprints[content_hash] is None:
+            todo.setdefault(content_hash, path)
+
+    errors = {}
+    if todo:
+        if num_workers > 0 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=min(num_workers, len(todo))) as executor:
+                results = list(executor.map(_fingerprint_or_error, todo.values()))
+        else:
+            results = [_fingerprint_or_error(path) for path in todo.values()]
+        for (content_hash, path), (fingerprint, error) in zip(todo.items(), results):
+            if fingerprint is None:
+                print(f"Error processing {path}: {error}")
+                errors[content_hash] = error
+                continue
+            fingerprints[content_hash] = fingerprint
+            index.put(content_hash, fingerprint)
+        index.save()
+
+    images = []
+    for path, content_hash in zip(image_paths, hashes):
+        fingerprint = fingerprints[content_hash]
+        if fingerprint is not None:
+            images.append({"path": path, "content_hash": content_hash, **fingerprint})
+
+    stats = {
+        "reused": len(set(hashes)) - len(todo),
+        "decoded": len(todo) - len(errors),
+        "corrupt": sum(content_hash in errors for content_hash in hashes),
+    }
+    return images, stats
+
+
+def drop_duplicates(images, max_distance=4):
+    """Keep the first of each group of identical or near-identical images
+
+    Images whose dHashes differ in at most max_distance of 64 bits count as
+    near-duplicates; a negative max_distance drops exact duplicates only.
+    Returns (kept, dropped), dropped as (image, duplicate_of) pairs.
+    """
+    kept = []
+    dropped = []
+    seen = {}
+    for image in images:
+        original = seen.get(image["content_hash"])
+        if original is None and max_distance >= 0:
+            original = next(
+                (other for other in kept if hamming_distance(image["dhash"], other["dhash"]) <= max_distance),
+                None
+            )
+        if original is not None:
+            dropped.append((image, original))
+            continue
+        seen[image["content_hash"]] = image
+        kept.append(image)
+    return kept, dropped
@@ -0,0 +1,157 @@
+"""
+Precomputed latent and caption-embedding cache for LoRA training
+
+The VAE and both text encoders are frozen during LoRA training, so every
+training image is encoded to its latent distribution and every caption to
+SDXL prompt embeddings once, up front. Results are stored as .npy files
+and memory-mapped back during training, keyed by image content hash,
+training bucket and base model revision.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+
+def file_sha256(path, chunk_size=8 * 1024 * 1024):
+    """SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sample_latents(parameters, generator=None):
+    """Draw latents from stored distribution parameters (mean and logvar along dim 1)"""
+    mean, logvar = torch.chunk(parameters, 2, dim=1)
+    logvar = torch.clamp(logvar, -30.0, 20.0)
+    std = torch.exp(0.5 * logvar)
+    noise = torch.randn(mean.shape, generator=generator, device=mean.device, dtype=mean.dtype)
+    return mean + std * noise
+
+
+class LatentCache:
+    """On-disk, memory-mapped store of VAE latent distributions and caption embeddings"""
+
+    def __init__(self, cache_dir, model_revision):
+        self.cache_dir = cache_dir
+        self.model_revision = model_revision
+        # Entries found in / added to the cache, counted separately for image latents and captions
+        self.latent_hits = 0
+        self.latent_misses = 0
+        self.caption_hits = 0
+        self.caption_misses = 0
+        os.makedirs(os.path.join(cache_dir, "latents"), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, "captions"), exist_ok=True)
+
+    def _key(self, *parts):
+        text = "\0".join([self.model_revision, *[str(part) for part in parts]])
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def image_key(self, image_path, size, content_hash=None):
+        return self._key("image", content_hash or file_sha256(image_path), size)
+
+    def caption_key(self, caption):
+        return self._key("caption", caption)
+
+    def _path(self, kind, key, name):
+        return os.path.join(self.cache_dir, kind, f"{key}.{name}.npy")
+
+    def _save(self, path, array):
+        # Write-then-rename so an interrupted run never leaves a truncated entry
+        tmp_path = f"{path}.tmp.npy"
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)
+
+    def _load(self, path):
+        try:
+            return np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+
+    def latents_path(self, key):
+        return self._path("latents", key, "dist")
+
+    def time_ids_path(self, key):
+        return self._path("latents", key, "time_ids")
+
+    def load_latents(self, key):
+        """Memory-mapped latent distribution parameters, or None if not cached"""
+        if not os.path.exists(self.time_ids_path(key)):
+            return None
+        return self._load(self.latents_path(key))
+
+    def missing_latents(self, keys):
+        """Indices of keys with no usable cached latents; updates the latent hit/miss counts"""
+        missing = [i for i, key in enumerate(keys) if self.load_latents(key) is None]
+        self.latent_hits += len(keys) - len(missing)
+        self.latent_misses += len(missing)
+        return missing
+
+    def save_latents(self, key, parameters, time_ids):
+        array = parameters.detach().to("cpu", torch.float16).numpy()
+        self._save(self.latents_path(key), array)
+        # Written last: its presence marks a complete entry
+        self._save(self.time_ids_path(key), time_ids.detach().to("cpu", torch.float32).numpy())
+        return self.load_latents(key)
+
+    def load_caption(self, key):
+        """(prompt_embeds, pooled_prompt_embeds) arrays, or None if not cached"""
+        prompt_embeds = self._load(self._path("captions", key, "prompt_embeds"))
+        pooled = self._load(self._path("captions", key, "pooled_prompt_embeds"))
+        if prompt_embeds is None or pooled is None:
+            return None
+        return prompt_embeds, pooled
+
+    def save_caption(self, key, prompt_embeds, pooled_prompt_embeds):
+        self._save(self._path("captions", key, "prompt_embeds"),
+                   prompt_embeds.detach().to("cpu", torch.float16).numpy())
+        self._save(self._path("captions", key, "pooled_prompt_embeds"),
+                   pooled_prompt_embeds.detach().to("cpu", torch.float16).numpy())
+        return self.load_caption(key)
+
+
+def encode_caption(tokenizers, text_encoders, caption, device):
+    """SDXL prompt embeddings: penultimate hidden states of both encoders, pooled from the second"""
+    embeds = []
+    pooled = None
+    with torch.no_grad():
+        for tokenizer, text_encoder in zip(tokenizers, text_encoders):
+            input_ids = tokenizer(
+                caption,
+                padding="max_length",
+                max_length=77,
+                truncation=True,
+                return_tensors="pt"
+            ).input_ids.to(device)
+            output = text_encoder(input_ids, output_hidden_states=True)
+            pooled = output[0]
+            embeds.append(output.hidden_states[-2])
+    return torch.cat(embeds, dim=-1), pooled
+
+
+def cache_captions(cache, captions, tokenizers, text_encoders, device):
+    """Encode each distinct caption once; returns {caption: (prompt_embeds, pooled) arrays}"""
+    cached = {}
+    for caption in dict.fromkeys(captions):
+        key = cache.caption_key(caption)
+        entry = cache.load_caption(key)
+        if entry is None:
+            cache.caption_misses += 1
+            prompt_embeds, pooled = encode_caption(tokenizers, text_encoders, caption, device)
+            entry = cache.save_caption(key, prompt_embeds, pooled)
+        else:
+            cache.caption_hits += 1
+        cached[caption] = entry
+    return cached
+
+
+def cache_latents(cache, keys, pixels, time_ids, vae):
+    """Encode a batch of images in [-1, 1] and store each one's latent distribution and time ids"""
+    with torch.no_grad():
+        parameters = vae.encode(pixels).latent_dist.parameters
+    for key, image_parameters, image_time_ids in zip(keys, parameters, time_ids):
+        cache.save_latents(key, image_parameters, image_time_ids)
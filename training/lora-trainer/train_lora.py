@@ -2,95 +2,223 @@
 """
 LoRA training script for MediaForge brand styles
 Runs on Vertex AI Training with GPU
+
+Trains one brand, or with --jobs a queue of brands in turn on a single
+loaded base model, each as its own named LoRA adapter.
+
+Data-parallel when started with `accelerate launch --num_processes N` (or
+`ACCELERATE_USE_CPU=1 torchrun --nproc_per_node N` for CPU processes over
+gloo); each process trains on its own shard of --batch_size batches and
+only the main process saves, uploads and reports status.
 """
 
 import argparse
+import contextlib
 import os
+import re
+import resource
+import sys
+import traceback
 import torch
 from diffusers import StableDiffusionXLPipeline, UNet2DConditionModel
-from peft import LoraConfig, get_peft_model, TaskType, PeftModel
-from google.cloud import storage
-from PIL import Image
+from diffusers.utils import is_xformers_available
+from peft import LoraConfig, get_peft_model, get_peft_model_state_dict, TaskType, PeftModel
 import json
+import time
 from pathlib import Path
 from transformers import CLIPTextModel, CLIPTextModelWithProjection
 from accelerate import Accelerator
 import numpy as np
 from tqdm import tqdm
 
-def parse_args():
+from brand_status import ProgressReporter, update_brand_status
+from checkpointing import CheckpointManager, run_fingerprint
+from convergence import (
+    PlateauDetector, SmoothedLoss, ValidationLatents, default_train_steps, diffusion_loss, make_noise_scheduler,
+    sample_timesteps, training_target
+)
+from gcs_transfer import IMAGE_SUFFIXES, GCSTransfer, default_transfer, parse_gcs_uri
+from image_index import FingerprintIndex, drop_duplicates, fingerprint_images
+from instrumentation import Instrumentation, StepProfiler
+from lora_export import EXPORT_DTYPES, EXPORT_WEIGHT_NAME, export_lora, peft_to_diffusers
+from latent_cache import LatentCache, cache_captions, cache_latents, sample_latents
+from training_data import (
+    BatchStream, BrandImageDataset, BucketBatchSampler, DevicePrefetcher, LatentDataset, assign_bucket,
+    make_buckets, make_loader, to_model_input
+)
+
+MODEL_ID = "stabilityai/stable-diffusion-xl-base-1.0"
+OUTPUT_DIR = "/tmp/lora_output"
+# Distinct, readable images a brand needs to train on
+MIN_TRAINING_IMAGES = 10
+
+# Required for every brand, from the command line or each --jobs entry
+BRAND_SETTINGS = ("brand_id", "brand_name", "input_bucket", "input_path", "output_bucket", "output_path")
+# Fixed for a whole queue by the one base model and accelerator it shares
+QUEUE_SETTINGS = ("jobs", "pretrained_model_name_or_path", "revision", "mixed_precision", "memory_mode",
+                  "image_dir", "checkpoint_dir", "metrics_file")
+
+# default: fastest. low: gradient checkpointing, memory-efficient attention, frozen
+# modules in half precision and off the device. min: low plus 8-bit AdamW
+MEMORY_MODES = ("default", "low", "min")
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Train LoRA for brand style")
-    parser.add_argument("--brand_id", type=str, required=True)
-    parser.add_argument("--brand_name", type=str, required=True)
-    parser.add_argument("--input_bucket", type=str, required=True)
-    parser.add_argument("--input_path", type=str, required=True)
-    parser.add_argument("--output_bucket", type=str, required=True)
-    parser.add_argument("--output_path", type=str, required=True)
+    parser.add_argument("--brand_id", type=str)
+    parser.add_argument("--brand_name", type=str)
+    parser.add_argument("--input_bucket", type=str)
+    parser.add_argument("--input_path", type=str)
+    parser.add_argument("--output_bucket", type=str)
+    parser.add_argument("--output_path", type=str)
+    parser.add_argument("--user_id", type=str, default=None,
+                        help="Owner of the brand; when set, the brand's Firestore status is kept up to date")
+    parser.add_argument("--progress_interval", type=float, default=10.0,
+                        help="Seconds between training progress updates to the brand's Firestore document")
+    parser.add_argument("--jobs", type=str, default=None,
+                        help="JSONL of brand jobs (local or gs://) to train in turn on one loaded base model; "
+                             "each line overrides the arguments above for one brand")
     parser.add_argument("--num_images", type=int, default=20)
-    parser.add_argument("--max_train_steps", type=int, default=500)
+    parser.add_argument("--max_train_steps", type=int, default=None,
+                        help="Step budget (default: derived from the number of images, batch size and LoRA rank)")
     parser.add_argument("--learning_rate", type=float, default=1e-4)
     parser.add_argument("--rank", type=int, default=16, help="LoRA rank")
+    parser.add_argument("--export_rank", type=int, default=None,
+                        help="Truncate the exported adapter to this rank by SVD (default: the trained rank)")
+    parser.add_argument("--export_dtype", choices=EXPORT_DTYPES, default="fp16",
+                        help="Precision of the exported adapter; int8 stores per-row scales and is dequantized on load")
     parser.add_argument("--batch_size", type=int, default=1)
     parser.add_argument("--gradient_accumulation_steps", type=int, default=4)
     parser.add_argument("--mixed_precision", type=str, default="fp16")
+    parser.add_argument("--memory_mode", choices=MEMORY_MODES, default="default",
+                        help="Trade speed for device memory, e.g. to fit a higher rank or batch size on a T4")
     parser.add_argument("--seed", type=int, default=42)
-    return parser.parse_args()
-
-def download_training_images(bucket_name, path_prefix, local_dir="/tmp/training_images"):
+    parser.add_argument("--snr_gamma", type=float, default=None,
+                        help="Weight the loss by min(SNR, gamma) / SNR (min-SNR; 5.0 is typical)")
+    parser.add_argument("--validation_steps", type=int, default=50,
+                        help="Check for a loss plateau every this many steps (0 disables early stopping)")
+    parser.add_argument("--validation_images", type=int, default=4,
+                        help="Cached latents in the fixed validation set (0: use the smoothed training loss)")
+    parser.add_argument("--early_stopping_patience", type=int, default=3,
+                        help="Stop after this many checks without improvement (0 disables)")
+    parser.add_argument("--early_stopping_min_delta", type=float, default=0.01,
+                        help="Relative loss improvement a check needs to count as progress")
+    parser.add_argument("--pretrained_model_name_or_path", type=str, default=MODEL_ID)
+    parser.add_argument("--revision", type=str, default=None, help="Base model revision")
+    parser.add_argument("--resolution", type=int, default=1024,
+                        help="Base resolution; images are bucketed by aspect ratio at about this many pixels squared")
+    parser.add_argument("--latent_cache_dir", type=str, default="/tmp/latent_cache",
+                        help="Where image fingerprints, precomputed latents and caption embeddings are kept "
+                             "(e.g. a /gcs/ bucket mount to reuse them across jobs)")
+    parser.add_argument("--dedup_distance", type=int, default=4,
+                        help="Drop images whose 64-bit perceptual hash is within this many bits of an earlier "
+                             "image's (-1 drops exact duplicates only)")
+    parser.add_argument("--dataloader_num_workers", type=int, default=min(4, os.cpu_count() or 1),
+                        help="Worker processes decoding images")
+    parser.add_argument("--encode_batch_size", type=int, default=4,
+                        help="Images per VAE call when precomputing latents")
+    parser.add_argument("--checkpointing_steps", type=int, default=100,
+                        help="Save a resumable checkpoint every N steps (0 disables)")
+    parser.add_argument("--checkpoint_dir", type=str, default="/tmp/lora_checkpoints")
+    parser.add_argument("--checkpoints_total_limit", type=int, default=2,
+                        help="Checkpoints kept on local disk")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue from the latest checkpoint on local disk or in the output bucket written with "
+                             "the same images and settings; checkpoints are deleted once a run completes")
+    parser.add_argument("--metrics_file", type=str, default="",
+                        help="Write stage and per-step timings as JSON lines here ('-' for stdout; "
+                             "default $MEDIAFORGE_METRICS_FILE)")
+    parser.add_argument("--profile_steps", type=int, default=0,
+                        help="Record a torch.profiler trace of this many training steps")
+    parser.add_argument("--profile_dir", type=str, default="/tmp/lora_profile")
+    parser.add_argument("--image_dir", type=str, default="/tmp/training_images",
+                        help="Where training images are downloaded")
+    args = parser.parse_args(argv)
+    if not args.jobs:
+        missing = [name for name in BRAND_SETTINGS if not getattr(args, name)]
+        if missing:
+            parser.error("the following arguments are required without --jobs: "
+                         + ", ".join(f"--{name}" for name in missing))
+    return args
+
+def download_training_images(bucket_name, path_prefix, local_dir="/tmp/training_images", transfer=None):
     """Download training images from Cloud Storage"""
-    os.makedirs(local_dir, exist_ok=True)
-
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
-
-    image_paths = []
-    blobs = bucket.list_blobs(prefix=path_prefix)
+    transfer = transfer or default_transfer()
 
     print(f"Downloading training images from gs://{bucket_name}/{path_prefix}")
+    start_time = time.time()
 
-    for blob in blobs:
-        if blob.name.lower().endswith(('.jpg', '.jpeg', '.png')):
-            local_path = os.path.join(local_dir, os.path.basename(blob.name))
-            blob.download_to_filename(local_path)
-            image_paths.append(local_path)
-            print(f"Downloaded: {blob.name}")
-
-    return image_paths
-
-def prepare_dataset(image_paths, size=1024):
-    """Prepare and preprocess training images"""
-    dataset = []
-
-    for img_path in image_paths:
-        try:
-            img = Image.open(img_path).convert("RGB")
-            # Resize to training size
-            img = img.resize((size, size), Image.Resampling.LANCZOS)
-            # Convert to tensor
-            img_tensor = torch.from_numpy(np.array(img)).float() / 127.5 - 1.0
-            img_tensor = img_tensor.permute(2, 0, 1)
-            dataset.append(img_tensor)
-        except Exception as e:
-            print(f"Error processing {img_path}: {e}")
+    image_paths = transfer.download_prefix(bucket_name, path_prefix, local_dir, suffixes=IMAGE_SUFFIXES)
 
-    return torch.stack(dataset)
+    stats = transfer.summary("download")
+    print(f"Downloaded {len(image_paths)} images in {time.time() - start_time:.2f}s "
+          f"({stats['transferred']} fetched, {stats['skipped']} unchanged, "
+          f"{stats['bytes'] / 1e6:.1f} MB, {stats['retries']} retries)")
 
-def setup_lora_model(model_id="stabilityai/stable-diffusion-xl-base-1.0", rank=16):
-    """Setup SDXL with LoRA configuration"""
+    return image_paths
 
-    print("Loading SDXL base model...")
-    pipe = StableDiffusionXLPipeline.from_pretrained(
-        model_id,
-        torch_dtype=torch.float16,
-        use_safetensors=True,
-        variant="fp16"
+def select_images(image_paths, args):
+    """Fingerprint the downloaded images and drop corrupt files and duplicates
+
+    Returns the kept images (see image_index.fingerprint_images) and counts.
+    """
+    index = FingerprintIndex(os.path.join(args.latent_cache_dir, "fingerprints.json"))
+    images, stats = fingerprint_images(image_paths, index, num_workers=args.dataloader_num_workers)
+    images, dropped = drop_duplicates(images, max_distance=args.dedup_distance)
+    for image, original in dropped:
+        print(f"Skipping {image['path']}: duplicate of {original['path']}")
+    stats["duplicates"] = len(dropped)
+    stats["kept"] = len(images)
+    print(f"Images: {stats['kept']} kept, {stats['duplicates']} duplicates and {stats['corrupt']} unreadable "
+          f"dropped ({stats['reused']} fingerprints reused, {stats['decoded']} new)")
+    return images, stats
+
+def prepare_dataset(images, cache, vae, device, args):
+    """Stream images through the VAE into the latent cache
+
+    Returns a LatentDataset over the cached entries and each entry's bucket.
+    """
+    bucket_choices = make_buckets(args.resolution)
+
+    entries = []
+    for image in images:
+        bucket = assign_bucket(image["size"], bucket_choices)
+        entries.append((image["path"], bucket, cache.image_key(image["path"], bucket, image["content_hash"])))
+
+    keys = [key for _, _, key in entries]
+    missing = cache.missing_latents(keys)
+
+    if missing:
+        # Workers decode and resize as uint8 while the VAE encodes the previous batch
+        missing_buckets = [entries[i][1] for i in missing]
+        loader = make_loader(
+            BrandImageDataset([entries[i][0] for i in missing], missing_buckets),
+            BucketBatchSampler(missing_buckets, batch_size=args.encode_batch_size),
+            num_workers=args.dataloader_num_workers
+        )
+        vae_dtype = next(vae.parameters()).dtype
+        for batch in DevicePrefetcher(loader, device):
+            batch_keys = [keys[missing[i]] for i in batch["index"].tolist()]
+            pixels = to_model_input(batch["pixels"], vae_dtype)
+            cache_latents(cache, batch_keys, pixels, batch["time_ids"], vae)
+
+    # Images that failed to decode have no latents and are left out
+    cached = [(bucket, key) for _, bucket, key in entries if cache.load_latents(key) is not None]
+    dataset = LatentDataset(
+        [cache.latents_path(key) for _, key in cached],
+        [cache.time_ids_path(key) for _, key in cached]
     )
+    buckets = [bucket for bucket, _ in cached]
+
+    counts = {}
+    for bucket in buckets:
+        counts[bucket] = counts.get(bucket, 0) + 1
+    print("Buckets: " + ", ".join(f"{w}x{h}: {n}" for (w, h), n in sorted(counts.items())))
 
-    # Configure LoRA for UNet
-    unet = pipe.unet
+    return dataset, buckets
 
-    # LoRA configuration
-    lora_config = LoraConfig(
+def lora_config(rank):
+    """LoRA configuration for the SDXL UNet attention layers"""
+    return LoraConfig(
         r=rank,
         lora_alpha=rank,
         target_modules=[
@@ -100,176 +228,612 @@ def setup_lora_model(model_id="stabilityai/stable-diffusion-xl-base-1.0", rank=1
         lora_dropout=0.1,
     )
 
+def export_adapter(model, adapter_name, path, rank=None, dtype="fp16"):
+    """Write one trained adapter as a single diffusers-loadable file; returns its export metadata"""
+    config = model.peft_config[adapter_name]
+    state_dict = get_peft_model_state_dict(model, adapter_name=adapter_name)
+    return export_lora(peft_to_diffusers(state_dict), path, lora_scale=config.lora_alpha / config.r,
+                       rank=rank, dtype=dtype)
+
+def setup_lora_model(model_id=MODEL_ID, rank=16, revision=None):
+    """Setup SDXL with LoRA configuration"""
+
+    print("Loading SDXL base model...")
+    pipe = StableDiffusionXLPipeline.from_pretrained(
+        model_id,
+        revision=revision,
+        torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+        use_safetensors=True,
+        variant="fp16" if torch.cuda.is_available() else None
+    )
+
     # Apply LoRA to UNet
-    unet = get_peft_model(unet, lora_config)
+    unet = get_peft_model(pipe.unet, lora_config(rank))
+
+    # Keep the trainable LoRA weights in fp32; fp16 grads can't be unscaled
+    for param in unet.parameters():
+        if param.requires_grad:
+            param.data = param.data.float()
 
     print(f"LoRA model configured with rank {rank}")
     print(f"Trainable parameters: {unet.num_parameters(only_trainable=True):,}")
 
     return pipe, unet
 
-def train_lora(args):
-    """Main training function"""
+def enable_memory_savings(pipe, memory_mode):
+    """Recompute UNet activations in the backward pass and use memory-efficient attention"""
+    if memory_mode == "default":
+        return
+    pipe.unet.enable_gradient_checkpointing()
+    if torch.cuda.is_available() and is_xformers_available():
+        pipe.unet.enable_xformers_memory_efficient_attention()
+        attention = "xformers"
+    else:
+        # diffusers already uses PyTorch's fused scaled_dot_product_attention
+        attention = "sdpa"
+    # Encode latents one image at a time
+    pipe.vae.enable_slicing()
+    print(f"Memory mode {memory_mode}: gradient checkpointing, {attention} attention")
+
+def make_optimizer(params, args):
+    """AdamW over the trainable LoRA weights; 8-bit (bitsandbytes) in --memory_mode min when available"""
+    optimizer_class = torch.optim.AdamW
+    if args.memory_mode == "min":
+        try:
+            import bitsandbytes as bnb
+        except ImportError:
+            bnb = None
+        if bnb is not None and torch.cuda.is_available():
+            optimizer_class = bnb.optim.AdamW8bit
+        else:
+            print("8-bit AdamW needs bitsandbytes and CUDA; using torch AdamW")
+    return optimizer_class(
+        params,
+        lr=args.learning_rate,
+        betas=(0.9, 0.999),
+        weight_decay=1e-2,
+        eps=1e-8
+    )
+
+def reset_peak_memory(device):
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+def peak_memory_mb(device):
+    """Peak device memory allocated since reset_peak_memory(); peak process RSS on CPU"""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 1e6
+    # Linux reports kilobytes, macOS bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+class SharedBaseModel:
+    """SDXL loaded once per process and shared by every brand trained in it
+
+    The UNet carries one named LoRA adapter per brand being trained; the
+    base weights, VAE and text encoders are never reloaded. Each brand's
+    use_adapter() is paired with a release() once that brand is done.
+    """
+
+    def __init__(self, args, accelerator):
+        self.args = args
+        self.accelerator = accelerator
+        self.pipe = None
+        self.model = None
+        # The accelerate-prepared BrandUNet of the brand in training, if any
+        self.prepared = None
+        # Each brand starts from the same loss scale, wherever it sits in the queue
+        self._scaler_state = accelerator.scaler.state_dict() if accelerator.scaler is not None else None
+
+    def load(self, metrics):
+        """Load the base model on first use; returns (pipe, unwrapped unet)"""
+        if self.pipe is None:
+            with metrics.span("model_load", model_id=self.args.pretrained_model_name_or_path):
+                pipe, unet = setup_lora_model(
+                    self.args.pretrained_model_name_or_path, rank=self.args.rank, revision=self.args.revision
+                )
+                enable_memory_savings(pipe, self.args.memory_mode)
+            self.pipe = pipe
+            self.model = unet.to(self.accelerator.device)
+        return self.pipe, self.model
+
+    def use_adapter(self, adapter_name, rank, seed):
+        """Make adapter_name the UNet's only LoRA adapter and its only trainable weights; returns the prepared UNet"""
+        model = self.model
+        if adapter_name not in model.peft_config:
+            # Same initialization as a brand trained on its own
+            torch.manual_seed(seed)
+            model.add_adapter(adapter_name, lora_config(rank))
+        model.set_adapter(adapter_name)
+
+        # Previous brands' adapters are already uploaded
+        for name in [name for name in model.peft_config if name != adapter_name]:
+            model.base_model.delete_adapter(name)
+
+        for param in model.parameters():
+            if param.requires_grad:
+                param.data = param.data.float()
+
+        if self._scaler_state is not None:
+            self.accelerator.scaler.load_state_dict(self._scaler_state)
+
+        # DDP registers the parameters it synchronizes when it wraps the model, and
+        # accelerate wraps the forward of (and only once prepares) whatever it is
+        # given; a fresh BrandUNet per brand gets its own wrappers and leaves the
+        # shared UNet untouched
+        self.release()
+        self.prepared = self.accelerator.prepare(BrandUNet(model))
+        return self.prepared
+
+    def release(self):
+        """Drop the brand's prepared UNet (DDP and mixed-precision wrappers) once it is done"""
+        self.prepared = None
+
+class BrandUNet(torch.nn.Module):
+    """One brand's handle on the shared UNet, prepared by accelerate in its place"""
+
+    def __init__(self, unet):
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, *args, **kwargs):
+        return self.unet(*args, **kwargs)
+
+def adapter_name_for(brand_id):
+    """PEFT adapter names become module attributes; keep them identifier-safe"""
+    return "brand_" + re.sub(r"\W", "_", brand_id)
+
+def load_jobs(jobs_path, args, transfer):
+    """Per-brand argument namespaces from a JSONL (or JSON list) jobs file, local or gs://
+
+    Each job overrides this run's arguments for one brand, e.g.
+    {"brand_id": ..., "brand_name": ..., "user_id": ..., "input_path": ..., "output_path": ...}
+    """
+    if jobs_path.startswith("gs://"):
+        bucket_name, blob_name = parse_gcs_uri(jobs_path)
+        local_path = os.path.join("/tmp", os.path.basename(blob_name) or "lora_jobs.jsonl")
+        transfer.download(bucket_name, blob_name, local_path)
+        jobs_path = local_path
+
+    with open(jobs_path) as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        jobs = json.loads(text)
+    else:
+        jobs = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    job_args = []
+    for index, job in enumerate(jobs, 1):
+        unknown = sorted(set(job) - set(vars(args)))
+        if unknown:
+            raise ValueError(f"Job {index}: unknown settings {unknown}")
+        shared = sorted(set(job) & set(QUEUE_SETTINGS))
+        if shared:
+            raise ValueError(f"Job {index}: {shared} apply to the whole queue and can't be set per brand")
+        brand_args = argparse.Namespace(**{**vars(args), **job})
+        missing = [name for name in BRAND_SETTINGS if not getattr(brand_args, name)]
+        if missing:
+            raise ValueError(f"Job {index}: missing {missing}")
+        # Brands must not share downloaded images or checkpoints
+        brand_args.image_dir = os.path.join(args.image_dir, brand_args.brand_id)
+        brand_args.checkpoint_dir = os.path.join(args.checkpoint_dir, brand_args.brand_id)
+        job_args.append(brand_args)
+    return job_args
+
+def train_lora(args, transfer=None):
+    """Main training function; returns the training metadata"""
+
+    # Initialize accelerator for distributed training; train_brand() accumulates gradients itself
+    accelerator = Accelerator(mixed_precision=args.mixed_precision)
+
+    # One storage client for every download and upload in this run
+    transfer = transfer or GCSTransfer()
+    return run_brand(args, SharedBaseModel(args, accelerator), transfer)
+
+def train_queue(args, transfer=None):
+    """Train every brand in --jobs in turn on one loaded base model; returns per-brand results"""
+    accelerator = Accelerator(mixed_precision=args.mixed_precision)
+    transfer = transfer or GCSTransfer()
+    jobs = load_jobs(args.jobs, args, transfer)
+    base = SharedBaseModel(args, accelerator)
+
+    print(f"Training {len(jobs)} brands on one base model")
+    queue_start_time = time.time()
+    results = []
+    for index, brand_args in enumerate(jobs, 1):
+        print(f"=== Brand {index}/{len(jobs)}: {brand_args.brand_name} ({brand_args.brand_id}) ===")
+        start_time = time.time()
+        result = {"brand_id": brand_args.brand_id, "brand_name": brand_args.brand_name}
+        try:
+            metadata = run_brand(brand_args, base, transfer, adapter_name=adapter_name_for(brand_args.brand_id))
+        except Exception as e:
+            # One brand's bad data shouldn't stop the rest of the queue
+            traceback.print_exc()
+            result.update(status="failed", error=str(e))
+        else:
+            result.update(status="completed", model_path=metadata["model_path"])
+        finally:
+            # Drop this brand's prepared UNet and optimizer state before the next one
+            base.release()
+            accelerator.free_memory()
+        result["seconds"] = time.time() - start_time
+        results.append(result)
+        print(f"Brand {brand_args.brand_id} {result['status']} in {result['seconds']:.2f} seconds")
+
+    completed = sum(result["status"] == "completed" for result in results)
+    print(f"Queue finished: {completed}/{len(results)} brands trained in "
+          f"{time.time() - queue_start_time:.2f} seconds")
+    return results
+
+def run_brand(args, base, transfer, adapter_name="default"):
+    """Train one brand, keeping its Firestore status in step when --user_id is set"""
+    # Status and progress updates come from the main process only
+    report = args.user_id and base.accelerator.is_main_process
+    progress = None
+    if report:
+        update_brand_status(args.brand_id, args.user_id, "training")
+        progress = ProgressReporter(args.brand_id, args.user_id, interval=args.progress_interval)
+    try:
+        metadata = train_brand(args, base, transfer, adapter_name, progress=progress)
+    except Exception:
+        if report:
+            progress.close()
+            update_brand_status(args.brand_id, args.user_id, "failed")
+        raise
+    if report:
+        progress.close()
+        update_brand_status(args.brand_id, args.user_id, "ready", metadata["model_path"])
+    return metadata
+
+def train_brand(args, base, transfer, adapter_name="default", progress=None):
+    """Train and upload one brand's LoRA as adapter_name on the shared base model
+
+    progress, when given, is a ProgressReporter fed the step and smoothed loss.
+    """
 
     # Set random seed
     torch.manual_seed(args.seed)
     np.random.seed(args.seed)
 
-    # Initialize accelerator for distributed training
-    accelerator = Accelerator(
-        gradient_accumulation_steps=args.gradient_accumulation_steps,
-        mixed_precision=args.mixed_precision
-    )
-
-    # Download training images
-    image_paths = download_training_images(
-        args.input_bucket,
-        args.input_path
-    )
-
-    if len(image_paths) < 10:
-        raise ValueError(f"Not enough training images. Found {len(image_paths)}, need at least 10.")
+    accelerator = base.accelerator
+    context = {"brand_id": args.brand_id}
+    if accelerator.is_main_process:
+        metrics = Instrumentation.from_env("lora-trainer", sink=args.metrics_file, context=context)
+    else:
+        # Other ranks keep their stage timings in memory
+        metrics = Instrumentation("lora-trainer", context=dict(context, process_index=accelerator.process_index))
+
+    # Download training images (once per machine; the other ranks then find them unchanged)
+    with metrics.span("download") as span, accelerator.local_main_process_first():
+        image_paths = download_training_images(
+            args.input_bucket,
+            args.input_path,
+            local_dir=args.image_dir,
+            transfer=transfer
+        )
+        span["images"] = len(image_paths)
+
+    if len(image_paths) < MIN_TRAINING_IMAGES:
+        raise ValueError(f"Not enough training images. Found {len(image_paths)}, "
+                         f"need at least {MIN_TRAINING_IMAGES}.")
 
     print(f"Found {len(image_paths)} training images")
 
-    # Prepare dataset
-    dataset = prepare_dataset(image_paths)
+    # Same content is only decoded once; repeats and near-repeats aren't trained on twice
+    with metrics.span("image_filter") as span, accelerator.local_main_process_first():
+        images, image_stats = select_images(image_paths, args)
+        span.update(image_stats)
 
-    # Setup model
-    pipe, unet = setup_lora_model(rank=args.rank)
+    if len(images) < MIN_TRAINING_IMAGES:
+        raise ValueError(f"Not enough usable training images. {len(images)} of {len(image_paths)} remain after "
+                         f"dropping {image_stats['duplicates']} duplicates and {image_stats['corrupt']} "
+                         f"unreadable files, need at least {MIN_TRAINING_IMAGES}.")
+
+    # Setup model (loaded once per process; each brand gets its own adapter)
+    pipe, model = base.load(metrics)
+    unet = base.use_adapter(adapter_name, args.rank, args.seed)
+    if accelerator.num_processes > 1:
+        # DDP starts every rank from rank 0's adapter weights; each rank draws its own noise
+        torch.manual_seed(args.seed + accelerator.process_index)
 
-    # Move to device
     device = accelerator.device
-    unet = unet.to(device)
-    vae = pipe.vae.to(device)
-    text_encoder = pipe.text_encoder.to(device)
-    text_encoder_2 = pipe.text_encoder_2.to(device)
-
-    # Setup optimizer
-    optimizer = torch.optim.AdamW(
-        unet.parameters(),
-        lr=args.learning_rate,
-        betas=(0.9, 0.999),
-        weight_decay=1e-2,
-        eps=1e-8
+    weight_dtype = model.dtype
+
+    # Encode every image and the caption once; the VAE and text encoders are frozen
+    print("Precomputing latents and caption embeddings...")
+    cache = LatentCache(
+        args.latent_cache_dir,
+        model_revision=f"{args.pretrained_model_name_or_path}@{args.revision or 'main'}"
     )
 
+    # The SDXL VAE overflows in fp16, so encode in fp32. The local main process
+    # fills the cache first so the other ranks on the machine only read it
+    with metrics.span("latent_precompute") as span, accelerator.local_main_process_first():
+        vae = pipe.vae.to(device, dtype=torch.float32)
+        dataset, buckets = prepare_dataset(images, cache, vae, device, args)
+        span.update(reused=cache.latent_hits, encoded=cache.latent_misses)
+    scaling_factor = vae.config.scaling_factor
+    # Noised on the base model's own schedule
+    noise_scheduler = make_noise_scheduler(pipe.scheduler.config)
+    if args.memory_mode != "default":
+        # Off the device, and back to the base model's precision, before the text encoders load
+        vae.to("cpu", dtype=weight_dtype)
+
+    caption = f"A {args.brand_name} style illustration"
+    with metrics.span("caption_encode") as span, accelerator.local_main_process_first():
+        text_encoders = [pipe.text_encoder.to(device), pipe.text_encoder_2.to(device)]
+        captions = cache_captions(cache, [caption], [pipe.tokenizer, pipe.tokenizer_2], text_encoders, device)
+        span.update(reused=cache.caption_hits, encoded=cache.caption_misses)
+
+    print(f"Latent cache: image latents {cache.latent_hits} reused, {cache.latent_misses} new; "
+          f"caption embeddings {cache.caption_hits} reused, {cache.caption_misses} new; "
+          f"{len(dataset)} images usable")
+
+    # Free the frozen models from device memory for the training loop
+    vae.to("cpu")
+    for text_encoder in text_encoders:
+        text_encoder.to("cpu")
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    prompt_embeds = torch.from_numpy(np.array(captions[caption][0])).to(device, dtype=weight_dtype)
+    pooled_prompt_embeds = torch.from_numpy(np.array(captions[caption][1])).to(device, dtype=weight_dtype)
+
+    # Setup optimizer over this brand's adapter only
+    optimizer = make_optimizer([param for param in unet.parameters() if param.requires_grad], args)
+
     # Prepare for training
-    unet, optimizer = accelerator.prepare(unet, optimizer)
+    optimizer = accelerator.prepare(optimizer)
 
-    # Training loop
-    print(f"Starting training for {args.max_train_steps} steps...")
-    progress_bar = tqdm(range(args.max_train_steps), desc="Training")
+    # Cached latents stream from disk; the next batch is staged while this step runs.
+    # Each process trains on its own shard of every epoch's batches
+    sampler = BucketBatchSampler(buckets, batch_size=args.batch_size, shuffle=True, seed=args.seed,
+                                 num_replicas=accelerator.num_processes, rank=accelerator.process_index)
+    loader = make_loader(dataset, sampler, num_workers=args.dataloader_num_workers)
+    batches = BatchStream(loader, device)
 
-    unet.train()
+    # Unless given, the budget is a number of passes over this process's shard
+    max_train_steps = args.max_train_steps or default_train_steps(len(sampler), args.rank)
 
-    for step in progress_bar:
-        # Get batch of images
-        batch_idx = step % len(dataset)
-        batch = dataset[batch_idx:batch_idx+1].to(device)
-
-        # Encode images to latents
-        with torch.no_grad():
-            latents = vae.encode(batch).latent_dist.sample()
-            latents = latents * vae.config.scaling_factor
-
-        # Add noise
-        noise = torch.randn_like(latents)
-        timesteps = torch.randint(0, 1000, (1,), device=device)
-        noisy_latents = noise * timesteps / 1000 + latents * (1 - timesteps / 1000)
-
-        # Get text embeddings (using brand name as caption)
-        caption = f"A {args.brand_name} style illustration"
-        text_inputs = pipe.tokenizer(
-            caption,
-            padding="max_length",
-            max_length=77,
-            truncation=True,
-            return_tensors="pt"
-        ).to(device)
-
-        text_inputs_2 = pipe.tokenizer_2(
-            caption,
-            padding="max_length",
-            max_length=77,
-            truncation=True,
-            return_tensors="pt"
-        ).to(device)
-
-        with torch.no_grad():
-            text_embeddings = text_encoder(text_inputs.input_ids)[0]
-            text_embeddings_2 = text_encoder_2(text_inputs_2.input_ids)[0]
-            text_embeddings = torch.cat([text_embeddings, text_embeddings_2], dim=-1)
-
-        # Predict noise
-        model_pred = unet(
+    def predict(noisy_latents, timesteps, time_ids):
+        bsz = noisy_latents.shape[0]
+        return unet(
             noisy_latents,
             timesteps,
-            encoder_hidden_states=text_embeddings
+            encoder_hidden_states=prompt_embeds.expand(bsz, -1, -1),
+            added_cond_kwargs={
+                "text_embeds": pooled_prompt_embeds.expand(bsz, -1),
+                "time_ids": time_ids
+            }
         ).sample
 
-        # Calculate loss
-        loss = torch.nn.functional.mse_loss(model_pred, noise)
-
-        # Backprop
-        accelerator.backward(loss)
-
-        if (step + 1) % args.gradient_accumulation_steps == 0:
-            optimizer.step()
-            optimizer.zero_grad()
-
-        # Update progress bar
-        progress_bar.set_postfix({"loss": loss.item()})
-
-        # Save checkpoint every 100 steps
-        if (step + 1) % 100 == 0:
-            print(f"Checkpoint at step {step + 1}")
+    # Early stopping watches the loss on fixed validation latents, or the smoothed training loss
+    smoothed_loss = SmoothedLoss()
+    plateau = PlateauDetector(args.early_stopping_patience, args.early_stopping_min_delta,
+                              min_steps=max_train_steps // 4)
+    validation = None
+    if args.validation_steps and args.validation_images:
+        validation = ValidationLatents(dataset, noise_scheduler, args.validation_images, seed=args.seed)
+
+    def plateau_loss():
+        if validation is None:
+            value = torch.tensor(smoothed_loss.value, device=device)
+        else:
+            unet.eval()
+            value = validation.loss(predict, scaling_factor, device, weight_dtype, args.snr_gamma)
+            unet.train()
+        # Every rank decides on the same number
+        return accelerator.reduce(value.float(), reduction="mean").item()
+
+    # Checkpoints are written locally and mirrored under <output_path>/checkpoints/.
+    # --resume only picks up a checkpoint of this same data and configuration
+    fingerprint = run_fingerprint(
+        images=sorted(image["content_hash"] for image in images),
+        model=cache.model_revision,
+        **{name: getattr(args, name) for name in (
+            "brand_name", "resolution", "rank", "learning_rate", "batch_size", "gradient_accumulation_steps",
+            "seed", "snr_gamma", "memory_mode"
+        )},
+        max_train_steps=max_train_steps,
+        num_processes=accelerator.num_processes,
+    )
+    checkpoints = CheckpointManager(
+        args.checkpoint_dir,
+        total_limit=args.checkpoints_total_limit,
+        transfer=transfer,
+        bucket_name=args.output_bucket,
+        remote_prefix=args.output_path,
+        fingerprint=fingerprint
+    )
 
-    print("Training completed!")
+    start_step = 0
+    if args.resume:
+        # The main process fetches a remote checkpoint; the other ranks then read it locally
+        with accelerator.main_process_first():
+            state = checkpoints.restore(model, optimizer, accelerator.scaler)
+        if state is None:
+            print("No checkpoint found, starting from scratch")
+        else:
+            start_step = state["step"]
+            batches.load_state_dict(state["data"])
+            if state.get("progress"):
+                smoothed_loss.load_state_dict(state["progress"]["smoothed_loss"])
+                plateau.load_state_dict(state["progress"]["plateau"])
+            if accelerator.num_processes > 1:
+                # The checkpoint holds rank 0's RNG state; keep the ranks' noise distinct
+                torch.manual_seed(args.seed + accelerator.process_index + start_step * accelerator.num_processes)
 
-    # Save LoRA weights
-    print("Saving LoRA weights...")
-    output_dir = "/tmp/lora_output"
-    os.makedirs(output_dir, exist_ok=True)
+    # Training loop
+    effective_batch_size = args.batch_size * accelerator.num_processes * args.gradient_accumulation_steps
+    print(f"Starting training for up to {max_train_steps} steps "
+          f"({accelerator.num_processes} processes, effective batch size {effective_batch_size})...")
+    progress_bar = tqdm(range(start_step, max_train_steps), desc="Training",
+                        initial=start_step, total=max_train_steps,
+                        disable=not accelerator.is_local_main_process)
+    steps_completed = start_step
+    stop_reason = "max_train_steps"
 
-    # Save LoRA weights
-    unet_lora = accelerator.unwrap_model(unet)
-    unet_lora.save_pretrained(output_dir)
-
-    # Upload to Cloud Storage
-    client = storage.Client()
-    bucket = client.bucket(args.output_bucket)
-
-    # Upload the LoRA weights
-    for file_name in os.listdir(output_dir):
-        if file_name.endswith(('.bin', '.safetensors', '.json')):
-            local_path = os.path.join(output_dir, file_name)
-            blob_path = os.path.join(args.output_path, file_name)
-            blob = bucket.blob(blob_path)
-            blob.upload_from_filename(local_path)
-            print(f"Uploaded: {blob_path}")
+    unet.train()
+    reset_peak_memory(device)
+    train_start_time = time.time()
+
+    # Optional torch.profiler trace of the first few steps
+    with StepProfiler(args.profile_dir, steps=args.profile_steps) as profiler:
+        for step in progress_bar:
+            with metrics.span("train_step", step=step + 1) as span:
+                # Sample latents from the cached distribution of the next image
+                data_start = time.perf_counter()
+                batch = next(batches)
+                span["data_seconds"] = time.perf_counter() - data_start
+                parameters = batch["latent_params"].to(torch.float32)
+                latents = (sample_latents(parameters) * scaling_factor).to(weight_dtype)
+                bsz = latents.shape[0]
+
+                # SDXL micro-conditioning: original size, crop top-left, target size
+                add_time_ids = batch["time_ids"].to(weight_dtype)
+
+                # Add noise
+                noise = torch.randn_like(latents)
+                timesteps = sample_timesteps(noise_scheduler, bsz, device)
+                noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
+                target = training_target(noise_scheduler, latents, noise, timesteps)
+
+                # Gradients are only synchronized across processes, and the optimizer
+                # only steps, on accumulation boundaries; counted from step 0, so a
+                # resumed run keeps the same boundaries
+                sync = (step + 1) % args.gradient_accumulation_steps == 0
+                with contextlib.nullcontext() if sync else accelerator.no_sync(unet):
+                    # Predict noise
+                    model_pred = predict(noisy_latents, timesteps, add_time_ids)
+
+                    # Calculate loss
+                    loss = diffusion_loss(model_pred, target, timesteps, noise_scheduler, args.snr_gamma)
+
+                    # Backprop
+                    accelerator.backward(loss / args.gradient_accumulation_steps)
+                if sync:
+                    optimizer.step()
+                    optimizer.zero_grad()
+
+                # Update progress bar
+                span["loss"] = loss.item()
+                span["smoothed_loss"] = smoothed_loss.update(span["loss"])
+                progress_bar.set_postfix({"loss": span["smoothed_loss"]})
+                steps_completed = step + 1
+                if progress is not None:
+                    progress.report(steps_completed, max_train_steps, span["smoothed_loss"])
+
+                stop = False
+                if args.validation_steps and (step + 1) % args.validation_steps == 0:
+                    with metrics.span("plateau_check", step=step + 1) as check:
+                        check["loss"] = plateau_loss()
+                        stop = plateau.update(step + 1, check["loss"])
+
+                # Snapshot now; serialization and upload run in the background
+                if (args.checkpointing_steps and (step + 1) % args.checkpointing_steps == 0
+                        and accelerator.is_main_process):
+                    with metrics.span("checkpoint_snapshot", step=step + 1):
+                        checkpoints.save(step + 1, model, optimizer,
+                                         accelerator.scaler, batches.state_dict(),
+                                         progress={"smoothed_loss": smoothed_loss.state_dict(),
+                                                   "plateau": plateau.state_dict()})
+            profiler.step()
+            if stop:
+                stop_reason = "plateau"
+                print(f"Stopping at step {step + 1}: no improvement since step {plateau.best_step} "
+                      f"(best loss {plateau.best:.4f})")
+                break
+    progress_bar.close()
+    # High-water mark of the training steps themselves, since reset_peak_memory() above
+    peak_memory = peak_memory_mb(device)
+
+    # Wait for the last checkpoint write/upload
+    with metrics.span("checkpoint_flush"):
+        checkpoints.close()
+    accelerator.wait_for_everyone()
+    training_seconds = time.time() - train_start_time
+    print(f"Training completed in {training_seconds:.2f} seconds! "
+          f"(memory mode {args.memory_mode}, peak memory {peak_memory:.0f} MB)")
 
     # Save training metadata
     metadata = {
         "brand_id": args.brand_id,
         "brand_name": args.brand_name,
         "num_images": len(image_paths),
-        "training_steps": args.max_train_steps,
+        "images_used": len(dataset),
+        "duplicates_dropped": image_stats["duplicates"],
+        "unreadable_dropped": image_stats["corrupt"],
+        "training_steps": steps_completed,
+        "max_train_steps": max_train_steps,
+        "stop_reason": stop_reason,
+        "smoothed_loss": smoothed_loss.value,
+        "plateau_metric": "validation_loss" if validation is not None else "smoothed_loss",
+        "best_plateau_loss": plateau.best,
+        "best_plateau_step": plateau.best_step,
+        "snr_gamma": args.snr_gamma,
         "learning_rate": args.learning_rate,
         "lora_rank": args.rank,
-        "model_path": f"gs://{args.output_bucket}/{args.output_path}"
+        "batch_size": args.batch_size,
+        "num_processes": accelerator.num_processes,
+        "effective_batch_size": effective_batch_size,
+        "memory_mode": args.memory_mode,
+        "peak_memory_mb": peak_memory,
+        "training_seconds": training_seconds,
+        "resumed_from_step": start_step,
+        "checkpoint_failures": checkpoints.failures,
+        # The compact export is what the generation service loads
+        "model_path": f"gs://{args.output_bucket}/{args.output_path.rstrip('/')}/{EXPORT_WEIGHT_NAME}"
     }
 
+    # The ranks hold identical weights; only the main process saves and uploads
+    if not accelerator.is_main_process:
+        metrics.close()
+        return metadata
+
+    # Save LoRA weights
+    print("Saving LoRA weights...")
+    # PEFT writes named adapters to a subdirectory of the same name
+    output_dir = OUTPUT_DIR if adapter_name == "default" else os.path.join(OUTPUT_DIR, adapter_name)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Save LoRA weights
+    with metrics.span("save_weights"):
+        model.save_pretrained(OUTPUT_DIR, selected_adapters=[adapter_name])
+
+    with metrics.span("export_weights"):
+        metadata["export"] = export_adapter(model, adapter_name, os.path.join(output_dir, EXPORT_WEIGHT_NAME),
+                                            rank=args.export_rank, dtype=args.export_dtype)
+    export = metadata["export"]
+    print(f"Exported {export['dtype']} rank {export['rank']} adapter: {export['bytes'] / 1e6:.1f} MB "
+          f"(trained adapter {export['original_bytes'] / 1e6:.1f} MB, "
+          f"reconstruction error {export['reconstruction_error']:.4f})")
+
     metadata_path = os.path.join(output_dir, "training_metadata.json")
     with open(metadata_path, "w") as f:
         json.dump(metadata, f, indent=2)
 
-    # Upload metadata
-    metadata_blob = bucket.blob(os.path.join(args.output_path, "training_metadata.json"))
-    metadata_blob.upload_from_filename(metadata_path)
+    # Upload the LoRA weights and metadata to Cloud Storage
+    with metrics.span("upload"):
+        for record in transfer.upload_dir(output_dir, args.output_bucket, args.output_path,
+                                          suffixes=('.bin', '.safetensors', '.json')):
+            action = "Unchanged" if record["skipped"] else "Uploaded"
+            print(f"{action}: {record['uri']} ({record['seconds']:.2f}s)")
+
+    # The run is done; a later retrain of this brand must not resume from it
+    with metrics.span("checkpoint_cleanup"):
+        checkpoints.clear()
 
     print(f"Training complete! Model saved to gs://{args.output_bucket}/{args.output_path}")
+    metadata["stages"] = metrics.summary()
+    metrics.emit("summary", stages=metadata["stages"])
+    metrics.close()
+    return metadata
 
 if __name__ == "__main__":
     args = parse_args()
-    train_lora(args)
\ No newline at end of file
+    if args.jobs:
+        results = train_queue(args)
+        if any(result["status"] == "failed" for result in results):
+            sys.exit(1)
+    else:
+        train_lora(args)
@@ -0,0 +1,288 @@
+"""
+Streaming training data for MediaForge LoRA training
+
+Images are decoded and resized lazily in DataLoader worker processes and
+kept as uint8 until they reach the device, so host memory stays flat as
+brand libraries grow. Batches are copied from pinned memory with
+non-blocking transfers, and the next batch is staged while the current
+step runs.
+
+Each image is assigned to the aspect-ratio bucket closest to its own
+shape (all buckets hold roughly resolution^2 pixels), resized to cover it
+and center-cropped, and batches are drawn from one bucket at a time. The
+original size and crop offset are kept for SDXL's size conditioning.
+"""
+
+import math
+import random
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+
+def make_buckets(resolution=1024, max_aspect=2.5):
+    """(width, height) buckets of about resolution^2 pixels, sides multiples of resolution/16
+
+    At 1024 this gives the standard SDXL buckets (1024x1024, 1152x896, 1216x832, ...).
+    Sides stay multiples of 32 so latents divide evenly through the UNet's downsampling.
+    """
+    step = max(32, resolution // 16)
+    target_pixels = resolution * resolution
+    buckets = set()
+    # Pick the short side, derive the long side, and add both orientations
+    for short_side in range(step, resolution + 1, step):
+        long_side = int(target_pixels / short_side) // step * step
+        if long_side / short_side <= max_aspect:
+            buckets.add((short_side, long_side))
+            buckets.add((long_side, short_side))
+    return sorted(buckets)
+
+
+def assign_bucket(image_size, buckets):
+    """Bucket whose aspect ratio is closest (in log space) to the image's"""
+    width, height = image_size
+    aspect = math.log(width / height)
+    return min(buckets, key=lambda bucket: abs(math.log(bucket[0] / bucket[1]) - aspect))
+
+
+def image_size(img_path):
+    """(width, height) from the image header, without decoding pixels"""
+    with Image.open(img_path) as img:
+        return img.size
+
+
+def load_image(img_path, bucket):
+    """Decode one image into its bucket; returns (3, H, W) uint8 pixels and SDXL time ids
+
+    time ids are (original_h, original_w, crop_top, crop_left, target_h, target_w).
+    """
+    target_width, target_height = bucket
+    img = Image.open(img_path).convert("RGB")
+    original_width, original_height = img.size
+
+    # Resize so the image covers the bucket, then center-crop the overflow
+    scale = max(target_width / original_width, target_height / original_height)
+    resized_width = max(target_width, round(original_width * scale))
+    resized_height = max(target_height, round(original_height * scale))
+    img = img.resize((resized_width, resized_height), Image.Resampling.LANCZOS)
+    left = (resized_width - target_width) // 2
+    top = (resized_height - target_height) // 2
+    img = img.crop((left, top, left + target_width, top + target_height))
+
+    pixels = torch.from_numpy(np.asarray(img).copy()).permute(2, 0, 1).contiguous()
+    time_ids = torch.tensor(
+        [original_height, original_width, top, left, target_height, target_width], dtype=torch.float32
+    )
+    return pixels, time_ids
+
+
+def to_model_input(pixels, dtype=torch.float32):
+    """uint8 image batch -> model input in [-1, 1]"""
+    return pixels.to(dtype) / 127.5 - 1.0
+
+
+class BrandImageDataset(Dataset):
+    """Training images decoded into their buckets on demand; unreadable files yield None"""
+
+    def __init__(self, image_paths, buckets):
+        self.image_paths = list(image_paths)
+        self.buckets = list(buckets)
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, index):
+        img_path = self.image_paths[index]
+        try:
+            pixels, time_ids = load_image(img_path, self.buckets[index])
+        except Exception as e:
+            print(f"Error processing {img_path}: {e}")
+            return None
+        return {"pixels": pixels, "time_ids": time_ids, "index": index}
+
+
+class LatentDataset(Dataset):
+    """Cached latent distribution parameters and time ids, memory-mapped per item"""
+
+    def __init__(self, latent_files, time_ids_files):
+        self.latent_files = list(latent_files)
+        self.time_ids_files = list(time_ids_files)
+
+    def __len__(self):
+        return len(self.latent_files)
+
+    def __getitem__(self, index):
+        # Opening per item keeps worker processes from inheriting large mappings
+        parameters = np.load(self.latent_files[index], mmap_mode="r")
+        time_ids = np.load(self.time_ids_files[index])
+        return {
+            "latent_params": torch.from_numpy(np.array(parameters)),
+            "time_ids": torch.from_numpy(time_ids),
+            "index": index,
+        }
+
+
+class BucketBatchSampler(Sampler):
+    """Batches of indices that all share one bucket, so every batch has a single shape
+
+    With num_replicas > 1 each rank iterates its own shard of the epoch's
+    batches; every rank draws the same order from the seed and takes every
+    num_replicas-th batch, so ranks never see the same images in an epoch.
+    """
+
+    def __init__(self, buckets, batch_size=1, shuffle=False, seed=0, drop_last=False, num_replicas=1, rank=0):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.groups = {}
+        for index, bucket in enumerate(buckets):
+            self.groups.setdefault(tuple(bucket), []).append(index)
+
+    def _batches(self, rng):
+        batches = []
+        for bucket in sorted(self.groups):
+            indices = list(self.groups[bucket])
+            if self.shuffle:
+                rng.shuffle(indices)
+            for i in range(0, len(indices), self.batch_size):
+                batch = indices[i:i + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return self._shard(batches)
+
+    def _shard(self, batches):
+        if self.num_replicas == 1 or not batches:
+            return batches
+        # Every rank takes the same number of steps; pad by repeating from the start
+        total = math.ceil(len(batches) / self.num_replicas) * self.num_replicas
+        padded = (batches * math.ceil(total / len(batches)))[:total]
+        return padded[self.rank::self.num_replicas]
+
+    def set_epoch(self, epoch):
+        """Select the epoch's order; the loader may iterate the sampler more than once per pass"""
+        self.epoch = epoch
+
+    def __iter__(self):
+        # A new order every epoch, reproducible from the seed
+        return iter(self._batches(random.Random(self.seed + self.epoch)))
+
+    def __len__(self):
+        return len(self._batches(random.Random(0)))
+
+
+def collate_batch(items):
+    """Stack dict items, dropping images that failed to decode"""
+    items = [item for item in items if item is not None]
+    if not items:
+        return None
+    return {key: torch.stack([torch.as_tensor(item[key]) for item in items]) for key in items[0]}
+
+
+def make_loader(dataset, batch_sampler, num_workers=2):
+    """DataLoader with worker-side decoding and pinned host memory"""
+    return DataLoader(
+        dataset,
+        batch_sampler=batch_sampler,
+        num_workers=num_workers,
+        collate_fn=collate_batch,
+        pin_memory=torch.cuda.is_available(),
+        persistent_workers=num_workers > 0,
+        prefetch_factor=2 if num_workers > 0 else None,
+        # Worker seeds come from a private generator, so starting an epoch
+        # doesn't advance the global RNG (keeps resumed runs reproducible)
+        generator=torch.Generator(),
+    )
+
+
+class DevicePrefetcher:
+    """Iterates a loader, copying the next batch to the device while the current one is used"""
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+    def _to_device(self, batch):
+        if self.stream is None:
+            return {key: value.to(self.device) for key, value in batch.items()}
+        with torch.cuda.stream(self.stream):
+            return {key: value.to(self.device, non_blocking=True) for key, value in batch.items()}
+
+    def _stage_next(self, batches):
+        for batch in batches:
+            if batch is not None:
+                return self._to_device(batch)
+        return None
+
+    def __iter__(self):
+        batches = iter(self.loader)
+        staged = self._stage_next(batches)
+        while staged is not None:
+            if self.stream is not None:
+                # Make the compute stream wait for the copy, and keep the memory alive for it
+                torch.cuda.current_stream(self.device).wait_stream(self.stream)
+                for value in staged.values():
+                    value.record_stream(torch.cuda.current_stream(self.device))
+            batch = staged
+            # Start copying the next batch before handing this one to the caller
+            staged = self._stage_next(batches)
+            yield batch
+
+    def __len__(self):
+        return len(self.loader)
+
+
+class BatchStream:
+    """Endless batches for step-based training, reshuffled each epoch
+
+    Tracks the epoch and position within it so a resumed run continues
+    with the same data order it would have seen without interruption.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.sampler = loader.batch_sampler
+        self.prefetcher = DevicePrefetcher(loader, device)
+        self.epoch = 0
+        self.position = 0
+        self._batches = None
+        self._skip = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            if self._batches is None:
+                self.sampler.set_epoch(self.epoch)
+                self._batches = iter(self.prefetcher)
+            try:
+                batch = next(self._batches)
+            except StopIteration:
+                self._batches = None
+                self.epoch += 1
+                self.position = 0
+                continue
+            self.position += 1
+            if self._skip:
+                # Replaying batches already trained on before the resume
+                self._skip -= 1
+                continue
+            return batch
+
+    def state_dict(self):
+        return {"epoch": self.epoch, "position": self.position}
+
+    def load_state_dict(self, state):
+        self.epoch = state["epoch"]
+        self.position = 0
+        self._batches = None
+        self._skip = state["position"]
@@ -0,0 +1,180 @@
+"""
+Compact LoRA export for MediaForge brand adapters
+
+Shared by the LoRA trainer, which exports each trained adapter, and the
+SDXL generation service, which loads them; the sdxl-lora image is built
+from the repository root to copy it from here.
+
+A trained PEFT adapter is written as one safetensors file with diffusers
+key names ("unet.<module>.lora_A.weight" / "lora_B.weight") and the LoRA
+alpha folded into the weights, so pipe.load_lora_weights() takes it as is.
+Optionally each layer's update is truncated to a lower rank by SVD, and
+the weights are stored in fp16 or as int8 with one fp16 scale per output
+row ("<key>.scale"); int8 files are dequantized by load_lora_state_dict()
+before they reach the pipeline. The file's metadata records the ranks,
+dtype, sizes and the relative reconstruction error of the stored
+update against the trained one.
+"""
+
+import json
+import os
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+# safetensors metadata key holding the export's JSON metadata
+METADATA_KEY = "mediaforge_lora"
+EXPORT_DTYPES = ("fp32", "fp16", "int8")
+EXPORT_WEIGHT_NAME = "lora_weights.safetensors"
+SCALE_SUFFIX = ".scale"
+
+
+def peft_to_diffusers(state_dict, prefix="unet"):
+    """PEFT adapter keys ("base_model.model.<module>.lora_A.weight") -> diffusers keys"""
+    converted = {}
+    for key, tensor in state_dict.items():
+        module_key = key.removeprefix("base_model.model.")
+        converted[f"{prefix}.{module_key}"] = tensor
+    return converted
+
+
+def _lora_pairs(state_dict):
+    """{module: (lora_A key, lora_B key)} for every LoRA layer in a diffusers state dict"""
+    pairs = {}
+    for key in state_dict:
+        if key.endswith(".lora_A.weight"):
+            module = key[:-len(".lora_A.weight")]
+            pairs[module] = (key, f"{module}.lora_B.weight")
+    return pairs
+
+
+def reduce_rank(down, up, scale=1.0, rank=None):
+    """Factors of scale * up @ down truncated to rank, with the singular values split evenly
+
+    Works on the (rank x rank) core of the factors rather than the full
+    weight update. Returns (down, up, singular values); keeping all of them
+    just rebalances the factors, which also suits int8 storage.
+    """
+    down = down.double()
+    up = up.double() * scale
+    q_up, r_up = torch.linalg.qr(up)
+    q_down, r_down = torch.linalg.qr(down.T)
+    u, s, vh = torch.linalg.svd(r_up @ r_down.T)
+    rank = min(rank or len(s), len(s))
+    root = s[:rank].sqrt()
+    new_up = (q_up @ u[:, :rank]) * root
+    new_down = root[:, None] * (vh[:rank] @ q_down.T)
+    return new_down, new_up, s
+
+
+def _update_error(down, up, new_down, new_up):
+    """(squared Frobenius error, squared norm) of new_up @ new_down against up @ down, from the factors"""
+    down, up, new_down, new_up = (t.double() for t in (down, up, new_down, new_up))
+    norm = torch.trace((up.T @ up) @ (down @ down.T))
+    new_norm = torch.trace((new_up.T @ new_up) @ (new_down @ new_down.T))
+    cross = torch.trace((up.T @ new_up) @ (new_down @ down.T))
+    return max(float(norm - 2 * cross + new_norm), 0.0), float(norm)
+
+
+def quantize_int8(tensor):
+    """Symmetric int8 with one scale per row; returns (int8 tensor, fp16 scales)"""
+    tensor = tensor.float()
+    scale = tensor.abs().amax(dim=1, keepdim=True) / 127
+    scale = scale.half().float().clamp(min=torch.finfo(torch.float16).tiny)
+    quantized = torch.round(tensor / scale).clamp(-127, 127).to(torch.int8)
+    return quantized, scale.squeeze(1).half()
+
+
+def dequantize_int8(quantized, scale, dtype=torch.float32):
+    return (quantized.float() * scale.float()[:, None]).to(dtype)
+
+
+def _encode(key, tensor, dtype):
+    """({key: stored tensor(s)}, what the tensor reads back as) for storage in dtype"""
+    if dtype == "int8":
+        quantized, scale = quantize_int8(tensor)
+        return {key: quantized, key + SCALE_SUFFIX: scale}, dequantize_int8(quantized, scale)
+    stored = tensor.to(torch.float16 if dtype == "fp16" else torch.float32).contiguous()
+    return {key: stored}, stored.float()
+
+
+def export_lora(state_dict, path, lora_scale=1.0, rank=None, dtype="fp16"):
+    """Write a diffusers LoRA state dict (alpha not yet applied) as one compact file
+
+    lora_scale is the adapter's alpha / r, folded into the weights; rank
+    truncates every layer to at most that rank. Returns the metadata
+    recorded in the file.
+    """
+    if dtype not in EXPORT_DTYPES:
+        raise ValueError(f"Unknown export dtype {dtype!r}; expected one of {EXPORT_DTYPES}")
+
+    pairs = _lora_pairs(state_dict)
+    tensors = {}
+    error_total = norm_total = 0.0
+    max_error = 0.0
+    ranks = set()
+    original_ranks = set()
+    for module, (down_key, up_key) in pairs.items():
+        down, up = state_dict[down_key], state_dict[up_key]
+        original_ranks.add(down.shape[0])
+        new_down, new_up, _ = reduce_rank(down, up, lora_scale, rank)
+        stored_down, new_down = _encode(down_key, new_down, dtype)
+        stored_up, new_up = _encode(up_key, new_up, dtype)
+        tensors.update(stored_down)
+        tensors.update(stored_up)
+        ranks.add(new_down.shape[0])
+
+        error, norm = _update_error(down, up * lora_scale, new_down, new_up)
+        error_total += error
+        norm_total += norm
+        if norm > 0:
+            max_error = max(max_error, (error / norm) ** 0.5)
+
+    # Anything that isn't a LoRA pair (none for UNet attention adapters) is kept as is
+    paired = {key for keys in pairs.values() for key in keys}
+    for key, tensor in state_dict.items():
+        if key not in paired:
+            tensors[key] = tensor.contiguous()
+
+    metadata = {
+        "dtype": dtype,
+        "rank": max(ranks) if ranks else 0,
+        "original_rank": max(original_ranks) if original_ranks else 0,
+        "layers": len(pairs),
+        "reconstruction_error": (error_total / norm_total) ** 0.5 if norm_total > 0 else 0.0,
+        "max_layer_reconstruction_error": max_error,
+        "original_bytes": sum(t.numel() * t.element_size() for t in state_dict.values()),
+    }
+    save_file(tensors, path, metadata={"format": "pt", METADATA_KEY: json.dumps(metadata)})
+    metadata["bytes"] = os.path.getsize(path)
+    return metadata
+
+
+def export_metadata(path):
+    """Metadata written by export_lora(), or None for other LoRA files"""
+    with safe_open(path, framework="pt") as f:
+        metadata = f.metadata() or {}
+    if METADATA_KEY not in metadata:
+        return None
+    return json.loads(metadata[METADATA_KEY])
+
+
+def is_quantized(path):
+    """Whether path is an int8 export file that needs load_lora_state_dict() before loading"""
+    if os.path.isdir(path):
+        return False
+    metadata = export_metadata(path)
+    return metadata is not None and metadata["dtype"] == "int8"
+
+
+def load_lora_state_dict(path, dtype=torch.float32):
+    """A LoRA file's state dict for pipe.load_lora_weights(), int8 exports dequantized to dtype"""
+    state_dict = load_file(path)
+    scales = {key for key in state_dict if key.endswith(SCALE_SUFFIX)}
+    for scale_key in scales:
+        key = scale_key[:-len(SCALE_SUFFIX)]
+        state_dict[key] = dequantize_int8(state_dict[key], state_dict[scale_key], dtype)
+    for scale_key in scales:
+        del state_dict[scale_key]
+    return state_dict
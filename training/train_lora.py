@@ -12,33 +12,33 @@ import torch
 from diffusers import StableDiffusionXLPipeline, AutoencoderKL
 from diffusers.loaders import LoraLoaderMixin
 from peft import LoraConfig, get_peft_model
-from google.cloud import storage, firestore
 import logging
+import time
+
+from brand_status import update_brand_status
+from gcs_transfer import default_transfer
+from instrumentation import Instrumentation
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def download_training_images(bucket_name: str, input_path: str, local_dir: str):
+def download_training_images(bucket_name: str, input_path: str, local_dir: str, transfer=None):
     """Download training images from Cloud Storage"""
     logger.info(f"Downloading images from gs://{bucket_name}/{input_path}")
 
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=input_path)
-
-    os.makedirs(local_dir, exist_ok=True)
-    count = 0
-
-    for blob in blobs:
-        if blob.name.endswith(('.jpg', '.jpeg', '.png')):
-            local_path = os.path.join(local_dir, os.path.basename(blob.name))
-            blob.download_to_filename(local_path)
-            count += 1
-            logger.info(f"Downloaded {count}: {blob.name}")
+    transfer = transfer or default_transfer()
+    start_time = time.time()
+    local_paths = transfer.download_prefix(
+        bucket_name, input_path, local_dir, suffixes=('.jpg', '.jpeg', '.png')
+    )
 
-    logger.info(f"Downloaded {count} training images")
-    return count
+    stats = transfer.summary("download")
+    logger.info(
+        f"Downloaded {len(local_paths)} training images in {time.time() - start_time:.2f}s "
+        f"({stats['transferred']} fetched, {stats['skipped']} unchanged, {stats['bytes'] / 1e6:.1f} MB)"
+    )
+    return len(local_paths)
 
 
 def train_lora(
@@ -91,49 +91,20 @@ def train_lora(
     return weights_path
 
 
-def upload_model(local_path: str, bucket_name: str, output_path: str):
+def upload_model(local_path: str, bucket_name: str, output_path: str, transfer=None):
     """Upload trained model to Cloud Storage"""
     logger.info(f"Uploading model to gs://{bucket_name}/{output_path}")
 
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-
-    for root, dirs, files in os.walk(local_path):
-        for file in files:
-            local_file = os.path.join(root, file)
-            relative_path = os.path.relpath(local_file, local_path)
-            blob_path = os.path.join(output_path, relative_path)
-
-            blob = bucket.blob(blob_path)
-            blob.upload_from_filename(local_file)
-            logger.info(f"Uploaded {blob_path}")
+    transfer = transfer or default_transfer()
+    for record in transfer.upload_dir(local_path, bucket_name, output_path):
+        action = "Unchanged" if record["skipped"] else "Uploaded"
+        logger.info(f"{action} {record['uri']} ({record['seconds']:.2f}s)")
 
     model_uri = f"gs://{bucket_name}/{output_path}"
     logger.info(f"Model uploaded to {model_uri}")
     return model_uri
 
 
-def update_brand_status(brand_id: str, user_id: str, status: str, model_path: str = None):
-    """Update brand training status in Firestore"""
-    logger.info(f"Updating brand {brand_id} status to {status}")
-
-    db = firestore.Client()
-    brand_ref = db.collection('users').document(user_id).collection('brands').document(brand_id)
-
-    update_data = {
-        'status': status,
-    }
-
-    if status == 'ready' and model_path:
-        update_data['loraModelPath'] = model_path
-        update_data['trainingCompletedAt'] = firestore.SERVER_TIMESTAMP
-    elif status == 'failed':
-        update_data['failedAt'] = firestore.SERVER_TIMESTAMP
-
-    brand_ref.update(update_data)
-    logger.info(f"Brand status updated to {status}")
-
-
 def main():
     parser = argparse.ArgumentParser(description='Train SDXL LoRA for brand style')
     parser.add_argument('--brand_id', required=True, help='Brand ID')
@@ -147,45 +118,58 @@ def main():
     parser.add_argument('--max_train_steps', type=int, default=500, help='Max training steps')
     parser.add_argument('--learning_rate', type=float, default=1e-4, help='Learning rate')
     parser.add_argument('--rank', type=int, default=4, help='LoRA rank')
+    parser.add_argument('--metrics_file', default='',
+                        help="Write stage timings as JSON lines here ('-' for stdout; "
+                             "default $MEDIAFORGE_METRICS_FILE)")
 
     args = parser.parse_args()
 
+    metrics = Instrumentation.from_env(
+        'lora-training', sink=args.metrics_file, context={'brand_id': args.brand_id}
+    )
+
     try:
         # Update status to training
-        update_brand_status(args.brand_id, args.user_id, 'training')
+        with metrics.span('status_update', brand_status='training'):
+            update_brand_status(args.brand_id, args.user_id, 'training')
 
         # Download training data
         local_train_dir = '/tmp/training_data'
-        num_images = download_training_images(
-            args.input_bucket,
-            args.input_path,
-            local_train_dir
-        )
+        with metrics.span('download') as span:
+            num_images = download_training_images(
+                args.input_bucket,
+                args.input_path,
+                local_train_dir
+            )
+            span['images'] = num_images
 
         if num_images < 10:
             raise ValueError(f"Insufficient training images: {num_images} (minimum 10)")
 
         # Train LoRA
         local_output_dir = '/tmp/lora_output'
-        train_lora(
-            brand_id=args.brand_id,
-            brand_name=args.brand_name,
-            train_data_dir=local_train_dir,
-            output_dir=local_output_dir,
-            num_train_steps=args.max_train_steps,
-            learning_rate=args.learning_rate,
-            rank=args.rank,
-        )
+        with metrics.span('train', steps=args.max_train_steps):
+            train_lora(
+                brand_id=args.brand_id,
+                brand_name=args.brand_name,
+                train_data_dir=local_train_dir,
+                output_dir=local_output_dir,
+                num_train_steps=args.max_train_steps,
+                learning_rate=args.learning_rate,
+                rank=args.rank,
+            )
 
         # Upload trained model
-        model_uri = upload_model(
-            local_output_dir,
-            args.output_bucket,
-            args.output_path
-        )
+        with metrics.span('upload'):
+            model_uri = upload_model(
+                local_output_dir,
+                args.output_bucket,
+                args.output_path
+            )
 
         # Update status to ready
-        update_brand_status(args.brand_id, args.user_id, 'ready', model_uri)
+        with metrics.span('status_update', brand_status='ready'):
+            update_brand_status(args.brand_id, args.user_id, 'ready', model_uri)
 
         logger.info(f"Training completed successfully for {args.brand_name}")
 
@@ -193,6 +177,9 @@ def main():
         logger.error(f"Training failed: {e}", exc_info=True)
         update_brand_status(args.brand_id, args.user_id, 'failed')
         raise
+    finally:
+        metrics.emit('summary', stages=metrics.summary())
+        metrics.close()
 
 
 if __name__ == '__main__':